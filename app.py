@@ -8,22 +8,35 @@ import os
 import threading
 import subprocess
 import json
+import math
+import atexit
 import psycopg2
 from pathlib import Path
 from dotenv import load_dotenv
 import time
+import uuid
 
 from modules.config_loader import ConfigLoader
 from modules.room_config_manager import RoomConfigManager
-from modules.battery_tracker import BatteryTracker
-from modules.gift_sender import GiftSender
+from modules.room_config_store import create_room_config_store
+from modules.battery_tracker import BatteryTracker, format_retry_after
+from modules.quota_store import create_quota_store
+from modules.gift_sender import GiftSender, GiftNotSentError
 from modules.danmaku_sender import DanmakuSender
 from modules.like_sender import LikeSender
+from modules.action_queue import ActionQueue, ActionQueueFull
 from modules.db_handler import DBHandler
+from modules.db_pool import get_db_pool, close_all_pools
+from modules.gift_write_buffer import GiftWriteBuffer
+from modules.event_spool import EventSpool, SpoolError
+from modules.partition_manager import create_partition_manager
+from modules.leaderboard import start_leaderboard
+from modules.event_bus import get_event_bus
 from modules.gift_api import gift_api_bp
 from modules.logger import get_logger, debug, info, warning, error, critical
 from tools.init_db import init_database, init_guard_table
 from modules.chatbot import ChatbotHandler
+from modules.welcome_batcher import create_welcome_batcher
 
 
 class DanmakuGiftApp:
@@ -53,52 +66,157 @@ class DanmakuGiftApp:
             del self.config["log_file"]
 
         # ---------- 初始化房间配置管理 ----------
-        self.room_config_manager = RoomConfigManager(room_config_path, self.config)
+        # 配置存储由 ROOM_CONFIG_BACKEND 选择，多个 worker 时使用 sqlite / postgres 共享配置
+        self.room_config_manager = RoomConfigManager(
+            room_config_path, self.config, store=create_room_config_store(room_config_path)
+        )
+        self.room_config_manager.start()
+        # 退出前停止后台刷新并写入尚未保存的房间配置
+        atexit.register(self.room_config_manager.close)
 
         # ---------- 初始化电池统计管理 ----------
+        # 额度存储由 BATTERY_QUOTA_BACKEND 选择，多个 worker 时使用 sqlite / postgres 共享额度
         self.battery_tracker = BatteryTracker(
-            reset_hour=self.config["reset_hour"]
+            reset_hour=self.config["reset_hour"],
+            store=create_quota_store()
         )
+        # 退出前把进程内额度快照写盘（atexit 后注册先执行：先停后台线程再写快照）
+        atexit.register(self.battery_tracker.store.close)
+        self.battery_tracker.start()
+        atexit.register(self.battery_tracker.stop)
 
         # ---------- 初始化礼物发送器 ----------
         self.gift_sender = GiftSender("./missions/send_gift")
+
+        # ---------- 初始化出站动作队列 ----------
+        # 送礼/弹幕/点赞统一入队，由后台线程执行，HTTP 请求不再等待 B 站接口
+        self.action_queue = ActionQueue(
+            num_workers=int(os.environ.get("ACTION_QUEUE_WORKERS", 4)),
+            max_pending=int(os.environ.get("ACTION_QUEUE_MAX_PENDING", 1000)),
+            max_attempts=int(os.environ.get("ACTION_MAX_ATTEMPTS", 3)),
+        )
+        atexit.register(self.action_queue.shutdown)
         
         # ---------- 初始化礼物记录数据库 ----------
         self.table_name = table_name
         self.no_dep = bool(no_dep)
         if not self.no_dep:
+            # 按月分区为可选项；已有的普通表不会在启动时自动迁移（见 tools/init_db.py --migrate-partitions）
+            partitioned = os.environ.get("GIFT_PARTITIONING", "false").lower() == "true"
             # 确保表存在但不强制重建
-            init_database(env_path, table_name, drop_existing=False)
+            init_database(env_path, table_name, drop_existing=False, partitioned=partitioned)
             # ---------- 初始化数据库处理器 ----------
             self.db_handler = DBHandler(env_path, table_name)
             # ---------- 初始化上舰记录数据库 ----------
             self.guard_table_name = "guard_records"
-            init_guard_table(env_path, self.guard_table_name, drop_existing=False)
+            init_guard_table(env_path, self.guard_table_name, drop_existing=False, partitioned=partitioned)
             self.guard_db_handler = DBHandler(env_path, self.guard_table_name)
+            atexit.register(close_all_pools)
+            # ---------- 分区维护：预建未来分区、处理过期分区 ----------
+            if partitioned:
+                self.partition_manager = create_partition_manager(
+                    self.db_handler.db_config, [table_name, self.guard_table_name]
+                )
+                self.partition_manager.start()
+            # ---------- 内存贡献排行榜：后台加载，之后随礼物写入增量更新 ----------
+            if os.environ.get("LEADERBOARD_ENABLED", "true").lower() == "true":
+                start_leaderboard(self.db_handler)
+            # ---------- 实时推送：礼物与上舰记录提交后发布到 /api/gift/stream ----------
+            event_bus = get_event_bus()
+            event_bus.add_source("gift", self.db_handler)
+            event_bus.add_source("guard", self.guard_db_handler)
         else:
             self.db_handler = None
             self.guard_db_handler = None
+
+        # ---------- 礼物写入模式 ----------
+        # direct: 每条礼物立即写库；write_behind: 先进入内存缓冲区，由后台线程批量写库；
+        # spool: 礼物与上舰事件先 fsync 到本地 spool 文件，由后台线程幂等重放到数据库
+        self.gift_ingest_mode = os.environ.get("GIFT_INGEST_MODE", "direct").lower()
+        self.gift_write_buffer = None
+        self.event_spool = None
+        if self.db_handler is not None and self.gift_ingest_mode == "spool":
+            self.event_spool = EventSpool(
+                os.environ.get("SPOOL_DIR", "data/spool"),
+                self._replay_spooled_events,
+                segment_max_bytes=int(os.environ.get("SPOOL_SEGMENT_MB", 64)) * 1024 * 1024,
+                replay_batch_size=int(os.environ.get("SPOOL_REPLAY_BATCH", 500)),
+            )
+            # 晚于连接池注册，退出时先于连接池关闭执行
+            atexit.register(self.event_spool.close)
+        if self.db_handler is not None and self.gift_ingest_mode == "write_behind":
+            self.gift_write_buffer = GiftWriteBuffer(
+                self.db_handler,
+                max_size=int(os.environ.get("GIFT_BUFFER_MAX_SIZE", 10000)),
+                batch_size=int(os.environ.get("GIFT_BUFFER_BATCH_SIZE", 500)),
+                flush_interval=float(os.environ.get("GIFT_BUFFER_FLUSH_MS", 200)) / 1000.0,
+                dead_letter_path=os.environ.get("GIFT_BUFFER_DEAD_LETTER", "data/dead_letter/gift_rows.jsonl"),
+            )
+            # 晚于连接池注册，退出时先于连接池关闭执行
+            atexit.register(self.gift_write_buffer.close)
+        
+        # 批量接口单次请求的最大条目数
+        self.batch_max_items = int(os.environ.get("BATCH_MAX_ITEMS", 1000))
         
         # ---------- 注册蓝图 ----------
         self.app.register_blueprint(gift_api_bp)
 
         # 初始化chatbot处理器（传入房间配置管理器以支持按房间自定义system prompt）
         self.chatbot_handler = ChatbotHandler(env_path="missions/.env", room_config_manager=self.room_config_manager)
+        # 进场欢迎按房间合并（WELCOME_BATCH_WINDOW=0 时每次进场单独发送）
+        self.welcome_batcher = create_welcome_batcher(self._compose_welcome, self._enqueue_danmaku)
 
         # 注册路由
         self.register_routes()
         
         info(f"Gift API endpoints registered successfully (table: {table_name})")
 
+    @staticmethod
+    def _to_spool_event(kind, data, received_at):
+        """构造 spool 事件；payload 没有 tid 时生成一个，保证重放时可以去重"""
+        payload = dict(data)
+        if payload.get("tid") is None:
+            payload["tid"] = f"spool-{uuid.uuid4().hex}"
+        return {"kind": kind, "received_at": received_at, "payload": payload}
+
+    def _spool_event(self, kind, data):
+        """
+        把单条事件写入本地 spool
+        :return: 事件的 tid
+        """
+        event = self._to_spool_event(kind, data, time.time())
+        self.event_spool.append(event)
+        return event["payload"]["tid"]
+
+    def _replay_spooled_events(self, events):
+        """
+        spool 重放回调：按类型批量写库，tid 已存在的记录跳过（幂等）
+        异常向上抛出：临时错误由 spool 稍后重试整批事件；数据库数据错误、事件格式错误或未知类型时
+        spool 逐条重放并把坏事件写入死信文件
+        """
+        gift_rows = []
+        guard_rows = []
+        for event in events:
+            kind = event.get("kind")
+            if kind == "gift":
+                gift_rows.append(self.db_handler.build_gift_row(event["payload"], event.get("received_at")))
+            elif kind == "guard":
+                guard_rows.append(self.guard_db_handler.build_guard_row(event["payload"], event.get("received_at")))
+            else:
+                raise ValueError(f"未知类型的 spool 事件: {kind}")
+
+        if gift_rows:
+            self.db_handler.insert_gift_rows(gift_rows, skip_existing_tid=True)
+        if guard_rows:
+            self.guard_db_handler.insert_guard_rows(guard_rows, skip_existing_tid=True)
+
     def _get_db_connection(self):
-        """获取数据库连接"""
-        return psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"),
-            database=os.getenv("DB_NAME")
-        )
+        """从共享连接池获取数据库连接，用完需调用 _release_db_connection 归还"""
+        return get_db_pool().getconn()
+
+    def _release_db_connection(self, conn):
+        """归还数据库连接"""
+        get_db_pool().putconn(conn)
 
     def register_routes(self):
         self.app.add_url_rule('/ticket', view_func=self.process_ticket, methods=['POST'])
@@ -106,12 +224,213 @@ class DanmakuGiftApp:
         self.app.add_url_rule('/live_room_spider', view_func=self.start_live_room_spider, methods=['POST'])
         self.app.add_url_rule('/money', view_func=self.handle_money, methods=['POST'])
         self.app.add_url_rule('/guard', view_func=self.handle_guard, methods=['POST'])
+        self.app.add_url_rule('/money/batch', view_func=self.handle_money_batch, methods=['POST'])
+        self.app.add_url_rule('/guard/batch', view_func=self.handle_guard_batch, methods=['POST'])
         # 兼容客户端可能使用的前缀
         self.app.add_url_rule('/api/guard', view_func=self.handle_guard, methods=['POST'])
         self.app.add_url_rule('/setting', view_func=self.handle_setting, methods=['POST'])
         self.app.add_url_rule('/chatbot', view_func=self.handle_chatbot, methods=['POST'])
         self.app.add_url_rule('/sendlike', view_func=self.handle_sendlike, methods=['POST'])
         self.app.add_url_rule('/entry_welcome', view_func=self.handle_entry_welcome, methods=['POST'])
+        self.app.add_url_rule('/jobs/<job_id>', view_func=self.handle_job_status, methods=['GET'])
+
+    def _enqueue_danmaku(self, room_id, text):
+        """
+        把弹幕放入出站队列，返回 job_id；队列已满时只记录日志并返回 None
+        """
+        try:
+            return self.action_queue.submit(room_id, "danmaku", DanmakuSender().send_danmaku, room_id, text)
+        except ActionQueueFull as e:
+            warning(str(e))
+            return None
+
+    def _enqueue_gift(self, room_id, num, account, gift_id):
+        """
+        把送礼放入出站队列，返回 job_id。
+        超时、连接中断等错误发生时请求可能已经送出礼物，因此只对确定请求尚未发出的失败
+        （GiftNotSentError）进行重试，避免重复送礼。
+        """
+        return self.action_queue.submit(
+            room_id, "gift", self.gift_sender.send_gift,
+            room_id, num, account, gift_id,
+            retry_on=(GiftNotSentError,)
+        )
+
+    def handle_job_status(self, job_id):
+        """
+        查询出站动作的执行状态
+        """
+        job = self.action_queue.get_job(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found", "job_id": job_id}), 404
+        return jsonify({"status": "success", "job": job}), 200
+
+    # /money 与 /guard（含批量接口）的必需字段
+    MONEY_REQUIRED_FIELDS = ("room_id", "uid", "uname", "gift_id", "gift_name", "price")
+    GUARD_REQUIRED_FIELDS = (
+        "room_id", "uid", "username", "guard_level", "count",
+        "price", "gift_id", "gift_name"
+    )
+
+    @staticmethod
+    def _parse_batch_body():
+        """
+        解析批量接口的请求体：JSON 数组，或每行一个 JSON 对象（JSON Lines）
+        :raises ValueError: 请求体格式不合法
+        """
+        data = request.get_json(silent=True)
+        if isinstance(data, list):
+            return data
+        if isinstance(data, dict) and isinstance(data.get("items"), list):
+            return data["items"]
+        if data is not None:
+            raise ValueError("Batch body must be a JSON array or JSON lines")
+
+        items = []
+        for line_no, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError(f"Invalid JSON on line {line_no}: {e}")
+        return items
+
+    def _handle_batch(self, kind, required_fields, db_handler, build_row, insert_rows, write_buffer=None):
+        """
+        批量接口的通用处理：一次遍历完成校验，合法条目在一个事务内用多行 INSERT 写入，
+        并按请求顺序返回每一条的处理结果（inserted / duplicate / invalid / accepted / skipped）
+        :param write_buffer: 写后缓冲模式下的缓冲区，合法条目整批放入缓冲区（目前只有礼物有写后缓冲）
+        """
+        try:
+            items = self._parse_batch_body()
+        except ValueError as e:
+            return jsonify({"error": "Invalid batch body", "details": str(e)}), 400
+
+        if not items:
+            return jsonify({"error": "Empty batch"}), 400
+        if len(items) > self.batch_max_items:
+            return jsonify({
+                "error": f"Batch too large, max {self.batch_max_items} items",
+                "count": len(items)
+            }), 413
+
+        results = [None] * len(items)
+        valid = []
+        received_at = time.time()
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {"index": index, "status": "invalid", "error": "Item must be a JSON object"}
+                continue
+            missing = [field for field in required_fields if field not in item]
+            if missing:
+                results[index] = {"index": index, "status": "invalid", "error": f"Missing required field: {missing[0]}"}
+                continue
+            try:
+                row = build_row(item, received_at)
+            except (TypeError, ValueError) as e:
+                results[index] = {"index": index, "status": "invalid", "error": f"Invalid field value: {e}"}
+                continue
+            valid.append((index, item, row))
+
+        if valid:
+            stored = self._store_batch(kind, valid, results, received_at, db_handler, insert_rows, write_buffer)
+            if not stored:
+                warning(f"写后缓冲空间不足，拒绝 {kind} 批量请求: {len(valid)} 条")
+                return jsonify({"error": "Gift buffer is full, retry later", "count": len(valid)}), 503
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        info(f"Batch {kind} request processed: total={len(items)}, {counts}")
+
+        return jsonify({
+            "status": "success" if "invalid" not in counts else "partial",
+            "total": len(items),
+            "counts": counts,
+            "results": results
+        }), 200
+
+    def _store_batch(self, kind, valid, results, received_at, db_handler, insert_rows, write_buffer):
+        """
+        写入校验通过的批量条目，并把每一条的处理结果填入 results
+        :return: 写后缓冲空间不足、整批未被接收时返回 False
+        """
+        if self.no_dep or db_handler is None:
+            info(f"[no-dep] Skip DB record for {len(valid)} {kind} items")
+            for index, _, _ in valid:
+                results[index] = {"index": index, "status": "skipped", "record_id": None}
+        elif self.event_spool is not None:
+            # spool 模式：整批落盘（一次 fsync）后返回，由后台重放写库
+            events = []
+            for index, item, _ in valid:
+                event = self._to_spool_event(kind, item, received_at)
+                events.append(event)
+                results[index] = {"index": index, "status": "accepted", "record_id": None, "tid": event["payload"]["tid"]}
+            self.event_spool.append_many(events)
+        elif write_buffer is not None:
+            # 写后缓冲模式：整批放入缓冲区，要么全部接收要么全部拒绝，上游可以安全地重试整批
+            if not write_buffer.offer_many([row for _, _, row in valid]):
+                return False
+            for index, _, _ in valid:
+                results[index] = {"index": index, "status": "accepted", "record_id": None}
+        else:
+            # 同一批次内 tid 重复或已入库的记录跳过，上游重试整批时不会重复写入
+            record_ids = insert_rows([row for _, _, row in valid], skip_existing_tid=True)
+            for (index, _, _), record_id in zip(valid, record_ids):
+                if record_id is None:
+                    results[index] = {"index": index, "status": "duplicate", "record_id": None}
+                else:
+                    results[index] = {"index": index, "status": "inserted", "record_id": record_id}
+        return True
+
+    def handle_money_batch(self):
+        """
+        批量记录礼物：请求体为 /money 负载组成的 JSON 数组或 JSON Lines
+        """
+        try:
+            db_handler = self.db_handler
+            return self._handle_batch(
+                "gift", self.MONEY_REQUIRED_FIELDS, db_handler,
+                DBHandler.build_gift_row,
+                db_handler.insert_gift_rows if db_handler is not None else None,
+                write_buffer=self.gift_write_buffer,
+            )
+        except SpoolError as e:
+            error(f"Spool error: {e}")
+            return jsonify({"error": "Spool write failed", "details": str(e)}), 500
+        except psycopg2.Error as e:
+            error(f"Database error: {e}")
+            traceback.print_exc()
+            return jsonify({"error": "Database error", "details": str(e)}), 500
+        except Exception as e:
+            error(f"Server error: {e}")
+            traceback.print_exc()
+            return jsonify({"error": "Server error", "details": str(e)}), 500
+
+    def handle_guard_batch(self):
+        """
+        批量记录上舰：请求体为 /guard 负载组成的 JSON 数组或 JSON Lines
+        """
+        try:
+            db_handler = self.guard_db_handler
+            return self._handle_batch(
+                "guard", self.GUARD_REQUIRED_FIELDS, db_handler,
+                DBHandler.build_guard_row,
+                db_handler.insert_guard_rows if db_handler is not None else None,
+            )
+        except SpoolError as e:
+            error(f"Spool error: {e}")
+            return jsonify({"error": "Spool write failed", "details": str(e)}), 500
+        except psycopg2.Error as e:
+            error(f"Database error: {e}")
+            traceback.print_exc()
+            return jsonify({"error": "Database error", "details": str(e)}), 500
+        except Exception as e:
+            error(f"Server error: {e}")
+            traceback.print_exc()
+            return jsonify({"error": "Server error", "details": str(e)}), 500
 
     def handle_money(self):
         """
@@ -124,8 +443,7 @@ class DanmakuGiftApp:
             data = request.json
             
             # 验证必要字段
-            required_fields = ["room_id", "uid", "uname", "gift_id", "gift_name", "price"]
-            for field in required_fields:
+            for field in self.MONEY_REQUIRED_FIELDS:
                 if field not in data:
                     return jsonify({"error": f"Missing required field: {field}"}), 400
             
@@ -138,6 +456,40 @@ class DanmakuGiftApp:
                     "record_id": None
                 }), 200
 
+            # 写后缓冲模式：校验后放入缓冲区，立即返回 202
+            if self.gift_write_buffer is not None:
+                try:
+                    row = self.db_handler.build_gift_row(data)
+                except (TypeError, ValueError) as e:
+                    return jsonify({"error": "Invalid field value", "details": str(e)}), 400
+
+                if not self.gift_write_buffer.offer(row):
+                    warning(f"礼物写后缓冲已满，拒绝礼物记录: user={data['uname']}, gift={data['gift_name']}")
+                    return jsonify({"error": "Gift buffer is full, retry later"}), 503
+
+                debug(f"Gift record buffered, from user: {data['uname']}, gift: {data['gift_name']}")
+                return jsonify({
+                    "status": "accepted",
+                    "message": "Gift record queued for batch write",
+                    "record_id": None
+                }), 202
+
+            # spool 模式：校验后落盘到本地 spool，立即返回 202
+            if self.event_spool is not None:
+                try:
+                    self.db_handler.build_gift_row(data)
+                except (TypeError, ValueError) as e:
+                    return jsonify({"error": "Invalid field value", "details": str(e)}), 400
+
+                tid = self._spool_event("gift", data)
+                debug(f"Gift record spooled, tid: {tid}, from user: {data['uname']}, gift: {data['gift_name']}")
+                return jsonify({
+                    "status": "accepted",
+                    "message": "Gift record spooled for write",
+                    "record_id": None,
+                    "tid": tid
+                }), 202
+
             # 使用新版写入（覆盖更丰富字段），向后兼容：缺失字段将写入 NULL
             record_id = self.db_handler.add_gift_record_v2(data)
             
@@ -149,6 +501,9 @@ class DanmakuGiftApp:
                 "record_id": record_id
             }), 200
             
+        except SpoolError as e:
+            error(f"Spool error: {e}")
+            return jsonify({"error": "Spool write failed", "details": str(e)}), 500
         except psycopg2.Error as e:
             error(f"Database error: {e}")
             traceback.print_exc()
@@ -168,11 +523,7 @@ class DanmakuGiftApp:
             data = request.json or {}
 
             # 校验必需字段
-            required_fields = [
-                "room_id", "uid", "username", "guard_level", "count",
-                "price", "gift_id", "gift_name"
-            ]
-            for field in required_fields:
+            for field in self.GUARD_REQUIRED_FIELDS:
                 if field not in data:
                     return jsonify({"error": f"Missing required field: {field}"}), 400
 
@@ -185,6 +536,22 @@ class DanmakuGiftApp:
                     "record_id": None
                 }), 200
 
+            # spool 模式：校验后落盘到本地 spool，立即返回 202
+            if self.event_spool is not None:
+                try:
+                    self.guard_db_handler.build_guard_row(data)
+                except (TypeError, ValueError) as e:
+                    return jsonify({"error": "Invalid field value", "details": str(e)}), 400
+
+                tid = self._spool_event("guard", data)
+                debug(f"Guard record spooled, tid: {tid}, user: {data.get('username')}")
+                return jsonify({
+                    "status": "accepted",
+                    "message": "Guard record spooled for write",
+                    "record_id": None,
+                    "tid": tid
+                }), 202
+
             record_id = self.guard_db_handler.add_guard_record(data)
 
             return jsonify({
@@ -192,6 +559,9 @@ class DanmakuGiftApp:
                 "message": "Guard record saved successfully",
                 "record_id": record_id
             }), 200
+        except SpoolError as e:
+            error(f"Spool error: {e}")
+            return jsonify({"error": "Spool write failed", "details": str(e)}), 500
         except psycopg2.Error as e:
             error(f"Database error: {e}")
             traceback.print_exc()
@@ -232,7 +602,6 @@ class DanmakuGiftApp:
 
             room_id = str(data['room_id'])
             danmaku = data['danmaku']
-            notifee = DanmakuSender()
 
             # ---------- 根据弹幕关键字决定业务逻辑 ----------
             if "全境" in danmaku:
@@ -274,76 +643,82 @@ class DanmakuGiftApp:
                 system_tz = time.tzname
                 msg = f"密码错误! 弹幕 '{danmaku}' 不包含正确密码 {target_number}，无法触发脚本。UTC时间：{now}，基础值：{sum_value}，幂次：{power}，系统时区：{system_tz}"
                 error(msg)  # 使用error级别确保一定会打印
-                notifee.send_danmaku(room_id, "喵喵喵！喵！")
+                self._enqueue_danmaku(room_id, "喵喵喵！喵！")
                 debug(msg)
                 return jsonify({"status": "failed", "reason": msg}), 400
 
             # ---------- 检查并更新电池用量 ----------
-            with self.battery_tracker.lock:
-                # 可能在整点或跨日时需要重置
-                self.battery_tracker.reset_hourly_battery_unlocked()
-                self.battery_tracker.reset_daily_battery_unlocked()
-
-                max_hourly, max_daily = self.room_config_manager.get_room_limits(room_id)
-                room_hourly_used = self.battery_tracker.hourly_battery_count.get(room_id, 0)
-                room_daily_used = self.battery_tracker.daily_battery_count_by_room.get(room_id, 0)
-
-                if is_special_all:
-                    # 特殊逻辑：计算剩余可用额度，分发给三个账号
-                    remaining_hourly = max_hourly - room_hourly_used
-                    num_each = max(1, remaining_hourly // 3)  # 每个账号至少分配1个，否则平均分配
-                    total_need = num_each * 3  # 总共需要的电池数量
-
-                    if total_need <= 0:
-                        msg = f"房间 {room_id} 小时电池已用完 (已用:{room_hourly_used}, 上限:{max_hourly})"
-                        debug(msg)
-                        notifee.send_danmaku(room_id, f"喵喵，小时电池已用完喵")
-                        return jsonify({"status": "failed", "reason": msg}), 400
-
-                    if room_daily_used + total_need > max_daily:
-                        msg = f"房间 {room_id} 日电池超上限 (已用:{room_daily_used}, 计划:{total_need}, 上限:{max_daily})"
-                        debug(msg)
-                        notifee.send_danmaku(room_id, f"喵喵，天{room_daily_used + total_need}喵{max_daily}")
-                        return jsonify({"status": "failed", "reason": msg}), 400
-
-                    self.battery_tracker.hourly_battery_count[room_id] = room_hourly_used + total_need
-                    self.battery_tracker.daily_battery_count_by_room[room_id] = room_daily_used + total_need
-
-                    debug(f"[全境] 房间 {room_id} 更新用量：小时 {room_hourly_used+total_need}/{max_hourly}, 日 {room_daily_used+total_need}/{max_daily}, 每个账号分配 {num_each} 个")
-                else:
-                    if room_hourly_used + num > max_hourly:
-                        msg = f"房间 {room_id} 小时电池超上限 (已用:{room_hourly_used}, 计划:{num}, 上限:{max_hourly})"
-                        debug(msg)
-                        notifee.send_danmaku(room_id, f"喵喵，小时{room_hourly_used}喵{max_hourly}")
-                        return jsonify({"status": "failed", "reason": msg}), 400
-
-                    if room_daily_used + num > max_daily:
-                        msg = f"房间 {room_id} 日电池超上限 (已用:{room_daily_used}, 计划:{num}, 上限:{max_daily})"
-                        debug(msg)
-                        notifee.send_danmaku(room_id, f"喵喵，天{room_daily_used}喵{max_daily}")
-                        return jsonify({"status": "failed", "reason": msg}), 400
-
-                    self.battery_tracker.hourly_battery_count[room_id] = room_hourly_used + num
-                    self.battery_tracker.daily_battery_count_by_room[room_id] = room_daily_used + num
-
-                    debug(f"房间 {room_id} 更新用量：小时 {room_hourly_used+num}/{max_hourly}, 日 {room_daily_used+num}/{max_daily}")
+            max_hourly, max_daily = self.room_config_manager.get_room_limits(room_id)
+
+            if is_special_all:
+                # 特殊逻辑：计算剩余可用额度，分发给三个账号
+                room_hourly_used, room_daily_used = self.battery_tracker.get_usage(room_id)
+                remaining_hourly = max_hourly - room_hourly_used
+                num_each = max(1, remaining_hourly // 3)  # 每个账号至少分配1个，否则平均分配
+                total_need = num_each * 3  # 总共需要的电池数量
+
+                # 检查与扣减是原子的，并发请求（包括其他 worker）不会超出额度
+                quota = self.battery_tracker.try_consume(room_id, total_need, max_hourly, max_daily)
+                room_hourly_used, room_daily_used = quota.hourly_used, quota.daily_used
+                if quota.exceeded == "hourly":
+                    return self._reject_over_quota(room_id, quota, total_need, max_hourly, max_daily, "喵喵，小时电池已用完喵")
+                if quota.exceeded == "daily":
+                    return self._reject_over_quota(
+                        room_id, quota, total_need, max_hourly, max_daily,
+                        f"喵喵，天{room_daily_used + total_need}喵{max_daily}"
+                    )
+
+                debug(f"[全境] 房间 {room_id} 更新用量：小时 {room_hourly_used}/{max_hourly}, 日 {room_daily_used}/{max_daily}, 每个账号分配 {num_each} 个")
+            else:
+                quota = self.battery_tracker.try_consume(room_id, num, max_hourly, max_daily)
+                room_hourly_used, room_daily_used = quota.hourly_used, quota.daily_used
+                if quota.exceeded == "hourly":
+                    return self._reject_over_quota(
+                        room_id, quota, num, max_hourly, max_daily, f"喵喵，小时{room_hourly_used}喵{max_hourly}"
+                    )
+                if quota.exceeded == "daily":
+                    return self._reject_over_quota(
+                        room_id, quota, num, max_hourly, max_daily, f"喵喵，天{room_daily_used}喵{max_daily}"
+                    )
+
+                debug(f"房间 {room_id} 更新用量：小时 {room_hourly_used}/{max_hourly}, 日 {room_daily_used}/{max_daily}")
             
-            # ---------- 发送礼物 ----------
+            # ---------- 发送礼物（入队，后台执行） ----------
             if is_special_all:
                 # 获取当前可用电池，平均分配给三个账号
                 accounts = ["titan", "striker", "ghost"]
-                for acc in accounts:
-                    self.gift_sender.send_gift(room_id, num_each, acc, gift_id)
-                return jsonify({"status": "success", "message": f"Gift sent successfully (全境), 每账号 {num_each} 个"}), 200
+                job_ids = [self._enqueue_gift(room_id, num_each, acc, gift_id) for acc in accounts]
+                return jsonify({"status": "success", "message": f"Gift queued successfully (全境), 每账号 {num_each} 个", "job_ids": job_ids}), 200
             else:
-                self.gift_sender.send_gift(room_id, num, account, gift_id)
-                return jsonify({"status": "success", "message": "Gift sent successfully"}), 200
+                job_id = self._enqueue_gift(room_id, num, account, gift_id)
+                return jsonify({"status": "success", "message": "Gift queued successfully", "job_id": job_id}), 200
 
+        except ActionQueueFull as e:
+            error(f"处理ticket请求失败: {e}")
+            return jsonify({"error": "Action queue is full", "details": str(e)}), 503
         except Exception as e:
             error(f"处理ticket请求失败: {e}")
             traceback.print_exc()
             return jsonify({"error": "Server error", "details": str(e)}), 500
 
+    def _reject_over_quota(self, room_id, quota, amount, max_hourly, max_daily, danmaku):
+        """
+        电池额度不足：发送提示弹幕（附带最早可以再次使用的时间）并返回 400 响应
+        :param quota: BatteryTracker.try_consume 的结果
+        """
+        if quota.exceeded == "hourly":
+            msg = f"房间 {room_id} 小时电池超上限 (已用:{quota.hourly_used}, 计划:{amount}, 上限:{max_hourly})"
+        else:
+            msg = f"房间 {room_id} 日电池超上限 (已用:{quota.daily_used}, 计划:{amount}, 上限:{max_daily})"
+        wait = format_retry_after(quota.retry_after)
+        if wait:
+            msg += f"，{wait}后可再次使用"
+            danmaku += f"，{wait}后再来喵"
+        debug(msg)
+        self._enqueue_danmaku(room_id, danmaku)
+        retry_after = int(math.ceil(quota.retry_after)) if quota.retry_after is not None else None
+        return jsonify({"status": "failed", "reason": msg, "retry_after": retry_after}), 400
+
     def handle_pk_wanzun(self):
         gift_id = "33988"  # 固定礼物ID
         data = request.json
@@ -357,7 +732,6 @@ class DanmakuGiftApp:
             return jsonify({"status": "error", "message": "Invalid data"}), 400
 
         room_id = str(data['room_id'])
-        notifee = DanmakuSender()
         account = "ghost"
         
         # 检查房间是否开启了加强模式
@@ -365,44 +739,30 @@ class DanmakuGiftApp:
         # 根据房间状态决定礼物数量
         num = 10 if youxiao else 1
 
-        with self.battery_tracker.lock:
-            self.battery_tracker.reset_hourly_battery_unlocked()
-            self.battery_tracker.reset_daily_battery_unlocked()
-
-            max_hourly, max_daily = self.room_config_manager.get_room_limits(room_id)
-            room_hourly_used = self.battery_tracker.hourly_battery_count.get(room_id, 0)
-            room_daily_used = self.battery_tracker.daily_battery_count_by_room.get(room_id, 0)
-
-            if room_hourly_used + num > max_hourly:
-                msg = f"房间 {room_id} 小时电池超上限 (已用:{room_hourly_used}, 计划:{num}, 上限:{max_hourly})"
-                debug(msg)
-                notifee.send_danmaku(room_id, f"喵喵，小时{room_hourly_used}喵{max_hourly}")
-                return jsonify({"status": "failed", "reason": msg}), 400
-
-            if room_daily_used + num > max_daily:
-                msg = f"房间 {room_id} 日电池超上限 (已用:{room_daily_used}, 计划:{num}, 上限:{max_daily})"
-                debug(msg)
-                notifee.send_danmaku(room_id, f"喵喵，天{room_daily_used}喵{max_daily}")
-                return jsonify({"status": "failed", "reason": msg}), 400
-
-            self.battery_tracker.hourly_battery_count[room_id] = room_hourly_used + num
-            self.battery_tracker.daily_battery_count_by_room[room_id] = room_daily_used + num
+        max_hourly, max_daily = self.room_config_manager.get_room_limits(room_id)
+        quota = self.battery_tracker.try_consume(room_id, num, max_hourly, max_daily)
+        room_hourly_used, room_daily_used = quota.hourly_used, quota.daily_used
+        if quota.exceeded == "hourly":
+            return self._reject_over_quota(
+                room_id, quota, num, max_hourly, max_daily, f"喵喵，小时{room_hourly_used}喵{max_hourly}"
+            )
+        if quota.exceeded == "daily":
+            return self._reject_over_quota(
+                room_id, quota, num, max_hourly, max_daily, f"喵喵，天{room_daily_used}喵{max_daily}"
+            )
 
-            debug(f"房间 {room_id} 更新用量：小时 {room_hourly_used+num}/{max_hourly}, 日 {room_daily_used+num}/{max_daily}, 加强模式: {youxiao}")
+        debug(f"房间 {room_id} 更新用量：小时 {room_hourly_used}/{max_hourly}, 日 {room_daily_used}/{max_daily}, 加强模式: {youxiao}")
 
         try:
-            self.gift_sender.send_gift(room_id, num, account, gift_id)
-            return jsonify({"status": "success", "message": "Gift sent successfully"}), 200
-        except TimeoutError:
-            error("Failed to send gift (timeout)")
-            return jsonify({"error": "Failed to send gift (timeout)"}), 500
-        except RuntimeError as e:
-            error(f"Failed to send gift: {str(e)}")
-            return jsonify({"error": f"Failed to send gift: {str(e)}"}), 500
+            job_id = self._enqueue_gift(room_id, num, account, gift_id)
+            return jsonify({"status": "success", "message": "Gift queued successfully", "job_id": job_id}), 200
+        except ActionQueueFull as e:
+            error(f"Failed to queue gift: {str(e)}")
+            return jsonify({"error": f"Failed to queue gift: {str(e)}"}), 503
         except Exception as e:
-            error(f"Unknown error in subprocess: {e}")
+            error(f"Unknown error while queueing gift: {e}")
             traceback.print_exc()
-            return jsonify({"error": "Unknown error in subprocess", "details": str(e)}), 500
+            return jsonify({"error": "Unknown error while queueing gift", "details": str(e)}), 500
 
     def start_live_room_spider(self):
         """
@@ -541,14 +901,13 @@ class DanmakuGiftApp:
                 
             room_id = str(data['room_id'])
             danmaku = data['danmaku']
-            notifee = DanmakuSender()
             
             # 检查是否包含有效的记仇机器人指令 或 欢迎模式指令
             if "记仇机器人有效299792" in danmaku:
                 # 设置房间状态为启用
                 self.room_config_manager.set_room_youxiao(room_id, True)
                 info(f"房间 {room_id} 已启用加强模式")
-                notifee.send_danmaku(room_id, "喵喵，加强模式已开启喵~")
+                self._enqueue_danmaku(room_id, "喵喵，加强模式已开启喵~")
                 return jsonify({
                     "status": "success", 
                     "message": "Room enabled successfully",
@@ -559,7 +918,7 @@ class DanmakuGiftApp:
                 # 设置房间状态为禁用
                 self.room_config_manager.set_room_youxiao(room_id, False)
                 info(f"房间 {room_id} 已禁用加强模式")
-                notifee.send_danmaku(room_id, "喵喵，加强模式已关闭喵~")
+                self._enqueue_danmaku(room_id, "喵喵，加强模式已关闭喵~")
                 return jsonify({
                     "status": "success", 
                     "message": "Room disabled successfully",
@@ -568,7 +927,7 @@ class DanmakuGiftApp:
             elif "启动欢迎模式" in danmaku or "开启欢迎模式" in danmaku:
                 self.room_config_manager.set_room_welcome_enabled(room_id, True)
                 info(f"房间 {room_id} 已开启欢迎模式")
-                notifee.send_danmaku(room_id, "呼噜~欢迎模式已开启喵！")
+                self._enqueue_danmaku(room_id, "呼噜~欢迎模式已开启喵！")
                 return jsonify({
                     "status": "success",
                     "message": "Welcome mode enabled",
@@ -577,7 +936,7 @@ class DanmakuGiftApp:
             elif "停止欢迎模式" in danmaku or "关闭欢迎模式" in danmaku:
                 self.room_config_manager.set_room_welcome_enabled(room_id, False)
                 info(f"房间 {room_id} 已关闭欢迎模式")
-                notifee.send_danmaku(room_id, "咪~欢迎模式已关闭喵！")
+                self._enqueue_danmaku(room_id, "咪~欢迎模式已关闭喵！")
                 return jsonify({
                     "status": "success",
                     "message": "Welcome mode disabled",
@@ -616,7 +975,6 @@ class DanmakuGiftApp:
                 "medal": data.get("medal") or {},
                 "meta": data.get("meta") or {},
             }
-            notifee = DanmakuSender()
             
             try:
                 # 使用GPT Responses API生成回复，按房间使用previous_response_id续写
@@ -624,37 +982,37 @@ class DanmakuGiftApp:
                 
                 # 检查是否是冷却回复
                 if response == "喵喵喵喵喵！！！":
-                    # 判断是处于冷却中还是刚触发冷却
-                    if time.time() < self.chatbot_handler.cooldown_until:
-                        # 冷却中
-                        remaining_time = int(self.chatbot_handler.cooldown_until - time.time())
+                    # 房间冷却中，或用户 / 全局额度、进行中请求数不足（只影响本次请求）
+                    remaining_time = int(self.chatbot_handler.rate_limiter.cooldown_remaining(room_id))
+                    if remaining_time > 0:
                         info(f"房间 {room_id} API调用被限制：冷却中，剩余 {remaining_time} 秒")
                     else:
-                        # 刚触发冷却
-                        info(f"房间 {room_id} 触发API调用冷却: 3秒内超过1次请求，冷却30秒")
+                        info(f"房间 {room_id} API调用被限制：用户或全局额度不足")
                 else:
                     debug(f"ChatGPT生成回复: {response}")
                 
-                # 发送弹幕
-                notifee.send_danmaku(room_id, response)
+                # 发送弹幕（入队，后台执行）
+                job_id = self._enqueue_danmaku(room_id, response)
                 
                 return jsonify({
                     "status": "success", 
-                    "message": "弹幕已发送",
+                    "message": "弹幕已加入发送队列",
                     "response": response,
                     "rate_limited": response == "喵喵喵喵喵！！！",
-                    "response_id": self.chatbot_handler.room_last_response_id.get(str(room_id))
+                    "response_id": self.chatbot_handler.room_last_response_id.get(str(room_id)),
+                    "job_id": job_id
                 }), 200
                 
             except Exception as e:
                 error(f"生成或发送回复失败: {str(e)}")
                 # 发送一个默认回复
-                notifee.send_danmaku(room_id, "喵喵喵～")
+                job_id = self._enqueue_danmaku(room_id, "喵喵喵～")
                 
                 return jsonify({
                     "status": "partial_success",
                     "message": f"生成回复失败，已发送默认回复: {str(e)}",
-                    "response": "喵喵喵～"
+                    "response": "喵喵喵～",
+                    "job_id": job_id
                 }), 200
                 
         except Exception as e:
@@ -682,16 +1040,12 @@ class DanmakuGiftApp:
             accounts = data.get('accounts', 'all')  # 可选参数，指定账号，默认全部账号
             max_workers = data.get('max_workers', 5)  # 可选参数，最大并行线程数，默认5
             
-            # 创建一个线程来执行点赞和发送弹幕的操作
-            like_thread = threading.Thread(
-                target=self._execute_like_task,
-                args=(room_id, message, like_times, accounts, max_workers),
-                daemon=True
+            # 点赞任务耗时很长，使用独立线程执行（不占用房间队列），同样可通过 job_id 查询状态
+            job_id = self.action_queue.run_detached(
+                room_id, "like", self._execute_like_task,
+                room_id, message, like_times, accounts, max_workers
             )
             
-            # 启动线程
-            like_thread.start()
-            
             # 立即返回成功响应，不等待点赞操作完成
             return jsonify({
                 "status": "success", 
@@ -699,7 +1053,8 @@ class DanmakuGiftApp:
                 "room_id": room_id,
                 "like_times": like_times,
                 "accounts": accounts,
-                "max_workers": max_workers
+                "max_workers": max_workers,
+                "job_id": job_id
             }), 200
                 
         except Exception as e:
@@ -709,7 +1064,7 @@ class DanmakuGiftApp:
             
     def _execute_like_task(self, room_id, message, like_times, accounts, max_workers=5):
         """
-        在后台线程中执行点赞任务
+        在后台线程中执行点赞任务，返回点赞是否成功
         """
         notifee = DanmakuSender()
         like_sender = LikeSender()
@@ -731,6 +1086,7 @@ class DanmakuGiftApp:
                 notifee.send_danmaku(room_id, "咪，点赞任务已完成，蹭蹭观测站的大伙们喵～！")
             except Exception as e:
                 error(f"发送完成弹幕失败: {str(e)}")
+            return True
             
         except TimeoutError:
             error(f"发送点赞超时 (room_id: {room_id})")
@@ -753,6 +1109,21 @@ class DanmakuGiftApp:
                 notifee.send_danmaku(room_id, "喵喵，点赞发生错误喵...")
             except:
                 pass
+        return False
+
+    def _compose_welcome(self, room_id, entries):
+        """
+        生成一批进场的欢迎语：只有一位用户时结合头像描述单独欢迎，多位用户时一次调用生成合并欢迎语
+        """
+        if len(entries) == 1:
+            entry = entries[0]
+            avatar_desc = self.chatbot_handler.describe_avatar(entry["face"]) if entry.get("face") else ""
+            return self.chatbot_handler.generate_welcome_message(
+                uname=entry["uname"],
+                is_captain=entry["is_captain"],
+                avatar_desc=avatar_desc
+            )
+        return self.chatbot_handler.generate_batch_welcome(entries)
 
     def handle_entry_welcome(self):
         """
@@ -760,6 +1131,7 @@ class DanmakuGiftApp:
         - 使用 OpenAI 视觉模型描述头像
         - 根据昵称与是否舰长生成欢迎语
         - 通过弹幕发送器发送
+        启用合并时（WELCOME_BATCH_WINDOW > 0）进场先进入房间缓冲区，窗口期结束后合并为一条欢迎弹幕，接口返回 202
         """
         try:
             debug(f"收到entry_welcome请求: {request.json}")
@@ -792,6 +1164,15 @@ class DanmakuGiftApp:
                     "welcome_enabled": False
                 }), 200
 
+            if self.welcome_batcher is not None:
+                batch_size = self.welcome_batcher.submit(room_id, uname, is_captain_flag, face)
+                return jsonify({
+                    "status": "queued",
+                    "message": "已加入欢迎合并队列",
+                    "is_captain": is_captain_flag,
+                    "batch_size": batch_size
+                }), 202
+
             # 头像描述
             avatar_desc = self.chatbot_handler.describe_avatar(face) if face else ""
 
@@ -802,15 +1183,16 @@ class DanmakuGiftApp:
                 avatar_desc=avatar_desc
             )
 
-            # 发送弹幕
-            DanmakuSender().send_danmaku(room_id, welcome_text)
+            # 发送弹幕（入队，后台执行）
+            job_id = self._enqueue_danmaku(room_id, welcome_text)
 
             return jsonify({
                 "status": "success",
-                "message": "弹幕已发送",
+                "message": "弹幕已加入发送队列",
                 "welcome": welcome_text,
                 "avatar_desc": avatar_desc,
-                "is_captain": is_captain_flag
+                "is_captain": is_captain_flag,
+                "job_id": job_id
             }), 200
 
         except Exception as e:
@@ -823,7 +1205,7 @@ class DanmakuGiftApp:
                 uname = str(payload.get('uname') or "小伙伴")
                 fallback_text = f"欢迎{uname}喵～"
                 if room_id:
-                    DanmakuSender().send_danmaku(room_id, fallback_text)
+                    self._enqueue_danmaku(room_id, fallback_text)
                 return jsonify({
                     "status": "partial_success",
                     "message": "发生异常，已发送默认欢迎",
@@ -834,15 +1216,36 @@ class DanmakuGiftApp:
     def run(self, host='0.0.0.0', port=8081, debug=True):
         self.app.run(host=host, port=port, debug=debug)
 
+    def asgi_app(self, threads=None):
+        """
+        把 Flask 应用包装为 ASGI 应用（a2wsgi），请求在大小为 threads 的线程池中执行，
+        默认取环境变量 ASGI_THREADS
+        """
+        from a2wsgi import WSGIMiddleware
+        threads = int(threads or os.environ.get("ASGI_THREADS", 128))
+        info(f"ASGI 模式: 请求线程池大小={threads}")
+        return WSGIMiddleware(self.app, workers=threads)
+
+    def run_asgi(self, host='0.0.0.0', port=8081, threads=None):
+        """用 uvicorn 运行（单进程即可并发处理大量慢请求）"""
+        import uvicorn
+        uvicorn.run(self.asgi_app(threads), host=host, port=port)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Tofu Mission Control')
     parser.add_argument('--no-dep', action='store_true', help='禁用外部依赖（例如数据库），跳过初始化并不进行持久化记录')
+    parser.add_argument('--asgi', action='store_true', help='使用 uvicorn（ASGI）运行，而不是 Flask 开发服务器')
+    parser.add_argument('--host', default='0.0.0.0', help='监听地址')
+    parser.add_argument('--port', type=int, default=8081, help='监听端口')
     args = parser.parse_args()
 
     app_instance = DanmakuGiftApp(no_dep=args.no_dep)
-    app_instance.run()
+    if args.asgi:
+        app_instance.run_asgi(host=args.host, port=args.port)
+    else:
+        app_instance.run(host=args.host, port=args.port)
 else:
-    # 当被 gunicorn 等 WSGI 服务器导入时，提供全局的 app 对象
+    # 当被 gunicorn 等 WSGI 服务器（或 asgi.py）导入时，提供全局的 app 对象
     app_instance = DanmakuGiftApp()
     app = app_instance.app
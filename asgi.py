@@ -0,0 +1,13 @@
+"""
+ASGI 入口
+    uvicorn asgi:app --host 0.0.0.0 --port 8081
+
+Flask 应用通过 a2wsgi 挂在 uvicorn 上，路由与请求 / 响应格式与 WSGI 部署完全相同：
+- 事件循环负责接收连接与收发数据，每个请求交给受管理的线程池执行
+- 慢的 OpenAI / B 站 / 数据库调用只占用线程池中的一个线程，不会阻塞其他请求，
+  单个进程即可同时处理数百个 webhook
+- /api/gift/stream 的长连接同样各占用一个线程，线程池大小（ASGI_THREADS）需覆盖推送连接数
+"""
+from app import app_instance
+
+app = app_instance.asgi_app()
@@ -6,49 +6,86 @@ import requests
 import time
 import json
 import os
+import sys
 import threading
 import concurrent.futures
 
-def get_anchor_uid(room_id, headers, cookies):
-    """获取直播间的主播 UID"""
+# 将项目根目录加入 sys.path，便于复用共享的 UID 缓存
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from modules.uid_cache import get_uid_cache
+
+def parse_cookies(cookie_str):
+    """将 cookie 字符串解析为 dict"""
+    cookies = {}
+    for c in cookie_str.strip().split(';'):
+        c = c.strip()
+        if '=' in c:
+            key, value = c.split('=', 1)
+            cookies[key.strip()] = value.strip()
+    return cookies
+
+def fetch_anchor_uid(room_id, headers, cookies):
+    """请求接口获取直播间的主播 UID；接口返回失败时返回 None，HTTP 请求失败时抛出异常"""
     url = "https://api.live.bilibili.com/room/v1/Room/get_info"
     response = requests.get(url, headers=headers, cookies=cookies, params={"room_id": room_id})
 
-    if response.status_code == 200:
-        data = response.json()
-        if data["code"] == 0 and "data" in data and "uid" in data["data"]:
-            ruid = data["data"]["uid"]
-            print(f"[INFO] 直播间 {room_id} 主播 UID: {ruid}")
-            return ruid
-        else:
-            print(f"[ERROR] API 响应异常: {data}")
-    else:
-        print(f"[ERROR] 获取主播 UID 失败，HTTP 状态码: {response.status_code}")
+    if response.status_code != 200:
+        raise RuntimeError(f"获取主播 UID 失败，HTTP 状态码: {response.status_code}")
 
+    data = response.json()
+    if data["code"] == 0 and "data" in data and "uid" in data["data"]:
+        return data["data"]["uid"]
+
+    print(f"[ERROR] API 响应异常: {data}")
     return None
 
-def get_self_uid(headers, cookies):
-    """获取自己的 UID"""
+def get_anchor_uid(room_id, headers, cookies):
+    """获取直播间的主播 UID（优先读取共享的 UID 缓存）"""
+    try:
+        ruid = get_uid_cache().get_anchor_uid(room_id, lambda: fetch_anchor_uid(room_id, headers, cookies))
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        return None
+
+    if ruid:
+        print(f"[INFO] 直播间 {room_id} 主播 UID: {ruid}")
+    return ruid
+
+def fetch_self_uid(headers, cookies):
+    """请求接口获取自己的 UID；接口返回失败时返回 None，HTTP 请求失败时抛出异常"""
     url = "https://api.bilibili.com/x/web-interface/nav"
     response = requests.get(url, headers=headers, cookies=cookies)
 
-    if response.status_code == 200:
-        data = response.json()
-        if data["code"] == 0 and "data" in data and "mid" in data["data"]:
-            uid = data["data"]["mid"]
-            print(f"[INFO] 当前用户 UID: {uid}")
-            return uid
-        else:
-            print(f"[ERROR] API 响应异常: {data}")
-    else:
-        print(f"[ERROR] 获取用户 UID 失败，HTTP 状态码: {response.status_code}")
+    if response.status_code != 200:
+        raise RuntimeError(f"获取用户 UID 失败，HTTP 状态码: {response.status_code}")
+
+    data = response.json()
+    if data["code"] == 0 and "data" in data and "mid" in data["data"]:
+        return data["data"]["mid"]
 
+    print(f"[ERROR] API 响应异常: {data}")
     return None
 
-def perform_like_for_account(account, cookies, headers, room_id, like_times):
+def get_self_uid(headers, cookies):
+    """获取自己的 UID（优先读取共享的 UID 缓存）"""
+    try:
+        uid = get_uid_cache().get_self_uid(cookies, lambda: fetch_self_uid(headers, cookies))
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        return None
+
+    if uid:
+        print(f"[INFO] 当前用户 UID: {uid}")
+    return uid
+
+def perform_like_for_account(account, cookies, headers, room_id, like_times, anchor_uid=None):
     """为单个账号执行点赞任务"""
-    # 获取主播 UID 和自己的 UID
-    anchor_uid = get_anchor_uid(room_id, headers, cookies)
+    # 获取主播 UID（同一任务内所有账号共用）和自己的 UID
+    if not anchor_uid:
+        anchor_uid = get_anchor_uid(room_id, headers, cookies)
     self_uid = get_self_uid(headers, cookies)
     
     if not anchor_uid or not self_uid:
@@ -165,18 +202,17 @@ def main():
     max_workers = min(args.max_workers, len(valid_accounts))  # 限制最大线程数
     print(f"[INFO] 使用 {max_workers} 个线程同时执行点赞任务")
     
+    # 主播 UID 与账号无关，只查询一次（命中缓存时不发请求）
+    anchor_uid = get_anchor_uid(args.room_id, {
+        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
+                      'AppleWebKit/537.36 (KHTML, like Gecko) '
+                      'Chrome/133.0.0.0 Safari/537.36'
+    }, parse_cookies(all_cookies_data[valid_accounts[0]]['cookie']))
+
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         for account in valid_accounts:
-            # 获取当前账号的 cookie 字符串
-            cookie_str = all_cookies_data[account]['cookie'].strip()
-
-            # 将 cookie 字符串解析为 dict
-            cookies = {}
-            for c in cookie_str.split(';'):
-                c = c.strip()
-                if '=' in c:
-                    key, value = c.split('=', 1)
-                    cookies[key.strip()] = value.strip()
+            # 将当前账号的 cookie 字符串解析为 dict
+            cookies = parse_cookies(all_cookies_data[account]['cookie'])
 
             # 构造请求头
             headers = {
@@ -203,7 +239,8 @@ def main():
                 cookies,
                 headers,
                 args.room_id,
-                args.like_times
+                args.like_times,
+                anchor_uid
             )
             futures.append((account, future))
     
@@ -216,5 +253,8 @@ def main():
     
     print(f"[INFO] 所有点赞任务完成，共有 {success_count}/{len(valid_accounts)} 个账号成功发送点赞")
 
+    # 进程即将退出，把新查询到的 UID 写入磁盘供下次复用
+    get_uid_cache().flush()
+
 if __name__ == '__main__':
     main() 
\ No newline at end of file
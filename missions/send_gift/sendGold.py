@@ -2,6 +2,14 @@ import requests
 import argparse
 import json
 import os
+import sys
+
+# 将项目根目录加入 sys.path，便于复用共享的 UID 缓存
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from modules.uid_cache import get_uid_cache
 
 API_URL = "https://api.live.bilibili.com/xlive/revenue/v1/gift/sendGold"
 
@@ -24,25 +32,35 @@ with open(price_list_file, "r") as f:
     price_list = json.load(f)
 
 
-def get_anchor_uid(room_id, headers):
-    """获取直播间的主播 UID"""
+def fetch_anchor_uid(room_id, headers):
+    """请求接口获取直播间的主播 UID；接口返回失败时返回 None，HTTP 请求失败时抛出异常"""
     url = "https://api.live.bilibili.com/room/v1/Room/get_info"
     response = requests.get(url, headers=headers, params={"room_id": room_id})
 
-    if response.status_code == 200:
-        data = response.json()
-        if data["code"] == 0 and "data" in data and "uid" in data["data"]:
-            ruid = data["data"]["uid"]
-            print(f"✅ 直播间 {room_id} 主播 UID: {ruid}")
-            return ruid
-        else:
-            print(f"❌ API 响应异常: {data}")
-    else:
-        print(f"❌ 获取主播 UID 失败，HTTP 状态码: {response.status_code}")
+    if response.status_code != 200:
+        raise RuntimeError(f"获取主播 UID 失败，HTTP 状态码: {response.status_code}")
+
+    data = response.json()
+    if data["code"] == 0 and "data" in data and "uid" in data["data"]:
+        return data["data"]["uid"]
 
+    print(f"❌ API 响应异常: {data}")
     return None
 
 
+def get_anchor_uid(room_id, headers):
+    """获取直播间的主播 UID（优先读取共享的 UID 缓存）"""
+    try:
+        ruid = get_uid_cache().get_anchor_uid(room_id, lambda: fetch_anchor_uid(room_id, headers))
+    except Exception as e:
+        print(f"❌ {e}")
+        return None
+
+    if ruid:
+        print(f"✅ 直播间 {room_id} 主播 UID: {ruid}")
+    return ruid
+
+
 def send_gift(room_id, num, account, gift_id):
     """发送礼物"""
     if account not in account_cookies:
@@ -0,0 +1,296 @@
+"""
+出站动作队列
+把送礼、弹幕、点赞等对 B 站的调用从 HTTP 请求线程中剥离出来，由后台工作线程执行。
+- 同一房间的动作固定分配到同一个工作线程，保证按提交顺序执行
+- 失败按指数退避重试：等待期间不占用工作线程，同一房间之后的动作暂存在该房间的等待队列中，
+  重试成功或放弃后再依次执行，不会越过正在重试的动作
+- 动作返回 False 视为失败（发送弹幕等接口用返回值表示失败）
+- 每个动作都有 job_id，可通过 get_job 查询状态
+"""
+import itertools
+import queue
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+
+from modules.logger import debug, info, warning, error
+
+# 任务状态
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_RETRYING = "retrying"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+
+FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED)
+
+
+class ActionQueueFull(RuntimeError):
+    """队列已满，动作未被接收"""
+
+
+class ActionQueue:
+    """
+    有界的进程内动作队列，按房间哈希分片到固定数量的工作线程。
+    """
+    def __init__(self, num_workers=4, max_pending=1000, max_attempts=3,
+                 base_backoff=1.0, max_backoff=30.0, max_jobs_kept=5000):
+        """
+        :param num_workers: 工作线程数量（同时也是房间分片数）
+        :param max_pending: 所有分片合计的最大排队数量
+        :param max_attempts: 默认最大尝试次数（含第一次）
+        :param base_backoff: 第一次重试前的等待时间（秒），之后每次翻倍
+        :param max_backoff: 单次重试等待的上限（秒）
+        :param max_jobs_kept: 保留的任务状态记录数量上限，超出时淘汰最早结束的任务
+        """
+        self.num_workers = max(1, int(num_workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_jobs_kept = max_jobs_kept
+
+        shard_size = max(1, int(max_pending) // self.num_workers)
+        self.shards = [queue.Queue(maxsize=shard_size) for _ in range(self.num_workers)]
+
+        # job_id -> 任务状态字典
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.sequence = itertools.count(1)
+
+        # room_id -> 该房间暂停执行的动作（队首为正在等待重试的动作）；键存在表示房间处于退避中
+        self.parked = {}
+        self.parked_lock = threading.Lock()
+
+        self.stopping = False
+        self.workers = []
+        for index, shard in enumerate(self.shards):
+            worker = threading.Thread(
+                target=self._worker_loop,
+                args=(shard,),
+                name=f"action-queue-{index}",
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+        info(f"出站动作队列已启动: workers={self.num_workers}, 每分片容量={shard_size}")
+
+    def _shard_for(self, room_id):
+        """同一房间始终落到同一分片"""
+        return self.shards[zlib.crc32(str(room_id).encode("utf-8")) % self.num_workers]
+
+    def _new_job(self, room_id, kind, max_attempts):
+        job_id = f"{int(time.time())}-{next(self.sequence)}-{uuid.uuid4().hex[:8]}"
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "room_id": str(room_id),
+            "kind": kind,
+            "status": STATUS_QUEUED,
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "error": None,
+            "result": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        with self.jobs_lock:
+            self.jobs[job_id] = job
+            self._evict_finished_unlocked()
+        return job
+
+    def _evict_finished_unlocked(self):
+        """超出上限时淘汰最早的已结束任务（不加锁版本，调用者需要先获取锁）"""
+        if len(self.jobs) <= self.max_jobs_kept:
+            return
+        for job_id in list(self.jobs.keys()):
+            if len(self.jobs) <= self.max_jobs_kept:
+                break
+            if self.jobs[job_id]["status"] in FINISHED_STATUSES:
+                del self.jobs[job_id]
+
+    def _update_job(self, job, **fields):
+        with self.jobs_lock:
+            job.update(fields)
+            job["updated_at"] = time.time()
+
+    def submit(self, room_id, kind, func, *args, max_attempts=None, retry_on=(Exception,), **kwargs):
+        """
+        提交一个动作，立即返回 job_id。
+
+        :param room_id: 房间ID，决定动作所在的分片（即执行顺序）
+        :param kind: 动作类型，例如 "gift"、"danmaku"
+        :param func: 实际执行的可调用对象
+        :param max_attempts: 最大尝试次数，默认使用队列配置
+        :param retry_on: 触发重试的异常类型，其他异常直接判定失败
+        :raises ActionQueueFull: 分片已满
+        """
+        attempts = max(1, int(max_attempts or self.max_attempts))
+        job = self._new_job(room_id, kind, attempts)
+        try:
+            self._shard_for(room_id).put_nowait((job, func, args, kwargs, retry_on))
+        except queue.Full:
+            self._update_job(job, status=STATUS_FAILED, error="action queue is full")
+            raise ActionQueueFull(f"动作队列已满，房间 {room_id} 的 {kind} 动作未被接收")
+        debug(f"动作已入队: job_id={job['job_id']}, room_id={room_id}, kind={kind}")
+        return job["job_id"]
+
+    def run_detached(self, room_id, kind, func, *args, max_attempts=1, retry_on=(Exception,), **kwargs):
+        """
+        在独立线程中执行耗时很长的动作（例如点赞任务），避免占用房间分片，
+        但同样记录 job 状态以便查询。
+        """
+        job = self._new_job(room_id, kind, max(1, int(max_attempts)))
+        thread = threading.Thread(
+            target=self._run_job,
+            args=(job, func, args, kwargs, retry_on),
+            name=f"action-detached-{job['job_id']}",
+            daemon=True
+        )
+        thread.start()
+        return job["job_id"]
+
+    def get_job(self, job_id):
+        """查询任务状态，不存在时返回 None"""
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def pending_count(self):
+        with self.parked_lock:
+            parked = sum(len(items) for items in self.parked.values())
+        return sum(shard.qsize() for shard in self.shards) + parked
+
+    def _worker_loop(self, shard):
+        while True:
+            item = shard.get()
+            try:
+                if item is None:
+                    return
+                if isinstance(item, str):
+                    # 重试到期：按顺序执行该房间暂停的动作
+                    self._run_parked(shard, item)
+                    continue
+                room_id = item[0]["room_id"]
+                with self.parked_lock:
+                    if room_id in self.parked:
+                        # 同一房间有动作在等待重试，排在它后面
+                        self.parked[room_id].append(item)
+                        continue
+                backoff = self._attempt(*item)
+                if backoff is not None:
+                    with self.parked_lock:
+                        self.parked[room_id] = deque([item])
+                    self._retry_later(shard, room_id, backoff)
+            finally:
+                shard.task_done()
+
+    def _run_parked(self, shard, room_id):
+        """依次执行房间暂停的动作，再次需要重试时停在该动作上"""
+        while True:
+            with self.parked_lock:
+                items = self.parked.get(room_id)
+                if not items:
+                    self.parked.pop(room_id, None)
+                    return
+                item = items[0]
+            backoff = self._attempt(*item)
+            if backoff is not None:
+                self._retry_later(shard, room_id, backoff)
+                return
+            with self.parked_lock:
+                if self.parked.get(room_id) is not items:
+                    return
+                items.popleft()
+
+    def _retry_later(self, shard, room_id, backoff):
+        """
+        等待 backoff 秒后通知工作线程继续执行该房间暂停的动作，
+        等待期间工作线程继续执行其他房间的动作
+        """
+        def resume():
+            # 通知只有房间ID，分片写满时等待空位而不是丢弃重试
+            while not self.stopping:
+                try:
+                    shard.put(room_id, timeout=1.0)
+                    return
+                except queue.Full:
+                    continue
+            self._fail_parked(room_id)
+
+        timer = threading.Timer(backoff, resume)
+        timer.daemon = True
+        timer.start()
+
+    def _fail_parked(self, room_id):
+        """队列关闭时放弃房间暂停的动作"""
+        with self.parked_lock:
+            items = self.parked.pop(room_id, ())
+        for index, (job, *_) in enumerate(items):
+            reason = f"action queue stopped before retry: {job['error']}" if index == 0 else "action queue stopped"
+            self._update_job(job, status=STATUS_FAILED, error=reason)
+        if items:
+            warning(f"动作队列已关闭，房间 {room_id} 有 {len(items)} 个动作未执行")
+
+    def _run_job(self, job, func, args, kwargs, retry_on):
+        """在当前线程内执行任务直到结束（独立线程使用，可以直接等待重试）"""
+        while True:
+            backoff = self._attempt(job, func, args, kwargs, retry_on)
+            if backoff is None:
+                return
+            time.sleep(backoff)
+
+    def _attempt(self, job, func, args, kwargs, retry_on):
+        """
+        执行一次任务
+        :return: 需要重试时返回等待的秒数，任务已结束（成功或失败）时返回 None
+        """
+        max_attempts = job["max_attempts"]
+        attempt = job["attempts"] + 1
+        self._update_job(job, status=STATUS_RUNNING, attempts=attempt)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            retryable = isinstance(e, retry_on)
+            if not retryable or attempt >= max_attempts or self.stopping:
+                self._update_job(job, status=STATUS_FAILED, error=str(e))
+                error(f"动作执行失败: job_id={job['job_id']}, room_id={job['room_id']}, kind={job['kind']}, attempts={attempt}, error={e}")
+                return None
+            backoff = min(self.max_backoff, self.base_backoff * (2 ** (attempt - 1)))
+            self._update_job(job, status=STATUS_RETRYING, error=str(e))
+            warning(f"动作执行失败，{backoff:.1f} 秒后重试: job_id={job['job_id']}, kind={job['kind']}, attempt={attempt}/{max_attempts}, error={e}")
+            return backoff
+
+        if result is False:
+            # 接口明确返回失败（原因已由动作自身记录），不重试
+            self._update_job(job, status=STATUS_FAILED, result=False, error="action returned False")
+            error(f"动作执行失败: job_id={job['job_id']}, room_id={job['room_id']}, kind={job['kind']}, attempts={attempt}, 返回 False")
+            return None
+        if not isinstance(result, (bool, int, float, str, type(None))):
+            result = None
+        self._update_job(job, status=STATUS_SUCCEEDED, result=result, error=None)
+        debug(f"动作执行成功: job_id={job['job_id']}, kind={job['kind']}, attempts={attempt}")
+        return None
+
+    def shutdown(self, timeout=10.0):
+        """
+        停止接收新的重试，并在超时时间内尽量执行完已排队的动作
+        """
+        self.stopping = True
+        deadline = time.time() + timeout
+        for shard in self.shards:
+            try:
+                shard.put(None, timeout=max(0.0, deadline - time.time()))
+            except queue.Full:
+                pass
+        for worker in self.workers:
+            worker.join(max(0.0, deadline - time.time()))
+        with self.parked_lock:
+            parked_rooms = list(self.parked)
+        for room_id in parked_rooms:
+            self._fail_parked(room_id)
+        remaining = self.pending_count()
+        if remaining:
+            warning(f"动作队列关闭时仍有 {remaining} 个动作未执行")
@@ -0,0 +1,192 @@
+"""
+头像描述缓存
+/entry_welcome 每次进场都要用视觉模型描述头像，而常客每天以同一个头像多次进入同一房间。
+- 键为规范化后的头像 URL：B 站头像路径（bfs/face/<摘要>.jpg）本身就是图片内容的摘要，
+  去掉 http/https、镜像域名（i0/i1/i2.hdslb.com）、缩放后缀（@100w_100h.webp）与查询参数后，同一张图只对应一个键
+- 进程内 LRU + 过期时间；可选持久化到 SQLite，重启以及多个 worker 都能复用
+- 同一 URL 的并发请求合并为一次视觉模型调用，其余请求等待其结果
+- 描述失败（空字符串）只缓存较短时间，之后重试
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+from modules.ttl_cache import TTLCache, MISSING
+from modules.logger import debug, info, warning
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SQLITE_PATH = os.path.join(ROOT_DIR, "data", "avatar_cache.sqlite3")
+
+_HDSLB_MIRROR = re.compile(r"^i\d\.hdslb\.com$")
+
+
+def normalize_face_url(url):
+    """
+    规范化头像 URL，无法解析时返回 None
+    例：http://i1.hdslb.com/bfs/face/abc.jpg@96w_96h.webp?x=1 -> i0.hdslb.com/bfs/face/abc.jpg
+    """
+    if not url or not isinstance(url, str):
+        return None
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if not host:
+        return None
+    if _HDSLB_MIRROR.match(host):
+        host = "i0.hdslb.com"
+    path = parts.path.split("@", 1)[0]
+    return f"{host}{path}"
+
+
+class _Flight:
+    """一次进行中的描述调用，等待者从这里取结果"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = ""
+
+
+class AvatarCache:
+    def __init__(self, maxsize=5000, ttl=7 * 86400, negative_ttl=60, sqlite_path=None, wait_timeout=30.0):
+        """
+        :param maxsize: 进程内最多缓存的头像数
+        :param ttl: 描述的缓存时间（秒）
+        :param negative_ttl: 描述失败（空结果）的缓存时间（秒）
+        :param sqlite_path: 持久化文件路径，为空则只缓存在内存中
+        :param wait_timeout: 等待同一 URL 进行中调用的最长时间（秒），超时返回空描述
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.wait_timeout = wait_timeout
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.sqlite_path = sqlite_path or None
+        self.local = threading.local()
+        # 规范化 URL -> 进行中的调用
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+        if self.sqlite_path:
+            os.makedirs(os.path.dirname(self.sqlite_path) or ".", exist_ok=True)
+            conn = self._conn()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS avatar_desc ("
+                "key TEXT PRIMARY KEY, description TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_avatar_desc_expires_at ON avatar_desc(expires_at)")
+            conn.execute("DELETE FROM avatar_desc WHERE expires_at <= ?", (time.time(),))
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _load(self, key):
+        """从 SQLite 读取未过期的描述，并放入进程内缓存"""
+        if not self.sqlite_path:
+            return MISSING
+        try:
+            row = self._conn().execute(
+                "SELECT description, expires_at FROM avatar_desc WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        except Exception as e:
+            warning(f"读取头像描述缓存失败: {e}")
+            return MISSING
+        if row is None:
+            return MISSING
+        self.cache.set(key, row[0], expires_at=row[1])
+        return row[0]
+
+    def _store(self, key, value):
+        expires_at = time.time() + (self.ttl if value else self.negative_ttl)
+        self.cache.set(key, value, expires_at=expires_at)
+        if not self.sqlite_path or not value:
+            return
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO avatar_desc (key, description, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+        except Exception as e:
+            warning(f"写入头像描述缓存失败: {e}")
+
+    def get_or_describe(self, face_url, describe):
+        """
+        读取头像描述，未命中时调用 describe(face_url) 并缓存；同一头像的并发请求只调用一次
+        """
+        key = normalize_face_url(face_url)
+        if key is None:
+            return ""
+        value = self.cache.get(key)
+        if value is not MISSING:
+            return value
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait(self.wait_timeout)
+            return flight.value
+
+        try:
+            value = self._load(key)
+            if value is MISSING:
+                value = describe(face_url) or ""
+                self._store(key, value)
+                debug(f"头像描述已缓存: {key} -> {value}")
+            flight.value = value
+            return value
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self.lock:
+            stats["coalesced"] = self.coalesced
+            stats["inflight"] = len(self.inflight)
+        return stats
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_avatar_cache():
+    """
+    获取进程内共享的头像描述缓存；AVATAR_CACHE_ENABLED=false 时返回 None。
+    AVATAR_CACHE_SQLITE_PATH（相对路径以项目根目录为基准）为空时只缓存在内存中
+    """
+    global _shared_cache
+    if os.environ.get("AVATAR_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            path = os.environ.get("AVATAR_CACHE_SQLITE_PATH", DEFAULT_SQLITE_PATH)
+            if path and not os.path.isabs(path):
+                path = os.path.join(ROOT_DIR, path)
+            try:
+                cache = AvatarCache(
+                    maxsize=int(os.environ.get("AVATAR_CACHE_MAXSIZE", 5000)),
+                    ttl=float(os.environ.get("AVATAR_CACHE_TTL", 7 * 86400)),
+                    negative_ttl=float(os.environ.get("AVATAR_CACHE_NEGATIVE_TTL", 60)),
+                    sqlite_path=path or None,
+                )
+            except Exception as e:
+                warning(f"头像描述缓存持久化初始化失败，只缓存在内存中: {e}")
+                path = None
+                cache = AvatarCache()
+            _shared_cache = cache
+            info(f"头像描述缓存已启用: sqlite={path or '无'}")
+        return _shared_cache
@@ -1,26 +1,78 @@
 # modules/battery_tracker.py
 import datetime
+import math
 import threading
 import os  # 添加os模块导入
+from collections import namedtuple
+
+from modules.quota_store import MemoryQuotaStore
+from modules.logger import info, error
+
+# try_consume 的结果；retry_after 为额度不足时最早可以再次成功的秒数（无法成功时为 None）
+QuotaResult = namedtuple("QuotaResult", "allowed hourly_used daily_used exceeded retry_after")
+
+
+def format_retry_after(seconds):
+    """把等待秒数格式化为弹幕中使用的简短文字"""
+    if seconds is None:
+        return ""
+    seconds = int(math.ceil(seconds))
+    if seconds < 60:
+        return f"{seconds}秒"
+    minutes = int(math.ceil(seconds / 60))
+    if minutes < 60:
+        return f"{minutes}分钟"
+    return f"{minutes // 60}小时{minutes % 60}分钟" if minutes % 60 else f"{minutes // 60}小时"
+
 
 class BatteryTracker:
     """
-    负责每小时、每日电池计数的管理，以及相应的重置和日志记录。
+    负责每小时、每日电池额度的检查与扣减，以及每日统计日志。
+    - 小时额度为滑动窗口：按分钟分桶，统计当前分钟及之前 60 分钟内的用量，
+      不会出现整点前后各用满一次（2 倍额度）的情况；每个桶在其结束 60 分钟后滑出窗口
+    - 日额度为固定窗口：在每天 reset_hour 切换
+    已用数量保存在额度存储中（见 modules/quota_store.py），多个 worker 共享同一存储时额度全局生效。
+    检查与扣减只访问额度存储；清理旧窗口、写每日报告等磁盘操作由后台线程定期执行，不在请求路径上。
     """
-    def __init__(self, reset_hour):
-        # 每小时以 room_id 为 key 的电池统计
-        self.hourly_battery_count = {}
-        # 每日以 room_id 为 key 的电池统计
-        self.daily_battery_count_by_room = {}
+    # 每日报告在额度存储中的占用标记，保证多个 worker 只写一次
+    REPORT_KIND = "report"
+    # 小时额度的滑动窗口长度与分桶粒度
+    HOURLY_WINDOW = datetime.timedelta(hours=1)
+    BUCKET = datetime.timedelta(minutes=1)
+    BUCKET_FORMAT = "%Y-%m-%dT%H:%M"
+    # 后台检查窗口切换的间隔（秒）
+    MAINTAIN_INTERVAL = 30
+
+    def __init__(self, reset_hour, store=None):
+        # 额度存储，默认进程内
+        self.store = store or MemoryQuotaStore()
 
-        self.last_hour = None
-        self.last_reset_day = None
+        self.last_hour_window = None
+        self.last_day_window = None
 
         self.log_base_dir = "data"  # 基础日志目录
         self.reset_hour = reset_hour  # 每天几点重置
 
-        # 提供线程安全锁
-        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # 启动时按当前窗口清理恢复出来的旧窗口（跨天重启时补记上一天的用量）
+        self.maintain()
+
+    def current_windows(self, now=None):
+        """
+        :return: (滑动窗口起始分钟桶, 当前分钟桶, 当前日窗口)；日窗口在每天 reset_hour 切换
+        """
+        now = now or datetime.datetime.now()
+        minute = now.replace(second=0, microsecond=0)
+        since = (minute - self.HOURLY_WINDOW).strftime(self.BUCKET_FORMAT)
+        day_window = (now - datetime.timedelta(hours=self.reset_hour)).date().isoformat()
+        return since, minute.strftime(self.BUCKET_FORMAT), day_window
+
+    def next_reset(self, day_window):
+        """日窗口 day_window 结束（下一次重置）的时间"""
+        day = datetime.date.fromisoformat(day_window) + datetime.timedelta(days=1)
+        return datetime.datetime.combine(day, datetime.time(self.reset_hour))
 
     def get_log_path(self):
         """
@@ -30,52 +82,113 @@ class BatteryTracker:
         year_dir = str(now.year)
         month_dir = f"{now.month:02d}"  # 补零确保两位数
         day_dir = f"{now.day:02d}"  # 补零确保两位数
-        
+
         log_path = os.path.join(self.log_base_dir, year_dir, month_dir, day_dir, "report.txt")
         return log_path
 
-    def log_data_unlocked(self):
+    def log_data(self, usage):
         """
-        将当天累计的所有房间日用量记录到日志文件中（可根据需求自由扩展）。
+        将一天累计的所有房间日用量记录到日志文件中（可根据需求自由扩展）。
         使用格式: data/年/月/日/report.txt
         """
         now = datetime.datetime.now()
         log_path = self.get_log_path()
-        
+
         # 确保日志目录存在
         log_dir = os.path.dirname(log_path)
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
-            
+
         # 写入或追加日志内容
         mode = "a" if os.path.exists(log_path) else "w"
         with open(log_path, mode, encoding="utf-8") as log_file:
             log_file.write(f"\n[{now.strftime('%Y-%m-%d %H:%M:%S')}] 当日各房间电池用量统计:\n")
-            for room_id, used in self.daily_battery_count_by_room.items():
+            for room_id, used in usage.items():
                 log_file.write(f"  - 房间 {room_id}: {used} 电池\n")
 
-    def reset_hourly_battery_unlocked(self):
+    def maintain(self):
         """
-        每个整点重置房间的小时电池计数（不加锁版本，调用者需要先获取锁）
+        每小时清理已滑出窗口的分钟桶；进入新的一天时记录上一天的用量（所有 worker 中只记录一次）
         """
-        now = datetime.datetime.now()
-        current_hour = now.hour
+        _, minute_bucket, day_window = self.current_windows()
+        hour_window = minute_bucket[:13]
+        new_hour = hour_window != self.last_hour_window
+        new_day = day_window != self.last_day_window
+        if not new_hour and not new_day:
+            return
+        self.last_hour_window = hour_window
+        self.last_day_window = day_window
+
+        try:
+            if new_hour:
+                since = datetime.datetime.strptime(minute_bucket, self.BUCKET_FORMAT) - self.HOURLY_WINDOW
+                self.store.prune("hourly", since.strftime(self.BUCKET_FORMAT))
+            if new_day:
+                previous = (datetime.date.fromisoformat(day_window) - datetime.timedelta(days=1)).isoformat()
+                usage = self.store.window_usage("daily", previous)
+                claimed, _, _ = self.store.try_consume("", 1, {self.REPORT_KIND: (previous, previous, 1)})
+                if claimed and usage:
+                    self.log_data(usage)
+                    info(f"已记录 {previous} 各房间电池用量: {len(usage)} 个房间")
+                self.store.prune("daily", previous)
+                self.store.prune(self.REPORT_KIND, previous)
+        except Exception as e:
+            error(f"电池额度窗口切换失败: {e}")
+
+    def _loop(self):
+        while not self.stop_event.wait(self.MAINTAIN_INTERVAL):
+            self.maintain()
+
+    def start(self):
+        """在后台每隔 MAINTAIN_INTERVAL 秒检查一次窗口切换"""
+        self.thread = threading.Thread(target=self._loop, name="battery-tracker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_usage(self, room_id):
+        """
+        :return: (最近一小时已用, 当日已用)
+        """
+        since, minute_bucket, day_window = self.current_windows()
+        used = self.store.get_usage(room_id, {"hourly": (since, minute_bucket), "daily": (day_window, day_window)})
+        return used["hourly"], used["daily"]
 
-        if self.last_hour is None or self.last_hour != current_hour:
-            self.hourly_battery_count.clear()
-            self.last_hour = current_hour
+    def _hourly_retry_after(self, room_id, amount, max_hourly, used, since, minute_bucket, now):
+        """最早有足够的分钟桶滑出窗口、使本次扣减可以成功的等待秒数"""
+        if amount > max_hourly:
+            return None
+        excess = used + amount - max_hourly
+        for bucket, bucket_used in self.store.buckets(room_id, "hourly", since, minute_bucket):
+            excess -= bucket_used
+            if excess <= 0:
+                # 分钟桶在其结束 60 分钟后滑出窗口
+                expires = datetime.datetime.strptime(bucket, self.BUCKET_FORMAT) + self.BUCKET + self.HOURLY_WINDOW
+                return max(1.0, (expires - now).total_seconds())
+        return None
 
-    def reset_daily_battery_unlocked(self):
+    def try_consume(self, room_id, amount, max_hourly, max_daily):
         """
-        每天reset_hour之后重置每日总电池（不加锁版本，调用者需要先获取锁）
+        原子地检查并扣减房间的小时与日额度，两者都充足时才扣减
+        :return: QuotaResult(是否成功, 小时已用, 当日已用, 不足的额度 "hourly"/"daily" 或 None, 需等待秒数)；
+                 成功时已用数量为扣减后的值
         """
         now = datetime.datetime.now()
-        current_day = now.day
-
-        if self.last_reset_day is None or self.last_reset_day != current_day:
-            # 只有在 >= reset_hour 时才进行重置
-            if now.hour >= self.reset_hour:
-                # 在重置前记录当天的数据
-                self.log_data_unlocked()
-                self.daily_battery_count_by_room.clear()
-                self.last_reset_day = current_day
+        since, minute_bucket, day_window = self.current_windows(now)
+        allowed, used, exceeded = self.store.try_consume(
+            room_id, amount,
+            {"hourly": (since, minute_bucket, max_hourly), "daily": (day_window, day_window, max_daily)}
+        )
+        retry_after = None
+        if not allowed:
+            # 两个额度都不足时需要等到较晚的那个恢复
+            waits = []
+            if used["hourly"] + amount > max_hourly:
+                waits.append(self._hourly_retry_after(
+                    room_id, amount, max_hourly, used["hourly"], since, minute_bucket, now
+                ))
+            if used["daily"] + amount > max_daily:
+                waits.append((self.next_reset(day_window) - now).total_seconds() if amount <= max_daily else None)
+            retry_after = None if None in waits else max(waits)
+        return QuotaResult(allowed, used["hourly"], used["daily"], exceeded, retry_after)
@@ -0,0 +1,201 @@
+"""
+B 站账号会话池
+一次性加载 account_cookies.json，并为每个账号维护一个可复用的 requests.Session，
+使送礼、弹幕等请求可以复用 keep-alive 连接，避免每次调用都重新握手。
+配置文件修改后（mtime 变化）会自动重新加载。
+"""
+import os
+import json
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules.logger import debug, info, warning
+
+# 默认的账号 Cookie 配置文件
+DEFAULT_COOKIE_PATH = "./missions/account_cookies.json"
+
+
+def parse_cookie_string(cookie_str):
+    """
+    将 cookie 字符串解析为 dict（以 ";" 分割，然后以 "=" 分割键值）
+    示例: "SESSDATA=xxx; bili_jct=xxx" -> {"SESSDATA": "xxx", "bili_jct": "xxx"}
+    """
+    cookies = {}
+    for c in (cookie_str or "").split(';'):
+        c = c.strip()
+        if '=' in c:
+            key, value = c.split('=', 1)
+            cookies[key.strip()] = value.strip()
+    return cookies
+
+
+class BiliAccountPool:
+    """
+    账号 -> (cookie, Session) 的进程内缓存。
+    Session 自带连接池，线程之间可以共享使用。
+    """
+    def __init__(self, cookie_path=DEFAULT_COOKIE_PATH, pool_maxsize=10, reload_check_interval=2.0):
+        """
+        :param cookie_path: account_cookies.json 文件路径
+        :param pool_maxsize: 每个账号 Session 的最大连接数
+        :param reload_check_interval: 检查配置文件是否变化的最小间隔（秒）
+        """
+        self.cookie_path = os.path.abspath(os.path.expanduser(cookie_path))
+        self.pool_maxsize = pool_maxsize
+        self.reload_check_interval = reload_check_interval
+
+        # 账号名 -> 原始 cookie 字符串
+        self.cookie_strings = {}
+        # 账号名 -> 解析后的 cookie dict
+        self.cookies = {}
+        # 账号名 -> requests.Session
+        self.sessions = {}
+
+        self.loaded = False
+        # 已加载文件的修改时间，以及上一次检查的时间
+        self.loaded_mtime = None
+        self.last_check = 0.0
+        self.lock = threading.Lock()
+
+    def _load_unlocked(self):
+        """
+        读取账号配置文件（不加锁版本，调用者需要先获取锁）
+        """
+        if not os.path.exists(self.cookie_path):
+            raise RuntimeError(f"账号配置文件 {self.cookie_path} 不存在！")
+
+        mtime = os.path.getmtime(self.cookie_path)
+        with open(self.cookie_path, "r", encoding="utf-8") as f:
+            all_cookies_data = json.load(f)
+
+        cookie_strings = {}
+        for account, item in all_cookies_data.items():
+            if isinstance(item, dict) and item.get("cookie"):
+                cookie_strings[account] = item["cookie"].strip()
+
+        cookies = {acc: parse_cookie_string(s) for acc, s in cookie_strings.items()}
+
+        # cookie 有变化或账号被移除的 Session 需要丢弃，下次使用时按新 cookie 重建。
+        # 旧 Session 可能正被其他线程用于发送请求，这里只移除引用，不调用 close()，
+        # 请求结束、不再被引用后由垃圾回收关闭其连接
+        for account in list(self.sessions.keys()):
+            if cookies.get(account) != self.cookies.get(account):
+                self.sessions.pop(account)
+                debug(f"账号 {account} 的 cookie 已变化，丢弃旧 Session")
+
+        self.cookie_strings = cookie_strings
+        self.cookies = cookies
+        self.loaded = True
+        self.loaded_mtime = mtime
+        info(f"账号配置加载完成: {self.cookie_path}, 账号数量={len(cookie_strings)}")
+
+    def _ensure_loaded_unlocked(self):
+        """
+        首次使用时加载配置；之后按 reload_check_interval 检查文件 mtime，变化时重新加载
+        """
+        if not self.loaded:
+            self._load_unlocked()
+            self.last_check = time.time()
+            return
+
+        now = time.time()
+        if now - self.last_check < self.reload_check_interval:
+            return
+        self.last_check = now
+
+        try:
+            mtime = os.path.getmtime(self.cookie_path)
+        except OSError as e:
+            warning(f"无法读取账号配置文件状态，继续使用已加载的配置: {e}")
+            return
+        if mtime != self.loaded_mtime:
+            try:
+                self._load_unlocked()
+            except Exception as e:
+                # 文件写到一半或格式错误时保留旧配置
+                warning(f"重新加载账号配置失败，继续使用已加载的配置: {e}")
+
+    def _new_session(self, account):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.cookies.update(self.cookies[account])
+        debug(f"为账号 {account} 创建新的 HTTP Session")
+        return session
+
+    def accounts(self):
+        """返回全部可用账号名"""
+        with self.lock:
+            self._ensure_loaded_unlocked()
+            return list(self.cookie_strings.keys())
+
+    def has_account(self, account):
+        with self.lock:
+            self._ensure_loaded_unlocked()
+            return account in self.cookie_strings
+
+    def get_cookie_string(self, account):
+        """获取账号的原始 cookie 字符串"""
+        with self.lock:
+            self._ensure_loaded_unlocked()
+            if account not in self.cookie_strings:
+                raise RuntimeError(f"账号 {account} 未找到，请检查 {self.cookie_path}！")
+            return self.cookie_strings[account]
+
+    def get_cookies(self, account):
+        """获取账号解析后的 cookie dict（副本）"""
+        with self.lock:
+            self._ensure_loaded_unlocked()
+            if account not in self.cookies:
+                raise RuntimeError(f"账号 {account} 未找到，请检查 {self.cookie_path}！")
+            return dict(self.cookies[account])
+
+    def get_csrf(self, account):
+        """获取账号的 bili_jct（csrf token），不存在时返回 None"""
+        return self.get_cookies(account).get("bili_jct")
+
+    def get_session(self, account):
+        """
+        获取账号对应的 Session，首次调用时创建，之后复用同一个连接池
+        """
+        with self.lock:
+            self._ensure_loaded_unlocked()
+            if account not in self.cookies:
+                raise RuntimeError(f"账号 {account} 未找到，请检查 {self.cookie_path}！")
+            session = self.sessions.get(account)
+            if session is None:
+                session = self._new_session(account)
+                self.sessions[account] = session
+            return session
+
+    def close(self):
+        """关闭所有 Session"""
+        with self.lock:
+            for session in self.sessions.values():
+                try:
+                    session.close()
+                except Exception as e:
+                    warning(f"关闭 Session 失败: {e}")
+            self.sessions.clear()
+
+
+# 以配置文件绝对路径为 key 的进程级共享实例
+_shared_pools = {}
+_shared_pools_lock = threading.Lock()
+
+
+def get_account_pool(cookie_path=DEFAULT_COOKIE_PATH):
+    """
+    获取进程内共享的账号会话池，同一个配置文件只会加载一次
+    """
+    key = os.path.abspath(os.path.expanduser(cookie_path))
+    with _shared_pools_lock:
+        pool = _shared_pools.get(key)
+        if pool is None:
+            pool = BiliAccountPool(key)
+            _shared_pools[key] = pool
+        return pool
@@ -8,6 +8,9 @@ from collections import defaultdict
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from modules.avatar_cache import get_avatar_cache
+from modules.rate_limiter import ChatRateLimiter, ConcurrencyLimitError
+
 class ChatbotHandler:
     """
     用于调用ChatGPT API生成猫猫风格的弹幕回复
@@ -44,15 +47,18 @@ class ChatbotHandler:
         self.client = OpenAI(api_key=self.api_key)
         
         # 冷却机制 - 从环境变量获取配置，如果不存在则使用默认值
-        self.request_times = []  # 存储最近请求的时间戳
-        self.cooldown_until = 0  # 冷却结束时间戳
-        self.lock = Lock()  # 用于线程安全
-        
         # 从环境变量读取配置
         try:
             self.cooldown_duration = int(os.environ.get("COOLDOWN_DURATION", 30))  # 冷却时间（秒）
             self.rate_limit_window = int(os.environ.get("RATE_LIMIT_WINDOW", 3))  # 速率限制窗口（秒）
             self.max_requests_per_window = int(os.environ.get("MAX_REQUESTS_PER_WINDOW", 1))  # 窗口内最大请求数
+            # 每个用户的限制（0 表示不按用户限制）
+            self.user_rate_limit_window = int(os.environ.get("USER_RATE_LIMIT_WINDOW", 10))
+            self.max_user_requests_per_window = int(os.environ.get("MAX_USER_REQUESTS_PER_WINDOW", 0))
+            # 所有房间合计每分钟最多请求数（0 表示不限制）与同时进行中的请求数上限
+            self.global_requests_per_minute = int(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", 0))
+            self.max_concurrency = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 8))
+            self.concurrency_timeout = float(os.environ.get("OPENAI_CONCURRENCY_TIMEOUT", 10))
             
             # 上下文记忆相关配置
             self.context_enabled = os.environ.get("CONTEXT_ENABLED", "true").lower() == "true"  # 是否启用上下文记忆
@@ -63,10 +69,31 @@ class ChatbotHandler:
             self.cooldown_duration = 30
             self.rate_limit_window = 3
             self.max_requests_per_window = 1
+            self.user_rate_limit_window = 10
+            self.max_user_requests_per_window = 0
+            self.global_requests_per_minute = 0
+            self.max_concurrency = 8
+            self.concurrency_timeout = 10.0
             self.context_enabled = True
             self.max_context_messages = 10
             self.context_expiry = 1800
         
+        # 限流：每个房间（可选每个用户）的令牌桶 + 全局额度 + 进行中请求数上限
+        self.rate_limiter = ChatRateLimiter(
+            room_rate=self.max_requests_per_window / max(1, self.rate_limit_window),
+            room_capacity=self.max_requests_per_window,
+            cooldown=self.cooldown_duration,
+            user_rate=self.max_user_requests_per_window / max(1, self.user_rate_limit_window),
+            user_capacity=self.max_user_requests_per_window,
+            global_rate=self.global_requests_per_minute / 60.0,
+            global_capacity=self.global_requests_per_minute,
+            max_concurrency=self.max_concurrency,
+            acquire_timeout=self.concurrency_timeout,
+        )
+
+        # 头像描述缓存（按规范化的头像 URL），为 None 时每次都调用视觉模型
+        self.avatar_cache = get_avatar_cache()
+
         # 存储每个房间的消息历史
         self.message_history = defaultdict(list)
         # 存储每个房间最后一次交互的时间戳
@@ -104,31 +131,14 @@ class ChatbotHandler:
             pass
         return self.default_system_prompt
         
-    def is_rate_limited(self):
+    def is_rate_limited(self, room_id="default", user_key=None):
         """
-        检查是否超过速率限制
+        检查是否超过速率限制（按房间、用户与全局额度）
         
         :return: (是否受限, 是否在冷却状态)
         """
-        with self.lock:
-            current_time = time.time()
-            
-            # 如果在冷却期，直接返回限制状态
-            if current_time < self.cooldown_until:
-                return True, True
-                
-            # 清理旧的请求记录
-            self.request_times = [t for t in self.request_times if current_time - t <= self.rate_limit_window]
-            
-            # 检查是否超过速率限制
-            if len(self.request_times) >= self.max_requests_per_window:
-                # 设置冷却期
-                self.cooldown_until = current_time + self.cooldown_duration
-                return True, False
-                
-            # 记录当前请求时间
-            self.request_times.append(current_time)
-            return False, False
+        decision = self.rate_limiter.check(str(room_id), user_key)
+        return not decision.allowed, decision.reason == "cooldown"
         
     def clean_expired_contexts(self):
         """已弃用：上下文由 Responses API 管理。"""
@@ -260,7 +270,7 @@ class ChatbotHandler:
             room_id = "default"
 
         # 速率限制
-        is_limited, _ = self.is_rate_limited()
+        is_limited, _ = self.is_rate_limited(room_id, self._get_user_key(user_profile))
         if is_limited:
             return "喵喵喵喵喵！！！"
 
@@ -287,22 +297,23 @@ class ChatbotHandler:
                 prev_id = self.room_last_response_id.get(str(room_id))
 
             # 首次对话需注入房间级 system 提示；之后仅发送用户消息并通过 previous_response_id 续写
-            if prev_id:
-                response = self.client.responses.create(
-                    model=self.model,
-                    input=[{"role": "user", "content": user_content}],
-                    previous_response_id=prev_id,
-                    store=True
-                )
-            else:
-                response = self.client.responses.create(
-                    model=self.model,
-                    input=[
-                        {"role": "system", "content": self.get_system_prompt_for_room(room_id)},
-                        {"role": "user", "content": user_content}
-                    ],
-                    store=True
-                )
+            with self.rate_limiter.inflight():
+                if prev_id:
+                    response = self.client.responses.create(
+                        model=self.model,
+                        input=[{"role": "user", "content": user_content}],
+                        previous_response_id=prev_id,
+                        store=True
+                    )
+                else:
+                    response = self.client.responses.create(
+                        model=self.model,
+                        input=[
+                            {"role": "system", "content": self.get_system_prompt_for_room(room_id)},
+                            {"role": "user", "content": user_content}
+                        ],
+                        store=True
+                    )
 
             # 记录新的 response_id
             with self.response_id_lock:
@@ -346,17 +357,27 @@ class ChatbotHandler:
                 generated_text = generated_text[:40]
             return generated_text
 
+        except ConcurrencyLimitError:
+            return "喵喵喵喵喵！！！"
         except Exception as e:
             traceback.print_exc()
             raise RuntimeError(f"生成回复异常: {str(e)}")
 
     def describe_avatar(self, image_url: str) -> str:
         """
-        使用支持视觉的模型简要描述头像（中文，尽量不超过20字）。
+        简要描述头像（中文，尽量不超过20字）；同一头像的描述会被缓存，并发请求只调用一次视觉模型。
 
         :param image_url: 头像图片的URL
         :return: 简短的头像描述；失败时返回空字符串
         """
+        if self.avatar_cache is None:
+            return self._describe_avatar(image_url)
+        return self.avatar_cache.get_or_describe(image_url, self._describe_avatar)
+
+    def _describe_avatar(self, image_url: str) -> str:
+        """
+        使用支持视觉的模型描述头像（不经过缓存）。
+        """
         try:
             if not image_url or not isinstance(image_url, str):
                 return ""
@@ -378,14 +399,18 @@ class ChatbotHandler:
                 }
             ]
 
-            response = self.client.responses.create(
-                model=vision_model,
-                input=[
-                    {"role": "system", "content": messages[0]["content"]},
-                    {"role": "user", "content": messages[1]["content"]}
-                ],
-                store=False
-            )
+            # 只占用全局额度，不计入房间额度
+            if not self.rate_limiter.check().allowed:
+                return ""
+            with self.rate_limiter.inflight():
+                response = self.client.responses.create(
+                    model=vision_model,
+                    input=[
+                        {"role": "system", "content": messages[0]["content"]},
+                        {"role": "user", "content": messages[1]["content"]}
+                    ],
+                    store=False
+                )
 
             desc = getattr(response, "output_text", "") or ""
             if len(desc) > 30:
@@ -430,14 +455,18 @@ class ChatbotHandler:
                 {"role": "user", "content": "；".join(user_text_parts)}
             ]
 
-            response = self.client.responses.create(
-                model=base_model,
-                input=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": "；".join(user_text_parts)}
-                ],
-                store=False
-            )
+            # 只占用全局额度，不计入房间额度；额度不足时使用固定短句
+            if not self.rate_limiter.check().allowed:
+                return f"欢迎{uname}喵～" if not is_captain else f"欢迎舰长{uname}喵～"
+            with self.rate_limiter.inflight():
+                response = self.client.responses.create(
+                    model=base_model,
+                    input=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": "；".join(user_text_parts)}
+                    ],
+                    store=False
+                )
 
             text = getattr(response, "output_text", "") or ""
             if len(text) > 40:
@@ -446,3 +475,64 @@ class ChatbotHandler:
         except Exception:
             # 降级为固定短句
             return f"欢迎{uname}喵～" if not is_captain else f"欢迎舰长{uname}喵～"
+
+    @staticmethod
+    def template_batch_welcome(entries) -> str:
+        """
+        多位用户的固定格式欢迎语（舰长排在前面并逐个加上“舰长”称呼，昵称过多时只列出前几位）。
+
+        :param entries: [{"uname": 用户名, "is_captain": 是否舰长}]
+        """
+        captains = [f"舰长{e['uname']}" for e in entries if e.get("is_captain") and e.get("uname")]
+        others = [e["uname"] for e in entries if not e.get("is_captain") and e.get("uname")]
+        listed = []
+        for name in captains + others:
+            if len("、".join(listed + [name])) > 20:
+                break
+            listed.append(name)
+        if not listed:
+            return "欢迎各位小伙伴喵～"
+        suffix = f"等{len(entries)}位小伙伴" if len(listed) < len(entries) else ""
+        return f"欢迎{'、'.join(listed)}{suffix}喵～"
+
+    def generate_batch_welcome(self, entries) -> str:
+        """
+        为同一时间进场的多位用户生成一条合并欢迎语（一次调用，单句，不超过40字；舰长需特别致意）。
+
+        :param entries: [{"uname": 用户名, "is_captain": 是否舰长}]
+        :return: 欢迎语；失败时返回固定格式的欢迎语
+        """
+        try:
+            base_model = self.model or os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+
+            system_prompt = (
+                "你是直播间欢迎助手，以可爱猫猫风格写欢迎语。"
+                "要求：多位观众同时进场，仅输出一句中文欢迎语欢迎所有人；"
+                "舰长需点名特别致意，其他人可点名几位后用“等”概括；"
+                "不输出引号与解释；不超过40字。"
+            )
+            # 控制提示长度：最多列出 20 位（舰长优先）
+            ordered = sorted(entries, key=lambda e: not e.get("is_captain"))[:20]
+            lines = [f"{e['uname']}（{'舰长' if e.get('is_captain') else '观众'}）" for e in ordered]
+            user_text = f"共{len(entries)}位进场：" + "、".join(lines) + "。请直接给出最终欢迎语。"
+
+            # 只占用全局额度，不计入房间额度；额度不足时使用固定格式
+            if not self.rate_limiter.check().allowed:
+                return self.template_batch_welcome(entries)
+            with self.rate_limiter.inflight():
+                response = self.client.responses.create(
+                    model=base_model,
+                    input=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_text}
+                    ],
+                    store=False
+                )
+
+            text = getattr(response, "output_text", "") or ""
+            if len(text) > 40:
+                text = text[:40]
+            return text or self.template_batch_welcome(entries)
+        except Exception:
+            # 降级为固定格式
+            return self.template_batch_welcome(entries)
@@ -1,18 +1,114 @@
 import subprocess
 import os
+import time
 import traceback
 
+import requests
+
+from modules.bili_account_pool import get_account_pool
+from modules.logger import debug, error
+
+SEND_DANMAKU_URL = "https://api.live.bilibili.com/msg/send"
+
+# 与 sendDanmaku/main.py 保持一致的请求头（referer 按房间填充）
+DANMAKU_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'zh-CN,zh;q=0.9',
+    'origin': 'https://live.bilibili.com',
+    'sec-ch-ua': '"Google Chrome";v="131", "Chromium";v="131", "Not_A Brand";v="24"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"macOS"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-site',
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
+                  'AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/131.0.0.0 Safari/537.36'
+}
+
+
 class DanmakuSender:
     """
-    用于通过子进程执行发送弹幕脚本。
+    用于发送弹幕。
+    默认在进程内通过共享的账号会话池发送（cookie 只解析一次，连接保持 keep-alive），
+    mode="subprocess"（或环境变量 DANMAKU_SENDER_MODE=subprocess）时回退为通过子进程执行发送脚本。
     """
-    def __init__(self, workdir="./missions/danmaku/sendDanmaku"):
+    def __init__(self, workdir="./missions/danmaku/sendDanmaku", mode=None, account="sentry", timeout=15):
         """
         :param workdir: 存放 sendDanmaku.py 脚本的目录
+        :param mode: "inprocess" 或 "subprocess"，默认读取环境变量 DANMAKU_SENDER_MODE
+        :param account: 发送弹幕使用的账号
+        :param timeout: 单次发送的超时时间（秒）
         """
         self.workdir = os.path.expanduser(workdir)
+        self.mode = (mode or os.environ.get("DANMAKU_SENDER_MODE", "inprocess")).lower()
+        self.account = account
+        self.timeout = timeout
+        # 与 main.py 默认的 --cookie-path 保持一致；会话池在进程内共享，构造开销很小
+        self.account_pool = get_account_pool(os.path.join(self.workdir, "..", "..", "account_cookies.json"))
 
     def send_danmaku(self, room_id, danmaku):
+        """
+        发送弹幕
+        """
+        if self.mode == "subprocess":
+            return self._send_danmaku_subprocess(room_id, danmaku)
+        return self._send_danmaku_inprocess(room_id, danmaku)
+
+    def _send_danmaku_inprocess(self, room_id, danmaku):
+        """
+        使用账号会话池直接请求弹幕接口。
+        网络异常抛出 TimeoutError / RuntimeError；接口返回失败时只记录日志并返回 False
+        """
+        session = self.account_pool.get_session(self.account)
+        bili_jct = self.account_pool.get_csrf(self.account) or ''
+
+        headers = dict(DANMAKU_HEADERS)
+        headers['referer'] = f'https://live.bilibili.com/{room_id}'
+
+        data = {
+            'bubble': '0',
+            'msg': danmaku,
+            'color': '16777215',
+            'mode': '1',
+            'fontsize': '25',
+            'rnd': str(int(time.time())),
+            'room_type': '0',
+            'jumpfrom': '77002',
+            'reply_mid': '0',
+            'reply_attr': '0',
+            'replay_dmid': '',
+            'statistics': '{"appId":100,"platform":5}',
+            'reply_type': '0',
+            'reply_uname': '',
+            'roomid': str(room_id),
+            'csrf': bili_jct,
+            'csrf_token': bili_jct
+        }
+
+        try:
+            response = session.post(SEND_DANMAKU_URL, headers=headers, data=data, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise TimeoutError(f"发送弹幕超时: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"发送弹幕请求异常: {str(e)}")
+
+        if response.status_code != 200:
+            error(f"弹幕发送失败, HTTP状态码: {response.status_code}, 响应内容: {response.text}")
+            return False
+
+        try:
+            code = response.json().get('code')
+        except ValueError:
+            code = None
+        if code not in (0, None):
+            error(f"弹幕发送失败, 房间 {room_id}, 响应内容: {response.text}")
+            return False
+
+        debug(f"弹幕发送成功: 房间 {room_id}, {danmaku}")
+        return True
+
+    def _send_danmaku_subprocess(self, room_id, danmaku):
         """
         调用 sendDanmaku.py 脚本发送弹幕
         """
@@ -27,8 +123,9 @@ class DanmakuSender:
                 ],
                 cwd=self.workdir,
                 check=True,
-                timeout=15  # 防止脚本卡死
+                timeout=self.timeout  # 防止脚本卡死
             )
+            return True
         except subprocess.TimeoutExpired as e:
             raise TimeoutError(f"运行 sendDanmaku 超时: {str(e)}")
         except subprocess.CalledProcessError as e:
@@ -8,8 +8,25 @@ import psycopg2
 import psycopg2.extras
 import datetime
 from dotenv import load_dotenv
+from modules.db_pool import get_db_pool, load_db_config
 from modules.logger import get_logger, debug, info, warning, error, critical
 
+# 写入监听器：记录提交成功后调用 listener(table_name, records)，
+# records 为已写入记录的字典列表（列名 -> 值，另含 id），用于缓存失效、排行榜与实时推送等
+_write_listeners = []
+
+
+def register_write_listener(listener):
+    """注册写入监听器（进程内生效，重复注册同一个函数只保留一次）"""
+    if listener not in _write_listeners:
+        _write_listeners.append(listener)
+
+
+def unregister_write_listener(listener):
+    if listener in _write_listeners:
+        _write_listeners.remove(listener)
+
+
 class DBHandler:
     def __init__(self, env_path="missions/.env", table_name="gift_records"):
         """
@@ -22,29 +39,105 @@ class DBHandler:
         # 加载环境变量
         load_dotenv(env_path)
         
-        # 数据库连接信息
-        self.db_config = {
-            "host": os.getenv("DB_HOST"),
-            "port": os.getenv("DB_PORT"),
-            "user": os.getenv("DB_USER"),
-            "password": os.getenv("DB_PASS"),
-            "database": os.getenv("DB_NAME")
-        }
+        # 数据库连接信息（相同连接信息的处理器共享同一个连接池）
+        self.db_config = load_db_config()
         
         # 记录表名
         self.table_name = table_name
+
+        # 礼物汇总表（写入时在同一事务内增量维护，日/周/月汇总等分析查询直接读取汇总表）
+        self.use_rollups = os.getenv("GIFT_ROLLUPS", "true").lower() == "true"
+        self.room_hourly_table = f"{table_name}_room_hourly"
+        self.room_daily_table = f"{table_name}_room_daily"
+        self.user_daily_table = f"{table_name}_user_daily"
         
         info(f"数据库处理器初始化完成, 表名: {table_name}")
     
     def get_connection(self):
-        """获取数据库连接"""
+        """从共享连接池借出数据库连接，用完需调用 release_connection 归还"""
         try:
-            conn = psycopg2.connect(**self.db_config)
-            return conn
+            return get_db_pool(self.db_config).getconn()
         except Exception as e:
             error(f"数据库连接失败: {e}")
             raise
+
+    def release_connection(self, conn):
+        """把连接归还到共享连接池"""
+        get_db_pool(self.db_config).putconn(conn)
     
+    def _notify_write(self, columns, rows, record_ids):
+        """
+        通知写入监听器（在事务提交之后调用），监听器抛出的异常只记录日志
+        """
+        if not _write_listeners:
+            return
+        records = []
+        for row, record_id in zip(rows, record_ids):
+            if record_id is None:
+                continue
+            record = {
+                column: value.adapted if isinstance(value, psycopg2.extras.Json) else value
+                for column, value in zip(columns, row)
+            }
+            record["id"] = record_id
+            records.append(record)
+        if not records:
+            return
+        for listener in list(_write_listeners):
+            try:
+                listener(self.table_name, records)
+            except Exception as e:
+                error(f"写入监听器执行失败: {e}")
+
+    def _apply_rollups(self, cursor, rows):
+        """
+        在写入礼物记录的同一事务内增量更新汇总表。
+        rows 的前 7 列依次为 timestamp, room_id, uid, uname, gift_id, gift_name, price
+        """
+        if not self.use_rollups or not rows:
+            return
+
+        hourly = {}
+        daily = {}
+        user_daily = {}
+        for row in rows:
+            ts, room_id, uid, uname, price = row[0], row[1], row[2], row[3], row[6] or 0
+            for buckets, key in (
+                (hourly, (room_id, ts.replace(minute=0, second=0, microsecond=0))),
+                (daily, (room_id, ts.date())),
+            ):
+                count, total = buckets.get(key, (0, 0))
+                buckets[key] = (count + 1, total + price)
+            key = (room_id, uid, ts.date())
+            count, total, _ = user_daily.get(key, (0, 0, None))
+            user_daily[key] = (count + 1, total + price, uname)
+
+        # 按主键顺序更新，并发事务对同一批汇总行的加锁顺序一致，避免死锁
+        for table, buckets in ((self.room_hourly_table, hourly), (self.room_daily_table, daily)):
+            psycopg2.extras.execute_values(
+                cursor,
+                f'''
+                INSERT INTO {table} AS r (room_id, bucket, gift_count, total_price)
+                VALUES %s
+                ON CONFLICT (room_id, bucket) DO UPDATE SET
+                    gift_count = r.gift_count + EXCLUDED.gift_count,
+                    total_price = r.total_price + EXCLUDED.total_price
+                ''',
+                [(k[0], k[1], v[0], v[1]) for k, v in sorted(buckets.items())]
+            )
+        psycopg2.extras.execute_values(
+            cursor,
+            f'''
+            INSERT INTO {self.user_daily_table} AS r (room_id, uid, bucket, uname, gift_count, total_price)
+            VALUES %s
+            ON CONFLICT (room_id, uid, bucket) DO UPDATE SET
+                uname = EXCLUDED.uname,
+                gift_count = r.gift_count + EXCLUDED.gift_count,
+                total_price = r.total_price + EXCLUDED.total_price
+            ''',
+            [(k[0], k[1], k[2], v[2], v[0], v[1]) for k, v in sorted(user_daily.items())]
+        )
+
     def add_gift_record(self, room_id, uid, uname, gift_id, gift_name, price, gift_num=1):
         """
         添加礼物记录
@@ -79,7 +172,10 @@ class DBHandler:
             )
             
             record_id = cursor.fetchone()[0]
+            row = (now, str(room_id), int(uid), uname, int(gift_id), gift_name, int(price), int(gift_num))
+            self._apply_rollups(cursor, [row])
             conn.commit()
+            self._notify_write(self.GIFT_V2_COLUMNS[:8], [row], [record_id])
             info(f"礼物记录添加成功, ID: {record_id}")
             return record_id
             
@@ -89,7 +185,59 @@ class DBHandler:
             raise e
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
+
+    # 上舰记录写入的列顺序，与 build_guard_row 返回的元组一一对应
+    GUARD_COLUMNS = (
+        "timestamp", "room_id", "uid", "username", "guard_level", "count", "price",
+        "gift_id", "gift_name", "start_time", "end_time", "raw_message", "tid",
+    )
+
+    @staticmethod
+    def build_guard_row(payload: dict, received_at=None):
+        """
+        把 /guard 的 JSON 转换为待写入的行（列顺序见 GUARD_COLUMNS）。
+        缺少必需字段时抛出 ValueError。
+
+        Args:
+            payload: /guard 的完整 JSON
+            received_at: 事件接收时间戳（秒），默认为当前时间；延迟写库时用于保留原始时间
+        """
+        if received_at is None:
+            now_dt = datetime.datetime.now()
+        else:
+            now_dt = datetime.datetime.fromtimestamp(received_at)
+
+        # 安全转换
+        def to_int(value, default=None):
+            try:
+                return int(value)
+            except Exception:
+                return default
+
+        room_id = str(payload.get("room_id"))
+        uid = to_int(payload.get("uid"))
+        username = str(payload.get("username") or "")
+        guard_level = to_int(payload.get("guard_level"), 0)
+        count = to_int(payload.get("count"), 1)
+        price = to_int(payload.get("price"))
+        gift_id = to_int(payload.get("gift_id"))
+        gift_name = str(payload.get("gift_name") or "")
+        start_time = to_int(payload.get("start_time"))
+        end_time = to_int(payload.get("end_time"))
+        raw_message = payload.get("raw_message")
+        tid = payload.get("tid")
+
+        if room_id is None or uid is None or username == "" or guard_level is None:
+            raise ValueError("Missing required guard fields: room_id/uid/username/guard_level")
+
+        json_wrap = psycopg2.extras.Json
+        return (
+            now_dt, room_id, uid, username, guard_level, count, price,
+            gift_id, gift_name, start_time, end_time,
+            json_wrap(raw_message) if raw_message is not None else None,
+            str(tid) if tid is not None else None,
+        )
 
     def add_guard_record(self, payload: dict):
         """
@@ -100,54 +248,23 @@ class DBHandler:
         cursor = conn.cursor()
 
         try:
-            now_dt = datetime.datetime.now()
-
-            # 安全转换
-            def to_int(value, default=None):
-                try:
-                    return int(value)
-                except Exception:
-                    return default
-
-            room_id = str(payload.get("room_id"))
-            uid = to_int(payload.get("uid"))
-            username = str(payload.get("username") or "")
-            guard_level = to_int(payload.get("guard_level"), 0)
-            count = to_int(payload.get("count"), 1)
-            price = to_int(payload.get("price"))
-            gift_id = to_int(payload.get("gift_id"))
-            gift_name = str(payload.get("gift_name") or "")
-            start_time = to_int(payload.get("start_time"))
-            end_time = to_int(payload.get("end_time"))
-            raw_message = payload.get("raw_message")
-
-            if room_id is None or uid is None or username == "" or guard_level is None:
-                raise ValueError("Missing required guard fields: room_id/uid/username/guard_level")
-
-            sql = f'''
-                INSERT INTO {self.table_name}
-                (
-                    timestamp, room_id, uid, username, guard_level, count, price,
-                    gift_id, gift_name, start_time, end_time, raw_message
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s
-                ) RETURNING id
-            '''
+            row = self.build_guard_row(payload)
 
-            json_wrap = psycopg2.extras.Json
+            columns = ", ".join(self.GUARD_COLUMNS)
+            placeholders = ", ".join(["%s"] * len(self.GUARD_COLUMNS))
             cursor.execute(
-                sql,
-                (
-                    now_dt, room_id, uid, username, guard_level, count, price,
-                    gift_id, gift_name, start_time, end_time,
-                    json_wrap(raw_message) if raw_message is not None else None,
-                )
+                f'''
+                INSERT INTO {self.table_name} ({columns})
+                VALUES ({placeholders})
+                RETURNING id
+                ''',
+                row
             )
 
             record_id = cursor.fetchone()[0]
             conn.commit()
-            info(f"上舰记录添加成功, ID: {record_id}, user: {username}, level: {guard_level}")
+            self._notify_write(self.GUARD_COLUMNS, [row], [record_id])
+            info(f"上舰记录添加成功, ID: {record_id}, user: {row[3]}, level: {row[4]}")
             return record_id
         except Exception as e:
             conn.rollback()
@@ -155,7 +272,105 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
+
+    # 新版礼物记录写入的列顺序，与 build_gift_row 返回的元组一一对应
+    GIFT_V2_COLUMNS = (
+        "timestamp", "room_id", "uid", "uname", "gift_id", "gift_name", "price", "gift_num",
+        "total_price", "coin_type", "gift_type", "action", "is_blind_gift",
+        "blind_box", "sender", "receiver",
+        "tid", "rnd", "batch_combo_id", "combo_total_coin", "total_coin", "combo_id",
+        "gift_assets", "tag_image", "effect", "effect_block", "svga_block",
+        "combo_resources_id", "face_effect_v2", "face_effect_id", "face_effect_type", "gift_tag",
+    )
+
+    @staticmethod
+    def build_gift_row(payload: dict, received_at=None):
+        """
+        把 /money 的 JSON 转换为待写入的行（列顺序见 GIFT_V2_COLUMNS）。
+        字段类型不合法时抛出 TypeError / ValueError，可用于写库前的校验。
+
+        Args:
+            payload: /money 的完整 JSON
+            received_at: 事件接收时间戳（秒），payload 未携带 timestamp 时使用；默认为当前时间
+        """
+        # 时间
+        if received_at is None:
+            fallback_dt = datetime.datetime.now()
+        else:
+            fallback_dt = datetime.datetime.fromtimestamp(received_at)
+        ts = payload.get("timestamp")
+        if ts is None:
+            now_dt = fallback_dt
+        else:
+            try:
+                now_dt = datetime.datetime.fromtimestamp(int(ts))
+            except Exception:
+                now_dt = fallback_dt
+
+        # 必需字段回退
+        room_id = str(payload.get("room_id"))
+        uid = int(payload.get("uid"))
+        uname = str(payload.get("uname") or "")
+        gift_id = int(payload.get("gift_id"))
+        gift_name = str(payload.get("gift_name") or "")
+        price = int(payload.get("price"))
+        gift_num = int(payload.get("gift_num", 1))
+
+        # 可选扩展字段
+        total_price = payload.get("total_price")
+        coin_type = payload.get("coin_type")
+        gift_type = payload.get("gift_type")
+        action = payload.get("action")
+        is_blind_gift = payload.get("is_blind_gift")
+        blind_box = payload.get("blind_box") or None
+        gift_assets = payload.get("gift_assets") or None
+        tag_image = payload.get("tag_image")
+        effect = payload.get("effect")
+        effect_block = payload.get("effect_block")
+        svga_block = payload.get("svga_block")
+        combo_resources_id = payload.get("combo_resources_id")
+        face_effect_v2 = payload.get("face_effect_v2") or None
+        face_effect_id = payload.get("face_effect_id")
+        face_effect_type = payload.get("face_effect_type")
+        gift_tag = payload.get("gift_tag") or None
+        sender = payload.get("sender") or None
+        receiver = payload.get("receiver") or None
+        tid = payload.get("tid")
+        rnd = payload.get("rnd")
+        batch_combo_id = payload.get("batch_combo_id")
+        combo_total_coin = payload.get("combo_total_coin")
+        total_coin = payload.get("total_coin")
+        combo_id = payload.get("combo_id")
+
+        json_wrap = psycopg2.extras.Json
+        return (
+            now_dt, room_id, uid, uname, gift_id, gift_name, price, gift_num,
+            total_price if total_price is not None else None,
+            str(coin_type) if coin_type is not None else None,
+            int(gift_type) if gift_type is not None else None,
+            str(action) if action is not None else None,
+            bool(is_blind_gift) if is_blind_gift is not None else None,
+            json_wrap(blind_box) if blind_box is not None else None,
+            json_wrap(sender) if sender is not None else None,
+            json_wrap(receiver) if receiver is not None else None,
+            str(tid) if tid is not None else None,
+            str(rnd) if rnd is not None else None,
+            str(batch_combo_id) if batch_combo_id is not None else None,
+            int(combo_total_coin) if combo_total_coin is not None else None,
+            int(total_coin) if total_coin is not None else None,
+            str(combo_id) if combo_id is not None else None,
+            json_wrap(gift_assets) if gift_assets is not None else None,
+            str(tag_image) if tag_image is not None else None,
+            int(effect) if effect is not None else None,
+            int(effect_block) if effect_block is not None else None,
+            int(svga_block) if svga_block is not None else None,
+            int(combo_resources_id) if combo_resources_id is not None else None,
+            json_wrap(face_effect_v2) if face_effect_v2 is not None else None,
+            int(face_effect_id) if face_effect_id is not None else None,
+            int(face_effect_type) if face_effect_type is not None else None,
+            json_wrap(gift_tag) if gift_tag is not None else None,
+        )
 
     def add_gift_record_v2(self, payload: dict):
         """
@@ -166,109 +381,28 @@ class DBHandler:
         cursor = conn.cursor()
 
         try:
-            # 时间
-            ts = payload.get("timestamp")
-            if ts is None:
-                now_dt = datetime.datetime.now()
-            else:
-                try:
-                    now_dt = datetime.datetime.fromtimestamp(int(ts))
-                except Exception:
-                    now_dt = datetime.datetime.now()
-
-            # 必需字段回退
-            room_id = str(payload.get("room_id"))
-            uid = int(payload.get("uid"))
-            uname = str(payload.get("uname") or "")
-            gift_id = int(payload.get("gift_id"))
-            gift_name = str(payload.get("gift_name") or "")
-            price = int(payload.get("price"))
-            gift_num = int(payload.get("gift_num", 1))
-
-            # 可选扩展字段
-            total_price = payload.get("total_price")
-            coin_type = payload.get("coin_type")
-            gift_type = payload.get("gift_type")
-            action = payload.get("action")
-            is_blind_gift = payload.get("is_blind_gift")
-            blind_box = payload.get("blind_box") or None
-            gift_assets = payload.get("gift_assets") or None
-            tag_image = payload.get("tag_image")
-            effect = payload.get("effect")
-            effect_block = payload.get("effect_block")
-            svga_block = payload.get("svga_block")
-            combo_resources_id = payload.get("combo_resources_id")
-            face_effect_v2 = payload.get("face_effect_v2") or None
-            face_effect_id = payload.get("face_effect_id")
-            face_effect_type = payload.get("face_effect_type")
-            gift_tag = payload.get("gift_tag") or None
-            sender = payload.get("sender") or None
-            receiver = payload.get("receiver") or None
-            tid = payload.get("tid")
-            rnd = payload.get("rnd")
-            batch_combo_id = payload.get("batch_combo_id")
-            combo_total_coin = payload.get("combo_total_coin")
-            total_coin = payload.get("total_coin")
-            combo_id = payload.get("combo_id")
+            row = self.build_gift_row(payload)
 
             debug(
-                f"添加礼物记录V2: room_id={room_id}, uid={uid}, uname={uname}, gift={gift_name}, "
-                f"price={price}, num={gift_num}, total_price={total_price}, coin_type={coin_type}, action={action}"
+                f"添加礼物记录V2: room_id={row[1]}, uid={row[2]}, uname={row[3]}, gift={row[5]}, "
+                f"price={row[6]}, num={row[7]}, total_price={row[8]}, coin_type={row[9]}, action={row[11]}"
             )
 
-            sql = f'''
-                INSERT INTO {self.table_name}
-                (
-                    timestamp, room_id, uid, uname, gift_id, gift_name, price, gift_num,
-                    total_price, coin_type, gift_type, action, is_blind_gift,
-                    blind_box, sender, receiver,
-                    tid, rnd, batch_combo_id, combo_total_coin, total_coin, combo_id,
-                    gift_assets, tag_image, effect, effect_block, svga_block,
-                    combo_resources_id, face_effect_v2, face_effect_id, face_effect_type, gift_tag
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s,
-                    %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s
-                ) RETURNING id
-            '''
-
-            json_wrap = psycopg2.extras.Json
+            columns = ", ".join(self.GIFT_V2_COLUMNS)
+            placeholders = ", ".join(["%s"] * len(self.GIFT_V2_COLUMNS))
             cursor.execute(
-                sql,
-                (
-                    now_dt, room_id, uid, uname, gift_id, gift_name, price, gift_num,
-                    total_price if total_price is not None else None,
-                    str(coin_type) if coin_type is not None else None,
-                    int(gift_type) if gift_type is not None else None,
-                    str(action) if action is not None else None,
-                    bool(is_blind_gift) if is_blind_gift is not None else None,
-                    json_wrap(blind_box) if blind_box is not None else None,
-                    json_wrap(sender) if sender is not None else None,
-                    json_wrap(receiver) if receiver is not None else None,
-                    str(tid) if tid is not None else None,
-                    str(rnd) if rnd is not None else None,
-                    str(batch_combo_id) if batch_combo_id is not None else None,
-                    int(combo_total_coin) if combo_total_coin is not None else None,
-                    int(total_coin) if total_coin is not None else None,
-                    str(combo_id) if combo_id is not None else None,
-                    json_wrap(gift_assets) if gift_assets is not None else None,
-                    str(tag_image) if tag_image is not None else None,
-                    int(effect) if effect is not None else None,
-                    int(effect_block) if effect_block is not None else None,
-                    int(svga_block) if svga_block is not None else None,
-                    int(combo_resources_id) if combo_resources_id is not None else None,
-                    json_wrap(face_effect_v2) if face_effect_v2 is not None else None,
-                    int(face_effect_id) if face_effect_id is not None else None,
-                    int(face_effect_type) if face_effect_type is not None else None,
-                    json_wrap(gift_tag) if gift_tag is not None else None,
-                )
+                f'''
+                INSERT INTO {self.table_name} ({columns})
+                VALUES ({placeholders})
+                RETURNING id
+                ''',
+                row
             )
 
             record_id = cursor.fetchone()[0]
+            self._apply_rollups(cursor, [row])
             conn.commit()
+            self._notify_write(self.GIFT_V2_COLUMNS, [row], [record_id])
             info(f"礼物记录V2添加成功, ID: {record_id}")
             return record_id
         except Exception as e:
@@ -277,7 +411,106 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
+
+    def _insert_rows(self, columns, rows, page_size=500, skip_existing_tid=False, rollups=False):
+        """
+        在单个事务内用多行 INSERT 批量写入。
+
+        Args:
+            columns: 列名元组，与行元组一一对应（需包含 tid 列才能去重）
+            rows: 行元组列表
+            page_size: 每条 INSERT 语句包含的最大行数
+            skip_existing_tid: 为 True 时跳过表中已存在（或本批次内重复）的 tid，
+                               用于重放等需要幂等写入的场景
+            rollups: 是否同时更新礼物汇总表（仅礼物记录）
+
+        Returns:
+            与 rows 顺序一致的记录ID列表，被跳过的行为 None
+        """
+        if not rows:
+            return []
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            pending = list(range(len(rows)))
+            if skip_existing_tid:
+                # tid 索引不是唯一索引，用事务级咨询锁串行化同一张表的幂等写入
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (self.table_name,))
+                tid_index = columns.index("tid")
+                tids = list({row[tid_index] for row in rows if row[tid_index] is not None})
+                seen = set()
+                if tids:
+                    cursor.execute(
+                        f"SELECT tid FROM {self.table_name} WHERE tid = ANY(%s)",
+                        (tids,)
+                    )
+                    seen = {r[0] for r in cursor.fetchall()}
+                pending = []
+                for i, row in enumerate(rows):
+                    tid = row[tid_index]
+                    if tid is not None:
+                        if tid in seen:
+                            continue
+                        seen.add(tid)
+                    pending.append(i)
+
+            record_ids = [None] * len(rows)
+            if pending:
+                inserted = psycopg2.extras.execute_values(
+                    cursor,
+                    f"INSERT INTO {self.table_name} ({', '.join(columns)}) VALUES %s RETURNING id",
+                    [rows[i] for i in pending],
+                    page_size=page_size,
+                    fetch=True
+                )
+                for i, r in zip(pending, inserted):
+                    record_ids[i] = r[0]
+                if rollups:
+                    self._apply_rollups(cursor, [rows[i] for i in pending])
+            conn.commit()
+            self._notify_write(columns, rows, record_ids)
+            return record_ids
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.release_connection(conn)
+
+    def insert_gift_rows(self, rows, page_size=500, skip_existing_tid=False):
+        """
+        批量写入 build_gift_row 生成的行，单个事务内使用多行 INSERT 完成。
+
+        Args:
+            rows: 行元组列表
+            page_size: 每条 INSERT 语句包含的最大行数
+            skip_existing_tid: 是否跳过 tid 已存在的记录（幂等写入）
+
+        Returns:
+            与 rows 顺序一致的记录ID列表，被跳过的行为 None
+        """
+        try:
+            record_ids = self._insert_rows(self.GIFT_V2_COLUMNS, rows, page_size, skip_existing_tid, rollups=True)
+            info(f"批量写入礼物记录成功, 数量: {sum(1 for r in record_ids if r is not None)}/{len(rows)}")
+            return record_ids
+        except Exception as e:
+            error(f"批量写入礼物记录失败: {e}")
+            raise
+
+    def insert_guard_rows(self, rows, page_size=500, skip_existing_tid=False):
+        """
+        批量写入 build_guard_row 生成的行，参数与返回值同 insert_gift_rows
+        """
+        try:
+            record_ids = self._insert_rows(self.GUARD_COLUMNS, rows, page_size, skip_existing_tid)
+            info(f"批量写入上舰记录成功, 数量: {sum(1 for r in record_ids if r is not None)}/{len(rows)}")
+            return record_ids
+        except Exception as e:
+            error(f"批量写入上舰记录失败: {e}")
+            raise
     
     def get_daily_summary(self, date=None):
         """
@@ -294,27 +527,13 @@ class DBHandler:
         
         debug(f"获取日汇总数据: date={date}")
         
+        start = datetime.datetime.strptime(str(date), "%Y-%m-%d").date()
+        
         conn = self.get_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
         try:
-            cursor.execute(
-                f'''
-                SELECT 
-                    room_id,
-                    COUNT(*) as gift_count,
-                    SUM(price) as total_price
-                FROM 
-                    {self.table_name}
-                WHERE 
-                    DATE(timestamp) = %s
-                GROUP BY 
-                    room_id
-                ORDER BY 
-                    total_price DESC
-                ''',
-                (date,)
-            )
+            cursor.execute(self._room_range_summary_sql(), (start, start + datetime.timedelta(days=1)))
             
             results = [dict(row) for row in cursor.fetchall()]
             info(f"日汇总数据获取成功: date={date}, 结果数量={len(results)}")
@@ -325,8 +544,74 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
     
+    @staticmethod
+    def _week_range(year, week):
+        """ISO 周（周一为第一天）对应的日期区间 [start, end)"""
+        start = datetime.date.fromisocalendar(int(year), int(week), 1)
+        return start, start + datetime.timedelta(days=7)
+
+    @staticmethod
+    def _month_range(year, month):
+        """自然月对应的日期区间 [start, end)"""
+        start = datetime.date(int(year), int(month), 1)
+        end = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        return start, end
+
+    @classmethod
+    def _period_range(cls, period, today=None):
+        """
+        截至今天的时间段对应的日期区间 [start, end)
+        :param period: "day" / "week" / "month" / "year"，其他值返回 None（所有时间）
+        """
+        today = today or datetime.date.today()
+        if period == "day":
+            return today, today + datetime.timedelta(days=1)
+        if period == "week":
+            start = today - datetime.timedelta(days=today.weekday())
+            return start, start + datetime.timedelta(days=7)
+        if period == "month":
+            return cls._month_range(today.year, today.month)
+        if period == "year":
+            return datetime.date(today.year, 1, 1), datetime.date(today.year + 1, 1, 1)
+        return None
+
+    def _room_range_summary_sql(self):
+        """
+        按区间 [start, end) 统计各房间礼物（日/周/月汇总共用）。
+        区间在 Python 中计算好后直接比较时间列，可以使用时间索引（不要对列套用 DATE()/EXTRACT()）
+        """
+        if self.use_rollups:
+            return f'''
+                SELECT 
+                    room_id,
+                    SUM(gift_count)::BIGINT as gift_count,
+                    SUM(total_price)::BIGINT as total_price
+                FROM 
+                    {self.room_daily_table}
+                WHERE 
+                    bucket >= %s AND bucket < %s
+                GROUP BY 
+                    room_id
+                ORDER BY 
+                    total_price DESC
+            '''
+        return f'''
+            SELECT 
+                room_id,
+                COUNT(*) as gift_count,
+                SUM(price) as total_price
+            FROM 
+                {self.table_name}
+            WHERE 
+                timestamp >= %s AND timestamp < %s
+            GROUP BY 
+                room_id
+            ORDER BY 
+                total_price DESC
+        '''
+
     def get_weekly_summary(self, year=None, week=None):
         """
         获取指定周的礼物汇总
@@ -340,34 +625,19 @@ class DBHandler:
         """
         now = datetime.datetime.now()
         if year is None:
-            year = now.year
+            year = now.isocalendar()[0]  # ISO 周所属年份（跨年周可能与自然年不同）
         if week is None:
             week = now.isocalendar()[1]  # ISO周数
         
         debug(f"获取周汇总数据: year={year}, week={week}")
         
+        start, end = self._week_range(year, week)
+        
         conn = self.get_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
         try:
-            cursor.execute(
-                f'''
-                SELECT 
-                    room_id,
-                    COUNT(*) as gift_count,
-                    SUM(price) as total_price
-                FROM 
-                    {self.table_name}
-                WHERE 
-                    EXTRACT(YEAR FROM timestamp) = %s AND
-                    EXTRACT(WEEK FROM timestamp) = %s
-                GROUP BY 
-                    room_id
-                ORDER BY 
-                    total_price DESC
-                ''',
-                (year, week)
-            )
+            cursor.execute(self._room_range_summary_sql(), (start, end))
             
             results = [dict(row) for row in cursor.fetchall()]
             info(f"周汇总数据获取成功: year={year}, week={week}, 结果数量={len(results)}")
@@ -378,7 +648,7 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
     
     def get_monthly_summary(self, year=None, month=None):
         """
@@ -399,28 +669,13 @@ class DBHandler:
         
         debug(f"获取月汇总数据: year={year}, month={month}")
         
+        start, end = self._month_range(year, month)
+        
         conn = self.get_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
         try:
-            cursor.execute(
-                f'''
-                SELECT 
-                    room_id,
-                    COUNT(*) as gift_count,
-                    SUM(price) as total_price
-                FROM 
-                    {self.table_name}
-                WHERE 
-                    EXTRACT(YEAR FROM timestamp) = %s AND
-                    EXTRACT(MONTH FROM timestamp) = %s
-                GROUP BY 
-                    room_id
-                ORDER BY 
-                    total_price DESC
-                ''',
-                (year, month)
-            )
+            cursor.execute(self._room_range_summary_sql(), (start, end))
             
             results = [dict(row) for row in cursor.fetchall()]
             info(f"月汇总数据获取成功: year={year}, month={month}, 结果数量={len(results)}")
@@ -431,8 +686,17 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
     
+    def _contribution_source(self):
+        """
+        用户维度查询的数据来源：启用汇总表时读取 (room_id, uid, 日期) 汇总，否则扫描原始记录
+        :return: (表名, 数量表达式, 总价表达式, 时间列)
+        """
+        if self.use_rollups:
+            return (self.user_daily_table, "SUM(gift_count)::BIGINT", "SUM(total_price)::BIGINT", "bucket")
+        return (self.table_name, "COUNT(*)", "SUM(price)", "timestamp")
+
     def get_user_contribution(self, uid):
         """
         获取指定用户的历史贡献
@@ -448,6 +712,8 @@ class DBHandler:
         conn = self.get_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
+        source, count_expr, sum_expr, time_col = self._contribution_source()
+
         try:
             # 获取总贡献
             cursor.execute(
@@ -455,10 +721,10 @@ class DBHandler:
                 SELECT 
                     uid,
                     MAX(uname) as uname,
-                    COUNT(*) as total_gifts,
-                    SUM(price) as total_price
+                    {count_expr} as total_gifts,
+                    {sum_expr} as total_price
                 FROM 
-                    {self.table_name}
+                    {source}
                 WHERE 
                     uid = %s
                 GROUP BY 
@@ -474,10 +740,10 @@ class DBHandler:
                 f'''
                 SELECT 
                     room_id,
-                    COUNT(*) as gift_count,
-                    SUM(price) as room_total
+                    {count_expr} as gift_count,
+                    {sum_expr} as room_total
                 FROM 
-                    {self.table_name}
+                    {source}
                 WHERE 
                     uid = %s
                 GROUP BY 
@@ -494,12 +760,12 @@ class DBHandler:
             cursor.execute(
                 f'''
                 SELECT 
-                    EXTRACT(YEAR FROM timestamp) as year,
-                    EXTRACT(MONTH FROM timestamp) as month,
-                    COUNT(*) as gift_count,
-                    SUM(price) as month_total
+                    EXTRACT(YEAR FROM {time_col}) as year,
+                    EXTRACT(MONTH FROM {time_col}) as month,
+                    {count_expr} as gift_count,
+                    {sum_expr} as month_total
                 FROM 
-                    {self.table_name}
+                    {source}
                 WHERE 
                     uid = %s
                 GROUP BY 
@@ -526,7 +792,7 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
     
     def get_top_contributors(self, room_id=None, limit=10, period=None):
         """
@@ -545,15 +811,17 @@ class DBHandler:
         conn = self.get_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
+        source, count_expr, sum_expr, time_col = self._contribution_source()
+
         try:
             query = f'''
                 SELECT 
                     uid,
                     MAX(uname) as uname,
-                    COUNT(*) as gift_count,
-                    SUM(price) as total_price
+                    {count_expr} as gift_count,
+                    {sum_expr} as total_price
                 FROM 
-                    {self.table_name}
+                    {source}
                 WHERE 
                     1=1
             '''
@@ -565,14 +833,10 @@ class DBHandler:
                 params.append(room_id)
             
             # 添加时间段筛选条件
-            if period == "day":
-                query += " AND DATE(timestamp) = CURRENT_DATE"
-            elif period == "week":
-                query += " AND timestamp >= date_trunc('week', CURRENT_DATE)"
-            elif period == "month":
-                query += " AND timestamp >= date_trunc('month', CURRENT_DATE)"
-            elif period == "year":
-                query += " AND timestamp >= date_trunc('year', CURRENT_DATE)"
+            period_range = self._period_range(period)
+            if period_range is not None:
+                query += f" AND {time_col} >= %s AND {time_col} < %s"
+                params.extend(period_range)
             
             # 分组和排序
             query += '''
@@ -595,7 +859,7 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close()
+            self.release_connection(conn)
             
     def get_gift_trend(self, room_id=None, days=30):
         """
@@ -613,18 +877,27 @@ class DBHandler:
         conn = self.get_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
+        if self.use_rollups:
+            source, count_expr, sum_expr, time_col, day_expr = (
+                self.room_daily_table, "SUM(gift_count)::BIGINT", "SUM(total_price)::BIGINT", "bucket", "bucket"
+            )
+        else:
+            source, count_expr, sum_expr, time_col, day_expr = (
+                self.table_name, "COUNT(*)", "SUM(price)", "timestamp", "DATE(timestamp)"
+            )
+
         try:
             query = f'''
                 SELECT 
-                    DATE(timestamp) as date,
-                    COUNT(*) as gift_count,
-                    SUM(price) as total_price
+                    {day_expr} as date,
+                    {count_expr} as gift_count,
+                    {sum_expr} as total_price
                 FROM 
-                    {self.table_name}
+                    {source}
                 WHERE 
-                    timestamp >= CURRENT_DATE - INTERVAL %s DAY
+                    {time_col} >= %s
             '''
-            params = [days]
+            params = [datetime.date.today() - datetime.timedelta(days=int(days))]
             
             # 添加房间筛选条件
             if room_id:
@@ -650,4 +923,216 @@ class DBHandler:
             raise
         finally:
             cursor.close()
-            conn.close() 
\ No newline at end of file
+            self.release_connection(conn)
+
+    def get_hourly_trend(self, room_id=None, hours=24):
+        """
+        获取最近若干小时的礼物趋势（按小时统计，包含当前小时）
+
+        Args:
+            room_id: 房间ID，可选，如果提供则只查询特定房间
+            hours: 小时数
+
+        Returns:
+            包含每小时礼物统计的字典列表
+        """
+        debug(f"获取小时礼物趋势: room_id={room_id}, hours={hours}")
+
+        conn = self.get_connection()
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+        if self.use_rollups:
+            source, count_expr, sum_expr, time_col, hour_expr = (
+                self.room_hourly_table, "SUM(gift_count)::BIGINT", "SUM(total_price)::BIGINT", "bucket", "bucket"
+            )
+        else:
+            source, count_expr, sum_expr, time_col, hour_expr = (
+                self.table_name, "COUNT(*)", "SUM(price)", "timestamp", "date_trunc('hour', timestamp)"
+            )
+
+        try:
+            query = f'''
+                SELECT
+                    {hour_expr} as hour,
+                    {count_expr} as gift_count,
+                    {sum_expr} as total_price
+                FROM
+                    {source}
+                WHERE
+                    {time_col} >= %s
+            '''
+            current_hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+            params = [current_hour - datetime.timedelta(hours=int(hours) - 1)]
+
+            if room_id:
+                query += " AND room_id = %s"
+                params.append(room_id)
+
+            query += '''
+                GROUP BY
+                    hour
+                ORDER BY
+                    hour ASC
+            '''
+
+            cursor.execute(query, params)
+
+            results = [dict(row) for row in cursor.fetchall()]
+            info(f"小时礼物趋势查询成功: room_id={room_id}, hours={hours}, 结果数量={len(results)}")
+            return results
+
+        except Exception as e:
+            error(f"获取小时礼物趋势失败: {e}")
+            raise
+        finally:
+            cursor.close()
+            self.release_connection(conn)
+
+    def get_room_dashboard(self, room_id, period=None, top_limit=10, trend_days=30):
+        """
+        获取单个房间的看板数据：时间段内统计、历史顶级贡献者、最近 N 天趋势。
+        三部分在一条 SQL（CTE）中完成，全部按房间过滤，只需一次数据库往返。
+        
+        Args:
+            room_id: 房间ID
+            period: 统计时间段，可选值："day", "week", "month", "year", None(所有时间)
+            top_limit: 顶级贡献者数量
+            trend_days: 趋势天数
+            
+        Returns:
+            {"room_id", "period", "stats": {...}, "top_users": [...], "trend": [...]}
+        """
+        debug(f"获取房间看板: room_id={room_id}, period={period}")
+        
+        if self.use_rollups:
+            room_source, user_source = self.room_daily_table, self.user_daily_table
+            count_expr, sum_expr, time_col, day_expr = (
+                "SUM(gift_count)", "SUM(total_price)", "bucket", "bucket"
+            )
+        else:
+            room_source = user_source = self.table_name
+            count_expr, sum_expr, time_col, day_expr = (
+                "COUNT(*)", "SUM(price)", "timestamp", "DATE(timestamp)"
+            )
+        
+        params = {
+            "room_id": str(room_id),
+            "limit": int(top_limit),
+            "trend_start": datetime.date.today() - datetime.timedelta(days=int(trend_days)),
+        }
+        period_filter = ""
+        period_range = self._period_range(period)
+        if period_range is not None:
+            period_filter = f"AND {time_col} >= %(start)s AND {time_col} < %(end)s"
+            params["start"], params["end"] = period_range
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                f'''
+                WITH stats AS (
+                    SELECT 
+                        %(room_id)s as room_id,
+                        COALESCE({count_expr}, 0)::BIGINT as gift_count,
+                        COALESCE({sum_expr}, 0)::BIGINT as total_price
+                    FROM 
+                        {room_source}
+                    WHERE 
+                        room_id = %(room_id)s {period_filter}
+                ),
+                top_users AS (
+                    SELECT 
+                        uid,
+                        MAX(uname) as uname,
+                        {count_expr}::BIGINT as gift_count,
+                        {sum_expr}::BIGINT as total_price
+                    FROM 
+                        {user_source}
+                    WHERE 
+                        room_id = %(room_id)s
+                    GROUP BY 
+                        uid
+                    ORDER BY 
+                        total_price DESC
+                    LIMIT %(limit)s
+                ),
+                trend AS (
+                    SELECT 
+                        {day_expr} as date,
+                        {count_expr}::BIGINT as gift_count,
+                        {sum_expr}::BIGINT as total_price
+                    FROM 
+                        {room_source}
+                    WHERE 
+                        room_id = %(room_id)s AND {time_col} >= %(trend_start)s
+                    GROUP BY 
+                        1
+                )
+                SELECT 
+                    (SELECT row_to_json(stats) FROM stats),
+                    (SELECT COALESCE(json_agg(top_users ORDER BY total_price DESC), '[]'::json) FROM top_users),
+                    (SELECT COALESCE(json_agg(trend ORDER BY date), '[]'::json) FROM trend)
+                ''',
+                params
+            )
+            
+            stats, top_users, trend = cursor.fetchone()
+            info(f"房间看板获取成功: room_id={room_id}, period={period}, 贡献者数量={len(top_users)}, 趋势天数={len(trend)}")
+            return {
+                "room_id": str(room_id),
+                "period": period or "all",
+                "stats": stats,
+                "top_users": top_users,
+                "trend": trend
+            }
+            
+        except Exception as e:
+            error(f"获取房间看板失败: {e}")
+            raise
+        finally:
+            cursor.close()
+            self.release_connection(conn)
+
+    def get_records_after(self, after_id, columns, room_ids=None, limit=500, include_ids=None):
+        """
+        按 ID 升序读取 ID 大于 after_id 的记录（用于实时推送断线续传、排行榜追加读取）
+        
+        Args:
+            after_id: 起始记录ID（不含）
+            columns: 需要返回的列
+            room_ids: 房间ID列表，可选
+            limit: 返回的最大记录数
+            include_ids: 同时读取的其他记录ID（例如之前尚未提交的记录），可选
+            
+        Returns:
+            记录字典列表
+        """
+        debug(f"读取新记录: table={self.table_name}, after_id={after_id}, room_ids={room_ids}, limit={limit}")
+        
+        conn = self.get_connection()
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        try:
+            if include_ids:
+                query = f"SELECT {', '.join(columns)} FROM {self.table_name} WHERE (id > %s OR id = ANY(%s))"
+                params = [int(after_id), [int(record_id) for record_id in include_ids]]
+            else:
+                query = f"SELECT {', '.join(columns)} FROM {self.table_name} WHERE id > %s"
+                params = [int(after_id)]
+            if room_ids:
+                query += " AND room_id = ANY(%s)"
+                params.append([str(room_id) for room_id in room_ids])
+            query += " ORDER BY id LIMIT %s"
+            params.append(int(limit))
+            
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+            
+        except Exception as e:
+            error(f"读取新记录失败: {e}")
+            raise
+        finally:
+            cursor.close()
+            self.release_connection(conn)
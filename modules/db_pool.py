@@ -0,0 +1,178 @@
+"""
+PostgreSQL 连接池模块
+进程内共享的线程安全连接池，DBHandler、gift_api 以及 app 均从这里获取连接，
+避免每次调用都重新建立连接与认证。
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from modules.logger import debug, info, warning, error
+
+
+def load_db_config():
+    """
+    从环境变量读取数据库连接信息（需先 load_dotenv）
+    """
+    return {
+        "host": os.getenv("DB_HOST"),
+        "port": os.getenv("DB_PORT"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASS"),
+        "database": os.getenv("DB_NAME")
+    }
+
+
+class DBConnectionPool:
+    """
+    在 psycopg2 ThreadedConnectionPool 基础上增加：
+    - 连接耗尽时阻塞等待（而不是直接抛出 PoolError）
+    - 取出空闲较久的连接时先 ping 一次（pre-ping），失效连接自动丢弃重建
+    - 归还时回滚未结束的事务，保证下一个使用者拿到干净的连接
+    """
+    def __init__(self, db_config, minconn=1, maxconn=10, pre_ping=True, ping_interval=30.0, acquire_timeout=10.0):
+        """
+        :param db_config: psycopg2.connect 的参数
+        :param minconn: 最小连接数
+        :param maxconn: 最大连接数
+        :param pre_ping: 是否在取出连接时检查连接是否可用
+        :param ping_interval: 连接空闲超过该秒数才执行 ping，避免每次都多一次往返
+        :param acquire_timeout: 连接耗尽时最长等待时间（秒）
+        """
+        self.db_config = dict(db_config)
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self.pre_ping = pre_ping
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.db_config)
+        # 控制同时借出的连接数，超出时阻塞等待
+        self.slots = threading.BoundedSemaphore(self.maxconn)
+        # id(conn) -> 上次归还时间
+        self.last_used = {}
+        self.last_used_lock = threading.Lock()
+
+        info(f"数据库连接池初始化完成: min={self.minconn}, max={self.maxconn}, pre_ping={self.pre_ping}")
+
+    def _is_healthy(self, conn):
+        """检查连接是否仍然可用"""
+        if conn.closed:
+            return False
+        if not self.pre_ping:
+            return True
+        with self.last_used_lock:
+            idle = time.time() - self.last_used.get(id(conn), 0.0)
+        if idle < self.ping_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            warning(f"数据库连接检查失败，丢弃该连接: {e}")
+            return False
+
+    def getconn(self):
+        """
+        借出一个可用连接，用完必须调用 putconn 归还
+        """
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise psycopg2.pool.PoolError(f"数据库连接池已耗尽（等待 {self.acquire_timeout} 秒超时）")
+        try:
+            # 最多尝试 maxconn + 1 次，把池中的失效连接逐个替换掉
+            for _ in range(self.maxconn + 1):
+                conn = self.pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self.pool.putconn(conn, close=True)
+            raise psycopg2.OperationalError("无法从连接池获取可用的数据库连接")
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """
+        归还连接；未结束的事务会被回滚，连接异常时直接关闭
+        """
+        try:
+            if not conn.closed and not close:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except Exception as e:
+            warning(f"归还数据库连接时回滚失败，关闭该连接: {e}")
+            close = True
+
+        try:
+            with self.last_used_lock:
+                if close or conn.closed:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.time()
+            self.pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as conn: ...
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        try:
+            self.pool.closeall()
+        except Exception as e:
+            error(f"关闭数据库连接池失败: {e}")
+
+
+# 以连接参数为 key 的进程级共享连接池
+_shared_pools = {}
+_shared_pools_lock = threading.Lock()
+
+
+def get_db_pool(db_config=None):
+    """
+    获取进程内共享的连接池，相同连接参数只创建一次。
+    池大小等参数通过环境变量 DB_POOL_MIN / DB_POOL_MAX / DB_POOL_PRE_PING /
+    DB_POOL_PING_INTERVAL / DB_POOL_TIMEOUT 配置
+    """
+    if db_config is None:
+        db_config = load_db_config()
+    key = tuple(sorted((k, str(v)) for k, v in db_config.items()))
+    with _shared_pools_lock:
+        pool = _shared_pools.get(key)
+        if pool is None:
+            pool = DBConnectionPool(
+                db_config,
+                minconn=int(os.getenv("DB_POOL_MIN", 1)),
+                maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+                pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+                ping_interval=float(os.getenv("DB_POOL_PING_INTERVAL", 30)),
+                acquire_timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),
+            )
+            _shared_pools[key] = pool
+            debug(f"创建共享数据库连接池: host={db_config.get('host')}, database={db_config.get('database')}")
+        return pool
+
+
+def close_all_pools():
+    """关闭所有共享连接池（进程退出时调用）"""
+    with _shared_pools_lock:
+        for pool in _shared_pools.values():
+            pool.closeall()
+        _shared_pools.clear()
@@ -0,0 +1,60 @@
+"""
+死信文件与写库错误分类
+后台批量写库时，一条无法写入的数据（违反约束、数值溢出等）不能让整个队列无限重试。
+- is_transient_error 区分连接 / 数据库不可用等可以重试的错误，其余错误视为数据本身有问题
+- DeadLetterFile 把无法写入的数据追加到 JSON Lines 文件，并记录日志，便于人工排查后补录
+"""
+import datetime
+import json
+import os
+import threading
+
+import psycopg2
+import psycopg2.pool
+
+from modules.logger import error
+
+# 连接断开、数据库不可用、连接池耗尽等错误，与数据内容无关，稍后重试即可
+TRANSIENT_DB_ERRORS = (
+    psycopg2.OperationalError,
+    psycopg2.InterfaceError,
+    psycopg2.pool.PoolError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_transient_error(exc):
+    """是否为可以原样重试的错误；否则说明这批数据中有无法写入的行"""
+    return isinstance(exc, TRANSIENT_DB_ERRORS)
+
+
+class DeadLetterFile:
+    """追加写入的死信文件，每行一个 JSON 对象"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def write(self, record, exc, source):
+        """
+        记录一条无法写入的数据
+        :param record: 原始数据（行元组或事件字典），无法直接序列化的值转为字符串
+        :param exc: 写入时的异常
+        :param source: 来源，例如 "gift_write_buffer"
+        """
+        entry = {
+            "failed_at": datetime.datetime.now().isoformat(),
+            "source": source,
+            "error": f"{type(exc).__name__}: {exc}",
+            "record": record,
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.count += 1
+        error(f"{source} 有一条数据无法写入数据库，已写入死信文件 {self.path}: {entry['error']}")
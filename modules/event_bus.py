@@ -0,0 +1,294 @@
+"""
+进程内礼物 / 上舰事件总线
+礼物与上舰记录提交后（写入监听器）发布到总线，/api/gift/stream 通过 SSE 推送给浮层等客户端：
+- 订阅者可按房间、事件类型过滤
+- 每个订阅者有容量固定的队列，队列写满说明消费过慢，直接断开该订阅者，不拖慢写入与其他订阅者
+- 最近的事件保存在环形缓冲区中；客户端带 Last-Event-ID 重连时先从缓冲区补发，
+  缓冲区已覆盖不到的部分回退到按记录 ID 分页查询数据库；每类事件最多补发 resume_limit 条，
+  超出时发送 gap 事件，告知客户端中间有记录未补发（例如需要重新拉取排行等完整数据）
+事件 ID 为 "<礼物记录ID>:<上舰记录ID>"，即发送该事件时两张表各自已推送到的位置。
+注意：总线在进程内，多个 worker 时订阅者只能收到同一 worker 写入的事件。
+"""
+import datetime
+import json
+import os
+import threading
+from collections import deque
+
+from modules.db_handler import register_write_listener
+from modules.logger import warning
+
+# 各类事件推送的字段
+STREAM_COLUMNS = {
+    "gift": ("id", "timestamp", "room_id", "uid", "uname", "gift_id", "gift_name",
+             "price", "gift_num", "coin_type", "action"),
+    "guard": ("id", "timestamp", "room_id", "uid", "username", "guard_level", "count",
+              "price", "gift_name"),
+}
+EVENT_KINDS = tuple(STREAM_COLUMNS)
+# 从数据库补发时每页读取的记录数
+BACKFILL_PAGE_SIZE = 500
+
+
+def format_cursor(cursor):
+    return ":".join(str(cursor.get(kind, 0)) for kind in EVENT_KINDS)
+
+
+def parse_cursor(value):
+    """解析事件 ID，格式不正确时返回 None"""
+    parts = (value or "").strip().split(":")
+    if len(parts) != len(EVENT_KINDS):
+        return None
+    try:
+        return {kind: max(0, int(part)) for kind, part in zip(EVENT_KINDS, parts)}
+    except ValueError:
+        return None
+
+
+def format_sse(event, cursor):
+    """
+    把事件格式化为 SSE 消息，并把 cursor 推进到该事件（cursor 会被修改）
+    """
+    cursor[event["kind"]] = max(cursor.get(event["kind"], 0), event["id"])
+    return (
+        f"id: {format_cursor(cursor)}\n"
+        f"event: {event['kind']}\n"
+        f"data: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+    )
+
+
+def format_gap(gap, cursor):
+    """
+    把补发缺口格式化为 SSE gap 事件；截止位置已知时把 cursor 推进到截止位置（cursor 会被修改）
+    """
+    if gap["until_id"] is not None:
+        cursor[gap["kind"]] = max(cursor.get(gap["kind"], 0), gap["until_id"])
+    data = {"kind": gap["kind"], "after_id": gap["after_id"], "until_id": gap["until_id"]}
+    return (
+        f"id: {format_cursor(cursor)}\n"
+        f"event: gap\n"
+        f"data: {json.dumps(data)}\n\n"
+    )
+
+
+def _to_event(kind, record):
+    data = {}
+    for column in STREAM_COLUMNS[kind]:
+        value = record.get(column)
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.isoformat()
+        data[column] = value
+    data["room_id"] = str(data["room_id"]) if data["room_id"] is not None else None
+    return {"kind": kind, "id": int(record["id"]), "room_id": data["room_id"], "data": data}
+
+
+class Subscriber:
+    def __init__(self, rooms=None, kinds=None, queue_size=256, initial=()):
+        """
+        :param rooms: 订阅的房间ID集合，None 表示所有房间
+        :param kinds: 订阅的事件类型集合，None 表示所有类型
+        :param queue_size: 待发送事件的最大数量（包含 initial）
+        :param initial: 预先放入队列的事件（断线续传时从环形缓冲区补发的部分）
+        """
+        self.rooms = set(rooms) if rooms else None
+        self.kinds = set(kinds) if kinds else None
+        self.queue_size = queue_size
+        self.queue = deque(initial)
+        self.condition = threading.Condition()
+        self.dropped = False
+
+    def accepts(self, event):
+        return (self.kinds is None or event["kind"] in self.kinds) and \
+            (self.rooms is None or event["room_id"] in self.rooms)
+
+    def offer(self, event):
+        """放入事件；队列已满时返回 False（调用方断开该订阅者）"""
+        with self.condition:
+            if len(self.queue) >= self.queue_size:
+                self.dropped = True
+                self.condition.notify_all()
+                return False
+            self.queue.append(event)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout):
+        """
+        取出一个事件，超时返回 None；订阅者已被断开且队列为空时抛出 EOFError
+        """
+        with self.condition:
+            if not self.queue and not self.dropped:
+                self.condition.wait(timeout)
+            if self.queue:
+                return self.queue.popleft()
+            if self.dropped:
+                raise EOFError()
+            return None
+
+
+class EventBus:
+    def __init__(self, ring_size=2048, queue_size=256, max_subscribers=100, resume_limit=1000):
+        """
+        :param ring_size: 环形缓冲区保存的最近事件数
+        :param queue_size: 每个订阅者的队列容量
+        :param max_subscribers: 同时在线的最大订阅者数量
+        :param resume_limit: 断线续传时每类事件从数据库补发的最大条数
+        """
+        self.ring = deque(maxlen=max(1, int(ring_size)))
+        self.queue_size = max(1, int(queue_size))
+        self.max_subscribers = max_subscribers
+        self.resume_limit = resume_limit
+
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        # 事件类型 -> 已发布的最大记录ID
+        self.cursor = {kind: 0 for kind in EVENT_KINDS}
+        # 事件类型 -> 环形缓冲区无法覆盖的最大记录ID（未发布过时为 None，表示缓冲区不含任何历史）
+        self.floor = {kind: None for kind in EVENT_KINDS}
+        # 表名 -> 事件类型；事件类型 -> DBHandler（用于断线续传）
+        self.table_kinds = {}
+        self.sources = {}
+
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    def add_source(self, kind, db_handler):
+        """把一张表的写入作为某类事件发布"""
+        self.table_kinds[db_handler.table_name] = kind
+        self.sources[kind] = db_handler
+
+    def on_write(self, table_name, records):
+        """写入监听器"""
+        kind = self.table_kinds.get(table_name)
+        if kind is not None:
+            self.publish(kind, records)
+
+    def publish(self, kind, records):
+        """发布一批记录（记录需包含 id），队列已满的订阅者会被断开"""
+        events = [_to_event(kind, record) for record in records if record.get("id") is not None]
+        if not events:
+            return
+        with self.lock:
+            for event in events:
+                if self.floor[kind] is None:
+                    self.floor[kind] = event["id"] - 1
+                if len(self.ring) == self.ring.maxlen:
+                    evicted = self.ring[0]
+                    self.floor[evicted["kind"]] = max(self.floor[evicted["kind"]], evicted["id"])
+                self.cursor[kind] = max(self.cursor[kind], event["id"])
+                self.ring.append(event)
+            self.published += len(events)
+            subscribers = list(self.subscribers)
+
+        slow = []
+        for subscriber in subscribers:
+            for event in events:
+                if subscriber.accepts(event) and not subscriber.offer(event):
+                    slow.append(subscriber)
+                    break
+        if slow:
+            with self.lock:
+                for subscriber in slow:
+                    if subscriber in self.subscribers:
+                        self.subscribers.discard(subscriber)
+                        self.dropped_subscribers += 1
+            warning(f"事件推送: {len(slow)} 个订阅者消费过慢，已断开")
+
+    def subscribe(self, rooms=None, kinds=None, after=None):
+        """
+        注册订阅者
+        :param after: 断线续传的起始位置 {事件类型: 记录ID}，None 表示只接收新事件
+        :return: (订阅者, 需要从数据库补发的 {事件类型: (起始ID, 截止ID 或 None)}, 起始位置)；
+                 订阅者数量已达上限时返回 (None, None, None)
+        """
+        rooms = set(rooms) if rooms else None
+        kinds = set(kinds) if kinds else None
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None, None, None
+            backfill = {}
+            replay = []
+            if after is not None:
+                for kind in EVENT_KINDS:
+                    if kinds is not None and kind not in kinds:
+                        continue
+                    floor = self.floor[kind]
+                    if floor is None or after[kind] < floor:
+                        backfill[kind] = (after[kind], floor)
+                replay = [
+                    event for event in self.ring
+                    if event["id"] > after[event["kind"]]
+                    and (kinds is None or event["kind"] in kinds)
+                    and (rooms is None or event["room_id"] in rooms)
+                ]
+            # 缓冲区中补发的事件预先放入队列，队列容量在此之外另留 queue_size 给新事件
+            subscriber = Subscriber(rooms, kinds, self.queue_size + len(replay), replay)
+            self.subscribers.add(subscriber)
+            start = dict(after) if after is not None else dict(self.cursor)
+        return subscriber, backfill, start
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def load_backfill(self, kind, after_id, until_id, rooms=None):
+        """
+        按页从数据库读取缓冲区未覆盖的记录（生成器），逐个产出事件，最多 resume_limit 条。
+        超出上限时最后产出一个缺口 {"gap": True, "kind", "after_id", "until_id"}，
+        表示 (after_id, until_id] 中的记录没有补发（until_id 为 None 表示直到实时事件为止）
+        """
+        db_handler = self.sources.get(kind)
+        if db_handler is None:
+            return
+        sent = 0
+        while True:
+            # 多读一条，用来判断是否超出上限
+            page_size = min(BACKFILL_PAGE_SIZE, self.resume_limit - sent + 1)
+            records = db_handler.get_records_after(
+                after_id, STREAM_COLUMNS[kind], room_ids=sorted(rooms) if rooms else None, limit=page_size
+            )
+            for record in records:
+                if until_id is not None and record["id"] > until_id:
+                    return
+                if sent >= self.resume_limit:
+                    warning(f"事件推送续传超过上限 {self.resume_limit} 条，发送 gap 事件: kind={kind}, after_id={after_id}")
+                    yield {"gap": True, "kind": kind, "after_id": after_id, "until_id": until_id}
+                    return
+                yield _to_event(kind, record)
+                sent += 1
+                after_id = record["id"]
+            if len(records) < page_size:
+                return
+
+    def current_cursor(self):
+        with self.lock:
+            return dict(self.cursor)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "published": self.published,
+                "dropped_subscribers": self.dropped_subscribers,
+                "ring_size": len(self.ring),
+                "cursor": format_cursor(self.cursor),
+            }
+
+
+_event_bus = None
+_event_bus_lock = threading.Lock()
+
+
+def get_event_bus():
+    """获取进程内共享的事件总线（首次调用时创建并注册写入监听器）"""
+    global _event_bus
+    with _event_bus_lock:
+        if _event_bus is None:
+            _event_bus = EventBus(
+                ring_size=int(os.getenv("EVENT_STREAM_RING_SIZE", 2048)),
+                queue_size=int(os.getenv("EVENT_STREAM_QUEUE_SIZE", 256)),
+                max_subscribers=int(os.getenv("EVENT_STREAM_MAX_SUBSCRIBERS", 100)),
+                resume_limit=int(os.getenv("EVENT_STREAM_RESUME_LIMIT", 1000)),
+            )
+            register_write_listener(_event_bus.on_write)
+        return _event_bus
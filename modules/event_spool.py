@@ -0,0 +1,527 @@
+"""
+礼物 / 上舰事件本地 spool（预写日志）
+/money、/guard 先把事件追加到本地分段文件并 fsync，然后立即返回；后台重放线程再把事件批量写入数据库。
+数据库变慢或宕机时事件留在磁盘上，恢复后自动补写，接口延迟不再依赖数据库延迟。
+
+文件格式：
+- 分段文件 <dir>/<slot>/spool-<序号>.seg，写满 segment_max_bytes 后切换到下一段
+- 每条记录为 4 字节长度 + 4 字节 CRC32（大端）+ UTF-8 JSON
+- 重放进度保存在 checkpoint.json（段序号 + 字节偏移），已重放完的段会被删除
+- 一批事件因数据错误写库失败时逐条重放，无法写入的事件写入槽位目录下的 dead_letter.jsonl 后跳过，
+  不会卡住后续事件；连接断开等临时错误则整批稍后重试
+
+并发：
+- 同一进程内多个请求并发追加时合并 fsync（group commit），一次 fsync 确认一批记录
+- 多个 worker 进程各自占用一个槽位目录（slot-0、slot-1 ...，用文件锁互斥），
+  进程重启后会重新占用空闲槽位并继续重放上次遗留的数据
+- worker 数量减少或 max_slots 调小后，多出来的槽位没有进程占用；重放线程空闲时定期扫描，
+  对未加锁且仍有分段的槽位加锁并重放完，不会遗留数据
+"""
+import os
+import json
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from modules.dead_letter import DeadLetterFile, is_transient_error
+from modules.logger import debug, info, warning, error
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只使用第一个槽位
+    fcntl = None
+
+HEADER = struct.Struct(">II")
+SEGMENT_PREFIX = "spool-"
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint.json"
+LOCK_FILE = "slot.lock"
+DEAD_LETTER_FILE = "dead_letter.jsonl"
+
+
+class SpoolError(RuntimeError):
+    """事件无法写入本地 spool"""
+
+
+def _segment_name(index):
+    return f"{SEGMENT_PREFIX}{index:010d}{SEGMENT_SUFFIX}"
+
+
+def _encode_record(event):
+    data = json.dumps(event, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def read_records(path, offset=0, limit=None):
+    """
+    从分段文件的 offset 处读取完整记录
+    :return: (事件列表, 读到的结束偏移, 是否遇到损坏/不完整的记录)
+    """
+    events = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while limit is None or len(events) < limit:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return events, offset, len(header) > 0
+            length, crc = HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                return events, offset, True
+            try:
+                events.append(json.loads(data.decode("utf-8")))
+            except ValueError:
+                return events, offset, True
+            offset += HEADER.size + length
+    return events, offset, False
+
+
+class SpoolSlot:
+    """
+    一个槽位目录的重放状态：检查点、死信文件以及逐批 / 逐条重放。
+    调用方需持有该槽位的文件锁
+    """
+    def __init__(self, directory, handler, replay_batch_size, lock_file=None):
+        self.directory = directory
+        self.handler = handler
+        self.replay_batch_size = replay_batch_size
+        self.lock_file = lock_file
+        self.checkpoint = self._load_checkpoint()
+        self.replayed = 0
+        self.dead_letter = DeadLetterFile(os.path.join(self.directory, DEAD_LETTER_FILE))
+
+    def list_segments(self):
+        indexes = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    indexes.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(indexes)
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, _segment_name(index))
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return int(data.get("segment", 0)), int(data.get("offset", 0))
+        except FileNotFoundError:
+            return 0, 0
+        except Exception as e:
+            warning(f"读取事件 spool 检查点失败，从头重放（写库是幂等的）: {e}")
+            return 0, 0
+
+    def _save_checkpoint(self, segment, offset):
+        """原子写入重放进度"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".checkpoint.", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, CHECKPOINT_FILE))
+        self.checkpoint = (segment, offset)
+
+    def replay_once(self, active=None):
+        """
+        重放一批事件
+        :param active: 正在写入的分段序号；None 表示槽位没有写入者，所有分段都已写完
+        :return: 本次重放的事件数
+        """
+        segment, offset = self.checkpoint
+
+        for index in self.list_segments():
+            if index < segment:
+                # 早于检查点的分段已重放完，清理残留
+                os.remove(self.segment_path(index))
+                continue
+            if index > segment:
+                segment, offset = index, 0
+
+            events, end, broken = read_records(self.segment_path(index), offset, self.replay_batch_size)
+            if events:
+                try:
+                    self.handler(events)
+                except Exception as e:
+                    if is_transient_error(e):
+                        raise
+                    warning(f"事件 spool 批量重放失败，逐条重放以定位无法写入的事件: {e}")
+                    return self._replay_isolated(index, offset, len(events))
+                self._save_checkpoint(index, end)
+                self.replayed += len(events)
+                return len(events)
+
+            if active is not None and index >= active:
+                # 正在写入的分段：记录可能还没写完，等下次再读
+                return 0
+            if broken:
+                error(f"事件 spool 分段 {_segment_name(index)} 在偏移 {end} 处损坏，跳过剩余内容")
+            # 分段已重放完且不会再有写入，推进到下一段并删除
+            self._save_checkpoint(index + 1, 0)
+            os.remove(self.segment_path(index))
+            segment, offset = index + 1, 0
+        return 0
+
+    def _replay_isolated(self, index, offset, count):
+        """
+        从 offset 开始逐条重放 count 个事件，每条之后保存检查点；
+        数据错误的事件写入死信文件后跳过，临时错误向上抛出，从当前检查点稍后重试
+        :return: 处理的事件数
+        """
+        path = self.segment_path(index)
+        handled = 0
+        while handled < count:
+            events, end, _ = read_records(path, offset, 1)
+            if not events:
+                break
+            try:
+                self.handler(events)
+                self.replayed += 1
+            except Exception as e:
+                if is_transient_error(e):
+                    raise
+                self.dead_letter.write(events[0], e, "event_spool")
+            self._save_checkpoint(index, end)
+            offset = end
+            handled += 1
+        return handled
+
+    def pending_bytes(self):
+        """尚未重放的字节数（近似值）"""
+        segment, offset = self.checkpoint
+        total = 0
+        for index in self.list_segments():
+            if index < segment:
+                continue
+            try:
+                size = os.path.getsize(self.segment_path(index))
+            except OSError:
+                continue
+            total += size - offset if index == segment else size
+        return max(0, total)
+
+    def release(self):
+        """释放槽位文件锁"""
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class EventSpool:
+    def __init__(self, directory, handler, segment_max_bytes=64 * 1024 * 1024,
+                 replay_batch_size=500, replay_interval=0.2, max_backoff=30.0, max_slots=64,
+                 orphan_scan_interval=30.0):
+        """
+        :param directory: spool 根目录
+        :param handler: 重放回调 handler(events)，需要幂等；抛出临时错误时这批事件稍后重试，
+                        其他异常时逐条重放，仍然失败的事件写入死信文件
+        :param segment_max_bytes: 单个分段文件的最大字节数
+        :param replay_batch_size: 每次重放的最大事件数
+        :param replay_interval: 没有新事件时重放线程的轮询间隔（秒）
+        :param max_backoff: 重放失败后重试等待的上限（秒）
+        :param max_slots: 最多尝试的槽位数量
+        :param orphan_scan_interval: 扫描无人占用且有遗留数据的槽位的间隔（秒）
+        """
+        self.root = directory
+        self.handler = handler
+        self.segment_max_bytes = max(1024, int(segment_max_bytes))
+        self.replay_batch_size = max(1, int(replay_batch_size))
+        self.replay_interval = replay_interval
+        self.max_backoff = max_backoff
+        self.orphan_scan_interval = orphan_scan_interval
+
+        self.slot = self._acquire_slot(directory, max_slots)
+        self.directory = self.slot.directory
+
+        # 写入状态（condition 内部的锁保护以下字段）
+        self.condition = threading.Condition(threading.Lock())
+        self.write_file = None
+        self.write_index = 0
+        self.write_size = 0
+        self.written_seq = 0
+        self.synced_seq = 0
+        self.syncing = False
+        self.closed = False
+
+        # 重放状态
+        self.failed_replays = 0
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        # 正在重放的无主槽位，以及已重放完的无主槽位的累计数据
+        self.orphan = None
+        self.next_orphan_scan = 0.0
+        self.orphan_replayed = 0
+        self.orphan_dead_lettered = 0
+
+        existing = self.slot.list_segments()
+        # 分段已全部重放删除时，新分段序号不能落在检查点之前，否则会被当作已重放的残留删除
+        self._open_segment(max((existing[-1] + 1) if existing else 1, self.slot.checkpoint[0]))
+        if existing:
+            info(f"事件 spool 发现 {len(existing)} 个未重放完的分段，将继续写入数据库: {self.directory}")
+
+        self.replayer = threading.Thread(target=self._replay_loop, name="event-spool-replayer", daemon=True)
+        self.replayer.start()
+        info(f"事件 spool 已启动: {self.directory}")
+
+    @property
+    def replayed(self):
+        return self.slot.replayed
+
+    @property
+    def dead_letter(self):
+        return self.slot.dead_letter
+
+    # ---------- 槽位 ----------
+
+    def _try_lock(self, path):
+        """尝试对槽位目录加锁，成功时返回已加锁的文件，槽位已被占用时返回 None"""
+        os.makedirs(path, exist_ok=True)
+        lock_file = open(os.path.join(path, LOCK_FILE), "a")
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _acquire_slot(self, directory, max_slots):
+        """占用一个空闲槽位目录，保证每个分段文件只有一个写入者和一个重放者"""
+        for slot in range(max_slots if fcntl is not None else 1):
+            path = os.path.join(directory, f"slot-{slot}")
+            lock_file = self._try_lock(path)
+            if lock_file is not None:
+                return SpoolSlot(path, self.handler, self.replay_batch_size, lock_file)
+        raise SpoolError(f"没有可用的 spool 槽位: {directory}")
+
+    def _claim_orphan(self):
+        """
+        查找没有进程占用、但仍有分段文件的槽位并加锁（不限于 max_slots 以内）
+        :return: SpoolSlot，没有时返回 None
+        """
+        if fcntl is None:
+            return None
+        try:
+            names = sorted(os.listdir(self.root))
+        except OSError:
+            return None
+        for name in names:
+            path = os.path.join(self.root, name)
+            if not name.startswith("slot-") or path == self.directory or not os.path.isdir(path):
+                continue
+            if not any(n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX) for n in os.listdir(path)):
+                continue
+            lock_file = self._try_lock(path)
+            if lock_file is None:
+                continue
+            orphan = SpoolSlot(path, self.handler, self.replay_batch_size, lock_file)
+            if not orphan.list_segments():
+                # 加锁前已被其他进程重放完
+                orphan.release()
+                continue
+            info(f"事件 spool 发现无进程占用的槽位，开始重放遗留数据: {path}")
+            return orphan
+        return None
+
+    def _replay_orphan(self):
+        """
+        重放一批无主槽位中的事件
+        :return: 本次重放的事件数
+        """
+        if self.orphan is None:
+            if time.time() < self.next_orphan_scan:
+                return 0
+            self.next_orphan_scan = time.time() + self.orphan_scan_interval
+            self.orphan = self._claim_orphan()
+            if self.orphan is None:
+                return 0
+        count = self.orphan.replay_once()
+        if count == 0:
+            # 没有写入者，返回 0 说明所有分段都已重放并删除
+            info(f"事件 spool 无主槽位已重放完，共 {self.orphan.replayed} 条事件: {self.orphan.directory}")
+            self.orphan_replayed += self.orphan.replayed
+            self.orphan_dead_lettered += self.orphan.dead_letter.count
+            self.orphan.release()
+            self.orphan = None
+            # 继续查找下一个无主槽位
+            self.next_orphan_scan = 0.0
+        return count
+
+    # ---------- 写入 ----------
+
+    def _segment_path(self, index):
+        return self.slot.segment_path(index)
+    def _open_segment(self, index):
+        """打开新的分段文件（调用方持有锁或处于初始化阶段）"""
+        self.write_file = open(self._segment_path(index), "ab")
+        self.write_index = index
+        self.write_size = self.write_file.tell()
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        """新建文件后同步目录项，保证掉电后文件仍然存在"""
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _rotate(self):
+        """当前分段写满后切换到下一段（调用方持有锁）"""
+        # 等待正在进行的 fsync 结束，避免关闭其他线程正在同步的文件
+        while self.syncing:
+            self.condition.wait()
+        self.write_file.flush()
+        os.fsync(self.write_file.fileno())
+        self.write_file.close()
+        self.synced_seq = self.written_seq
+        self._open_segment(self.write_index + 1)
+        debug(f"事件 spool 切换分段: {_segment_name(self.write_index)}")
+
+    def append(self, event):
+        """
+        追加一条事件，返回时事件已 fsync 到磁盘。
+        并发调用会合并成一次 fsync：第一个等待者负责 fsync，其余调用等待结果。
+        :raises SpoolError: 写入或 fsync 失败
+        """
+        return self.append_many([event])
+
+    def append_many(self, events):
+        """
+        追加一批事件，整批只需一次 fsync，返回时全部事件已落盘
+        :raises SpoolError: 写入或 fsync 失败
+        """
+        records = [_encode_record(event) for event in events]
+        if not records:
+            return self.written_seq
+        with self.condition:
+            if self.closed:
+                raise SpoolError("事件 spool 已关闭")
+            try:
+                for record in records:
+                    if self.write_size > 0 and self.write_size + len(record) > self.segment_max_bytes:
+                        self._rotate()
+                    self.write_file.write(record)
+                    self.write_size += len(record)
+                    self.written_seq += 1
+                self.write_file.flush()
+            except OSError as e:
+                raise SpoolError(f"写入事件 spool 失败: {e}") from e
+            my_seq = self.written_seq
+
+            while self.synced_seq < my_seq:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+                # 由当前线程负责 fsync，期间释放锁让其他请求继续追加
+                self.syncing = True
+                target = self.written_seq
+                fileno = self.write_file.fileno()
+                self.condition.release()
+                try:
+                    os.fsync(fileno)
+                    sync_error = None
+                except OSError as e:
+                    sync_error = e
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+                if sync_error is not None:
+                    raise SpoolError(f"事件 spool fsync 失败: {sync_error}") from sync_error
+                self.synced_seq = max(self.synced_seq, target)
+
+        self.wakeup.set()
+        return my_seq
+
+    # ---------- 重放 ----------
+
+    def _replay_once(self):
+        """
+        重放一批事件：优先本槽位，空闲时重放无主槽位
+        :return: 本次重放的事件数
+        """
+        with self.condition:
+            active = self.write_index
+        count = self.slot.replay_once(active)
+        if count:
+            return count
+        return self._replay_orphan()
+
+    def _replay_loop(self):
+        backoff = 0.0
+        while True:
+            try:
+                count = self._replay_once()
+                backoff = 0.0
+            except Exception as e:
+                self.failed_replays += 1
+                count = 0
+                backoff = min(self.max_backoff, max(0.5, backoff * 2))
+                error(f"事件 spool 重放失败，{backoff:.1f} 秒后重试: {e}")
+                if self.stopping:
+                    return
+                time.sleep(backoff)
+                continue
+
+            if count:
+                continue
+            if self.stopping:
+                return
+            self.wakeup.wait(self.replay_interval)
+            self.wakeup.clear()
+
+    def pending_bytes(self):
+        """本槽位尚未重放的字节数（近似值）"""
+        return self.slot.pending_bytes()
+
+    def close(self, timeout=10.0):
+        """
+        停止接收新事件，并在超时时间内尽量把剩余事件写入数据库；写不完的留在磁盘上，下次启动继续重放
+        """
+        with self.condition:
+            self.closed = True
+            try:
+                self.write_file.flush()
+                os.fsync(self.write_file.fileno())
+                self.write_file.close()
+            except Exception as e:
+                error(f"关闭事件 spool 分段文件失败: {e}")
+        self.stopping = True
+        self.wakeup.set()
+        self.replayer.join(timeout)
+        remaining = self.pending_bytes()
+        if remaining:
+            warning(f"事件 spool 关闭时仍有约 {remaining} 字节未写入数据库，将在下次启动时重放")
+        else:
+            info(f"事件 spool 已关闭，累计重放 {self.replayed} 条事件")
+        if self.orphan is not None:
+            self.orphan.release()
+        self.slot.release()
+
+    def stats(self):
+        with self.condition:
+            written = self.written_seq
+            segment = self.write_index
+        orphan = self.orphan
+        return {
+            "directory": self.directory,
+            "segment": segment,
+            "appended": written,
+            "replayed": self.replayed,
+            "failed_replays": self.failed_replays,
+            "dead_lettered": self.dead_letter.count,
+            "pending_bytes": self.pending_bytes(),
+            "orphan_directory": orphan.directory if orphan is not None else None,
+            "orphan_replayed": self.orphan_replayed + (orphan.replayed if orphan is not None else 0),
+            "orphan_dead_lettered": self.orphan_dead_lettered + (orphan.dead_letter.count if orphan is not None else 0),
+        }
@@ -2,19 +2,81 @@
 礼物数据 API 模块
 提供礼物数据分析和查询的API路由
 """
-from flask import Blueprint, request, jsonify, current_app
-from modules.db_handler import DBHandler
+from flask import Blueprint, Response, request, jsonify, current_app
+from modules.db_handler import DBHandler, register_write_listener
+from modules.query_cache import get_query_cache, make_cache_key
+from modules.leaderboard import get_leaderboard
+from modules.event_bus import EVENT_KINDS, get_event_bus, parse_cursor, format_sse, format_gap
+from modules.logger import error
 import os
+import json
+import threading
 
 # 创建蓝图
 gift_api_bp = Blueprint('gift_api', __name__)
 
+# (env_path, table_name) -> DBHandler，处理器共享进程级连接池，无需每次请求重新创建
+_db_handlers = {}
+_db_handlers_lock = threading.Lock()
+
 def get_db_handler():
     """获取数据库处理器实例，从app实例中获取表名"""
     app = current_app
     table_name = getattr(app, 'config', {}).get('GIFT_TABLE_NAME', 'gift_records')
     env_path = os.environ.get('GIFT_ENV_PATH', 'missions/.env')
-    return DBHandler(env_path=env_path, table_name=table_name)
+    key = (env_path, table_name)
+    with _db_handlers_lock:
+        handler = _db_handlers.get(key)
+        if handler is None:
+            handler = DBHandler(env_path=env_path, table_name=table_name)
+            _db_handlers[key] = handler
+        return handler
+
+def cache_tags(table_name, room_id=None, uid=None):
+    """
+    查询结果依赖的失效标签：按房间 / 按用户的查询只依赖对应房间 / 用户，
+    不带筛选条件的查询依赖整张表（任何写入都会失效）
+    """
+    if uid is not None:
+        return [f"{table_name}:uid:{uid}"]
+    if room_id:
+        return [f"{table_name}:room:{room_id}"]
+    return [f"{table_name}:all"]
+
+def cached_query(endpoint, db_handler, loader, room_id=None, uid=None, **params):
+    """
+    通过查询缓存执行 loader()；缓存保存 JSON 规范化后的结果，命中与未命中时接口输出一致
+    """
+    cache = get_query_cache()
+    if cache is None:
+        return loader()
+    table_name = db_handler.table_name
+    key = make_cache_key(endpoint, table=table_name, room_id=room_id, uid=uid, **params)
+    return cache.get_or_load(
+        endpoint, key, cache_tags(table_name, room_id, uid),
+        lambda: json.loads(current_app.json.dumps(loader()))
+    )
+
+def invalidate_on_write(table_name, records):
+    """写入礼物记录后，使整张表以及涉及的房间 / 用户的缓存失效"""
+    cache = get_query_cache()
+    if cache is None or not records or "uname" not in records[0]:
+        return
+    tags = {f"{table_name}:all"}
+    for record in records:
+        tags.add(f"{table_name}:room:{record.get('room_id')}")
+        tags.add(f"{table_name}:uid:{record.get('uid')}")
+    cache.invalidate(sorted(tags))
+
+register_write_listener(invalidate_on_write)
+
+@gift_api_bp.route('/api/gift/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """查询缓存命中统计（当前 worker 进程）"""
+    cache = get_query_cache()
+    if cache is None:
+        return jsonify({"status": "success", "data": {"enabled": False}})
+    return jsonify({"status": "success", "data": dict(cache.stats(), enabled=True)})
 
 @gift_api_bp.route('/api/gift/daily', methods=['GET'])
 def get_daily_stats():
@@ -22,7 +84,7 @@ def get_daily_stats():
     try:
         date = request.args.get('date')  # 可选参数，默认为今天
         db_handler = get_db_handler()
-        result = db_handler.get_daily_summary(date)
+        result = cached_query("daily", db_handler, lambda: db_handler.get_daily_summary(date), date=date)
         return jsonify({
             "status": "success",
             "data": result
@@ -46,7 +108,9 @@ def get_weekly_stats():
             week = int(week)
             
         db_handler = get_db_handler()
-        result = db_handler.get_weekly_summary(year, week)
+        result = cached_query(
+            "weekly", db_handler, lambda: db_handler.get_weekly_summary(year, week), year=year, week=week
+        )
         return jsonify({
             "status": "success",
             "data": result
@@ -70,7 +134,9 @@ def get_monthly_stats():
             month = int(month)
             
         db_handler = get_db_handler()
-        result = db_handler.get_monthly_summary(year, month)
+        result = cached_query(
+            "monthly", db_handler, lambda: db_handler.get_monthly_summary(year, month), year=year, month=month
+        )
         return jsonify({
             "status": "success",
             "data": result
@@ -86,7 +152,7 @@ def get_user_contribution(uid):
     """获取用户贡献"""
     try:
         db_handler = get_db_handler()
-        result = db_handler.get_user_contribution(uid)
+        result = cached_query("user", db_handler, lambda: db_handler.get_user_contribution(uid), uid=uid)
         return jsonify({
             "status": "success",
             "data": result
@@ -106,7 +172,14 @@ def get_top_contributors():
         period = request.args.get('period')  # 可选值: day, week, month, year, null(所有时间)
         
         db_handler = get_db_handler()
-        result = db_handler.get_top_contributors(room_id, limit, period)
+        # 优先读取内存排行榜，未启用或尚未加载完成时查询数据库
+        leaderboard = get_leaderboard(db_handler.table_name)
+        result = leaderboard.top(room_id, limit, period) if leaderboard is not None else None
+        if result is None:
+            result = cached_query(
+                "top", db_handler, lambda: db_handler.get_top_contributors(room_id, limit, period),
+                room_id=room_id, limit=limit, period=period
+            )
         return jsonify({
             "status": "success",
             "data": result
@@ -119,13 +192,22 @@ def get_top_contributors():
 
 @gift_api_bp.route('/api/gift/trend', methods=['GET'])
 def get_gift_trend():
-    """获取礼物趋势"""
+    """获取礼物趋势（默认按天；interval=hour 时按小时统计最近 hours 小时，读取小时汇总表）"""
     try:
         room_id = request.args.get('room_id')
         days = request.args.get('days', 30, type=int)
+        interval = request.args.get('interval', 'day')
         
         db_handler = get_db_handler()
-        result = db_handler.get_gift_trend(room_id, days)
+        if interval == 'hour':
+            hours = min(max(request.args.get('hours', 24, type=int), 1), 24 * 31)
+            result = cached_query(
+                "hourly", db_handler, lambda: db_handler.get_hourly_trend(room_id, hours), room_id=room_id, hours=hours
+            )
+        else:
+            result = cached_query(
+                "trend", db_handler, lambda: db_handler.get_gift_trend(room_id, days), room_id=room_id, days=days
+            )
         return jsonify({
             "status": "success",
             "data": result
@@ -138,43 +220,96 @@ def get_gift_trend():
 
 @gift_api_bp.route('/api/gift/room/<room_id>', methods=['GET'])
 def get_room_stats(room_id):
-    """获取房间礼物统计"""
+    """获取房间礼物统计（时间段统计、顶级贡献者与 30 天趋势，一次数据库往返）"""
     try:
-        # 获取期间礼物总数和总价值
         period = request.args.get('period')  # day, week, month, year, all
+        if period == 'all':
+            period = None
         
         db_handler = get_db_handler()
         
-        # 基于不同时间段获取数据
-        if period == 'day':
-            result = db_handler.get_daily_summary()
-        elif period == 'week':
-            result = db_handler.get_weekly_summary()
-        elif period == 'month':
-            result = db_handler.get_monthly_summary()
-        else:
-            # 默认获取所有时间
-            result = db_handler.get_top_contributors(room_id=room_id, limit=9999)
-            
-        # 过滤出当前房间的数据
-        room_data = next((item for item in result if str(item['room_id']) == str(room_id)), {})
-        
-        # 获取该房间的顶级贡献者
-        top_users = db_handler.get_top_contributors(room_id=room_id, limit=10)
-        
-        # 获取礼物趋势
-        trend = db_handler.get_gift_trend(room_id=room_id, days=30)
+        # 结果只依赖该房间的数据，其他房间的写入不会使其失效
+        data = cached_query(
+            "room", db_handler, lambda: db_handler.get_room_dashboard(room_id, period),
+            room_id=room_id, period=period
+        )
         
         return jsonify({
             "status": "success",
-            "data": {
-                "stats": room_data,
-                "top_users": top_users,
-                "trend": trend
-            }
+            "data": data
         })
     except Exception as e:
         return jsonify({
             "status": "error",
             "message": str(e)
-        }), 500 
\ No newline at end of file
+        }), 500
+
+def _event_stream(bus, subscriber, backfill, cursor, rooms, heartbeat):
+    """SSE 输出：先补发数据库中的记录，再持续输出总线事件，空闲时发送心跳"""
+    try:
+        yield "retry: 3000\n\n"
+        sent = set()
+        for kind, (after_id, until_id) in backfill.items():
+            try:
+                for event in bus.load_backfill(kind, after_id, until_id, rooms):
+                    if event.get("gap"):
+                        # 超出续传上限：告知客户端中间有记录未补发
+                        yield format_gap(event, cursor)
+                        continue
+                    sent.add((kind, event["id"]))
+                    yield format_sse(event, cursor)
+            except Exception as e:
+                error(f"事件推送续传失败: kind={kind}, after_id={after_id}, {e}")
+        while True:
+            try:
+                event = subscriber.get(heartbeat)
+            except EOFError:
+                # 消费过慢被断开，客户端会带 Last-Event-ID 重连并续传
+                break
+            if event is None:
+                yield ": keepalive\n\n"
+            elif (event["kind"], event["id"]) not in sent:
+                yield format_sse(event, cursor)
+    finally:
+        bus.unsubscribe(subscriber)
+
+@gift_api_bp.route('/api/gift/stream', methods=['GET'])
+def stream_events():
+    """
+    实时礼物 / 上舰事件（Server-Sent Events）
+    参数：room_id（可重复或逗号分隔）、kinds（gift,guard）、last_event_id（也可使用 Last-Event-ID 请求头）
+    """
+    rooms = {
+        room_id.strip()
+        for value in request.args.getlist('room_id')
+        for room_id in value.split(',') if room_id.strip()
+    }
+    kinds = {kind.strip() for kind in request.args.get('kinds', '').split(',') if kind.strip()}
+    unknown = kinds - set(EVENT_KINDS)
+    if unknown:
+        return jsonify({
+            "status": "error",
+            "message": f"未知的事件类型: {', '.join(sorted(unknown))}"
+        }), 400
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    after = parse_cursor(last_event_id) if last_event_id else None
+
+    bus = get_event_bus()
+    subscriber, backfill, cursor = bus.subscribe(rooms or None, kinds or None, after)
+    if subscriber is None:
+        return jsonify({
+            "status": "error",
+            "message": "实时推送连接数已达上限"
+        }), 503
+
+    heartbeat = float(os.environ.get('EVENT_STREAM_HEARTBEAT', 15))
+    return Response(
+        _event_stream(bus, subscriber, backfill, cursor, rooms or None, heartbeat),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@gift_api_bp.route('/api/gift/stream/stats', methods=['GET'])
+def get_stream_stats():
+    """实时推送统计（当前 worker 进程）"""
+    return jsonify({"status": "success", "data": get_event_bus().stats()})
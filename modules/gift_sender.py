@@ -1,16 +1,177 @@
 import subprocess
 import os
+import json
+import threading
 import traceback
 
+import requests
+
+from modules.bili_account_pool import get_account_pool
+from modules.uid_cache import get_uid_cache
+from modules.logger import debug, info, error
+
+SEND_GOLD_URL = "https://api.live.bilibili.com/xlive/revenue/v1/gift/sendGold"
+ROOM_INFO_URL = "https://api.live.bilibili.com/room/v1/Room/get_info"
+
+# 与 sendGold.py 保持一致的请求头（cookie 由 Session 统一携带）
+GIFT_HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "content-type": "application/x-www-form-urlencoded",
+    "origin": "https://live.bilibili.com",
+    "referer": "https://live.bilibili.com/",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36",
+}
+
+
+class GiftNotSentError(RuntimeError):
+    """送礼请求发出之前就已失败（礼物一定没有送出），可以安全重试"""
+
+
 class GiftSender:
     """
-    用于通过子进程执行送礼物脚本。
+    用于发送礼物。
+    默认在进程内直接调用 B 站接口：账号与价格表只加载一次，每个账号复用同一个 HTTP 连接池；
+    mode="subprocess"（或环境变量 GIFT_SENDER_MODE=subprocess）时回退为通过子进程执行 sendGold.py。
     """
-    def __init__(self, workdir="./missions/send_gift"):
+    def __init__(self, workdir="./missions/send_gift", mode=None, timeout=15):
+        """
+        :param workdir: sendGold.py 与 price_list.json 所在目录
+        :param mode: "inprocess" 或 "subprocess"，默认读取环境变量 GIFT_SENDER_MODE
+        :param timeout: 单次发送的超时时间（秒）
+        """
         # 脚本所在目录
         self.workdir = os.path.expanduser(workdir)
+        self.mode = (mode or os.environ.get("GIFT_SENDER_MODE", "inprocess")).lower()
+        self.timeout = timeout
+
+        # 与 sendGold.py 相同的相对路径约定
+        self.price_list_path = os.path.join(self.workdir, "price_list.json")
+        self.account_pool = get_account_pool(os.path.join(self.workdir, "..", "account_cookies.json"))
+        self.uid_cache = get_uid_cache()
+
+        self.price_list = None
+        self.price_list_lock = threading.Lock()
 
     def send_gift(self, room_id, num, account, gift_id):
+        """
+        发送礼物，失败时抛出 TimeoutError / RuntimeError；
+        确定请求尚未发出时抛出 GiftNotSentError（RuntimeError 的子类）
+        """
+        if self.mode == "subprocess":
+            return self._send_gift_subprocess(room_id, num, account, gift_id)
+        return self._send_gift_inprocess(room_id, num, account, gift_id)
+
+    def _get_price_list(self):
+        """首次使用时加载礼物价格列表"""
+        with self.price_list_lock:
+            if self.price_list is None:
+                if not os.path.exists(self.price_list_path):
+                    raise RuntimeError(f"礼物价格列表文件 {self.price_list_path} 不存在！")
+                with open(self.price_list_path, "r", encoding="utf-8") as f:
+                    self.price_list = json.load(f)
+                info(f"礼物价格列表加载完成: {self.price_list_path}, 礼物数量={len(self.price_list)}")
+            return self.price_list
+
+    def _fetch_anchor_uid(self, room_id, session):
+        """
+        请求接口获取直播间的主播 UID。
+        接口明确返回失败时返回 None（会被负缓存），网络或 HTTP 错误时抛出异常（不缓存）
+        """
+        response = session.get(
+            ROOM_INFO_URL,
+            headers=GIFT_HEADERS,
+            params={"room_id": room_id},
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"获取主播 UID 失败，HTTP 状态码: {response.status_code}")
+
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise RuntimeError(f"获取主播 UID 失败，响应不是有效的 JSON: {str(e)}")
+        if data.get("code") == 0 and "uid" in (data.get("data") or {}):
+            ruid = data["data"]["uid"]
+            debug(f"直播间 {room_id} 主播 UID: {ruid}")
+            return ruid
+        error(f"获取主播 UID 失败，API 响应异常: {data}")
+        return None
+
+    def get_anchor_uid(self, room_id, session):
+        """获取直播间的主播 UID（优先读取共享的 UID 缓存）"""
+        ruid = self.uid_cache.get_anchor_uid(room_id, lambda: self._fetch_anchor_uid(room_id, session))
+        if not ruid:
+            raise RuntimeError(f"无法获取直播间 {room_id} 的主播 UID！")
+        return ruid
+
+    def _send_gift_inprocess(self, room_id, num, account, gift_id):
+        """
+        在当前进程内调用 sendGold 接口发送礼物
+        """
+        try:
+            price_list = self._get_price_list()
+        except (OSError, ValueError, RuntimeError) as e:
+            raise GiftNotSentError(f"加载礼物价格列表失败: {str(e)}")
+        if str(gift_id) not in price_list:
+            raise GiftNotSentError(f"礼物 ID {gift_id} 不在 {self.price_list_path}，请检查！")
+        gift_price = price_list[str(gift_id)]
+
+        session = self.account_pool.get_session(account)
+        bili_jct = self.account_pool.get_csrf(account)
+        if not bili_jct:
+            raise GiftNotSentError(f"账号 {account} 的 cookie 配置有误，缺少 bili_jct！")
+
+        try:
+            ruid = self.get_anchor_uid(room_id, session)
+        except (RuntimeError, requests.exceptions.RequestException) as e:
+            raise GiftNotSentError(f"送礼前获取主播 UID 失败: {str(e)}")
+
+        data = {
+            "uid": ruid,
+            "gift_id": gift_id,
+            "ruid": ruid,
+            "send_ruid": 0,
+            "gift_num": num,
+            "coin_type": "gold",
+            "bag_id": 0,
+            "platform": "pc",
+            "biz_code": "Live",
+            "biz_id": room_id,
+            "storm_beat_id": 0,
+            "metadata": "",
+            "price": gift_price,
+            "receive_users": "",
+            "live_statistics": '{"pc_client":"pcWeb","jumpfrom":"82002","room_category":"0","source_event":0,"official_channel":{"program_room_id":"-99998","program_up_id":"-99998"}}',
+            "statistics": '{"platform":5,"pc_client":"pcWeb","appId":100}',
+            "csrf_token": bili_jct,
+            "csrf": bili_jct,
+            "visit_id": "",
+        }
+
+        try:
+            response = session.post(SEND_GOLD_URL, headers=GIFT_HEADERS, data=data, timeout=self.timeout)
+        except requests.exceptions.ConnectTimeout as e:
+            # 连接都没有建立，请求一定没有发出
+            raise GiftNotSentError(f"连接送礼接口超时: {str(e)}")
+        except requests.exceptions.Timeout as e:
+            raise TimeoutError(f"发送礼物超时: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            # 连接中断等错误可能发生在请求发出之后，不能判定礼物没有送出
+            raise RuntimeError(f"发送礼物请求异常: {str(e)}")
+
+        if response.status_code != 200:
+            raise RuntimeError(f"送礼请求失败，HTTP 状态码: {response.status_code}")
+
+        try:
+            result = response.json()
+        except ValueError as e:
+            raise RuntimeError(f"送礼响应不是有效的 JSON: {str(e)}")
+        if result.get("code") != 0:
+            raise RuntimeError(f"送礼失败：{result.get('message')}")
+
+        info(f"成功送出 {num} 个礼物（ID: {gift_id}，单价 {gift_price}，账号 {account}）到直播间 {room_id}")
+
+    def _send_gift_subprocess(self, room_id, num, account, gift_id):
         """
         调用sendGold.py脚本发送礼物
         """
@@ -27,7 +188,7 @@ class GiftSender:
                 ],
                 cwd=self.workdir,
                 check=True,
-                timeout=15  # 防止卡死
+                timeout=self.timeout  # 防止卡死
             )
         except subprocess.TimeoutExpired as e:
             raise TimeoutError(f"运行 sendGold.py 超时: {str(e)}")
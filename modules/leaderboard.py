@@ -0,0 +1,430 @@
+"""
+内存实时贡献排行榜
+为每个 (房间, 时间段) 维护 uid -> (礼物数量, 总价, 用户名) 以及按总价降序排列的有序索引：
+- 启动时在后台线程从数据库（启用时读取汇总表）加载当前日/周/月/年及所有时间的排行
+- 本进程的礼物写入提交后通过写入监听器立即增量更新
+- 后台线程每隔 poll_interval 秒按 ID 追加读取礼物表的新记录，纳入其他 worker 的写入；
+  快照之后才提交的较小 ID（并发事务）记录为缺口，之后的追加读取会一并取回
+- 有序索引为分桶的有序列表（与 sortedcontainers.SortedList 相同的结构），
+  更新时二分定位桶，只在长度有上限的桶内移动元素
+- 跨过日/周/月/年边界时清空对应时间段的排行，从零开始累计
+- 每隔 resync_interval 秒重新从数据库完整加载一次，纠正超出缺口窗口的延迟提交或数据修改
+/api/gift/top 优先读取排行榜，尚未加载完成或时间段未启用时回退到数据库查询。
+"""
+import bisect
+import datetime
+import os
+import threading
+import time
+
+from modules.db_handler import register_write_listener, unregister_write_listener
+from modules.logger import debug, info, warning, error
+
+# 时间段名称，None 表示所有时间（与 DBHandler._period_range 一致）
+PERIODS = ("day", "week", "month", "year", None)
+
+# 追加读取礼物记录时需要的列
+RECORD_COLUMNS = ("id", "timestamp", "room_id", "uid", "uname", "price")
+
+
+def normalize_period(period):
+    """接口参数转换为时间段，未知取值视为所有时间（与数据库查询行为一致）"""
+    return period if period in PERIODS else None
+
+
+class SortedIndex:
+    """
+    有序列表，元素分散在若干个有序的桶中，每个桶最多 2 * load 个元素。
+    插入 / 删除时先在各桶的最大值上二分查找定位桶，再在桶内二分，移动的元素数量不超过桶的大小。
+    """
+    def __init__(self, load=256):
+        self.load = load
+        self.buckets = []
+        # 每个桶的最大元素，与 buckets 一一对应
+        self.maxes = []
+        self.size = 0
+
+    def add(self, key):
+        self.size += 1
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            return
+        position = bisect.bisect_left(self.maxes, key)
+        if position == len(self.maxes):
+            position -= 1
+            bucket = self.buckets[position]
+            bucket.append(key)
+            self.maxes[position] = key
+        else:
+            bucket = self.buckets[position]
+            bisect.insort(bucket, key)
+        if len(bucket) > 2 * self.load:
+            self.buckets[position:position + 1] = [bucket[:self.load], bucket[self.load:]]
+            self.maxes[position:position + 1] = [bucket[self.load - 1], bucket[-1]]
+
+    def remove(self, key):
+        """删除已存在的元素"""
+        position = bisect.bisect_left(self.maxes, key)
+        bucket = self.buckets[position]
+        index = bisect.bisect_left(bucket, key)
+        del bucket[index]
+        self.size -= 1
+        if not bucket:
+            del self.buckets[position]
+            del self.maxes[position]
+        elif index == len(bucket):
+            self.maxes[position] = bucket[-1]
+
+    def head(self, limit):
+        """按顺序返回前 limit 个元素"""
+        results = []
+        for bucket in self.buckets:
+            if len(results) >= limit:
+                break
+            results.extend(bucket[:limit - len(results)])
+        return results
+
+    def __len__(self):
+        return self.size
+
+
+class RankedBoard:
+    """单个 (房间, 时间段) 的排行"""
+    def __init__(self):
+        # uid -> [礼物数量, 总价, 用户名]
+        self.totals = {}
+        # 按 (-总价, uid) 升序排列，即总价降序、同分按 uid 升序
+        self.index = SortedIndex()
+
+    def add(self, uid, uname, gift_count, total_price):
+        entry = self.totals.get(uid)
+        if entry is None:
+            entry = self.totals[uid] = [0, 0, uname]
+        else:
+            self.index.remove((-entry[1], uid))
+        entry[0] += gift_count
+        entry[1] += total_price
+        if uname:
+            entry[2] = uname
+        self.index.add((-entry[1], uid))
+
+    def top(self, limit):
+        results = []
+        for _, uid in self.index.head(max(0, limit)):
+            gift_count, total_price, uname = self.totals[uid]
+            results.append({
+                "uid": uid,
+                "uname": uname,
+                "gift_count": gift_count,
+                "total_price": total_price,
+            })
+        return results
+
+    def __len__(self):
+        return len(self.totals)
+
+
+class Leaderboard:
+    def __init__(self, db_handler, periods=PERIODS, resync_interval=600, poll_interval=1.0,
+                 poll_batch_size=1000, gap_window=10000, gap_ttl=60.0):
+        """
+        :param db_handler: 礼物表的 DBHandler，用于加载排行与计算时间段
+        :param periods: 维护的时间段
+        :param resync_interval: 定期从数据库完整重新加载的间隔（秒），0 表示不重新加载
+        :param poll_interval: 追加读取新记录的间隔（秒），0 表示只依赖本进程的写入监听器
+        :param poll_batch_size: 每次追加读取的最大记录数
+        :param gap_window: 只追踪最近这么多个 ID 范围内的缺口（尚未提交或已回滚的 ID）
+        :param gap_ttl: 缺口超过这么多秒仍未取回时视为已回滚，不再追踪
+        """
+        self.db_handler = db_handler
+        self.table_name = db_handler.table_name
+        self.periods = tuple(periods)
+        self.resync_interval = resync_interval
+        self.poll_interval = poll_interval
+        self.poll_batch_size = max(1, int(poll_batch_size))
+        self.gap_window = max(0, int(gap_window))
+        self.gap_ttl = gap_ttl
+
+        self.lock = threading.Lock()
+        # (room_id, 时间段) -> RankedBoard，room_id 为 None 表示全部房间
+        self.boards = {}
+        # 时间段 -> 当前区间 [start, end)
+        self.ranges = {}
+        self.today = None
+        self.ready = False
+        # 不大于 tail_id 的记录要么已计入排行，要么在 missing 中等待取回
+        self.tail_id = 0
+        # 不大于 tail_id 但尚未计入的 ID -> 发现时间（快照时尚未提交的事务，或已回滚的 ID）
+        self.missing = {}
+        # 大于 tail_id、已由写入监听器计入的 ID，追加读取到时跳过
+        self.ahead = set()
+        # 每次完整加载后递增，丢弃与加载交错的追加读取结果
+        self.generation = 0
+        # 加载期间收到的写入，加载完成后按新的 tail_id / missing 过滤并补上
+        self.pending = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _current_ranges(self, today):
+        return {period: self.db_handler._period_range(period, today) for period in self.periods}
+
+    def _rollover(self, today=None):
+        """日期变化时清空已进入新区间的时间段（调用方持有锁）"""
+        today = today or datetime.date.today()
+        if today == self.today:
+            return
+        ranges = self._current_ranges(today)
+        for period, period_range in ranges.items():
+            if self.ranges.get(period) != period_range:
+                for key in [key for key in self.boards if key[1] == period]:
+                    del self.boards[key]
+                if self.ranges.get(period) is not None:
+                    info(f"排行榜进入新的时间段: table={self.table_name}, period={period}, range={period_range}")
+        self.ranges = ranges
+        self.today = today
+
+    @staticmethod
+    def _add(boards, ranges, room_id, uid, uname, gift_count, total_price, day):
+        for period, period_range in ranges.items():
+            if period_range is not None and not (period_range[0] <= day < period_range[1]):
+                continue
+            for key in ((room_id, period), (None, period)):
+                board = boards.get(key)
+                if board is None:
+                    board = boards[key] = RankedBoard()
+                board.add(uid, uname, gift_count, total_price)
+
+    def _accept(self, record_id):
+        """记录是否尚未计入排行，是则标记为已计入（调用方持有锁）"""
+        if record_id > self.tail_id:
+            if record_id in self.ahead:
+                return False
+            self.ahead.add(record_id)
+            return True
+        if record_id in self.missing:
+            del self.missing[record_id]
+            return True
+        return False
+
+    def _apply(self, records):
+        """把尚未计入的记录累加到当前排行（调用方持有锁）"""
+        for record in records:
+            record_id = record.get("id")
+            if record_id is None or not self._accept(int(record_id)):
+                continue
+            timestamp = record.get("timestamp")
+            day = timestamp.date() if isinstance(timestamp, datetime.datetime) else datetime.date.today()
+            self._add(
+                self.boards, self.ranges, str(record.get("room_id")), int(record.get("uid")),
+                record.get("uname"), 1, record.get("price") or 0, day
+            )
+
+    def on_write(self, table_name, records):
+        """写入监听器：只处理本排行榜对应礼物表的写入"""
+        if table_name != self.table_name:
+            return
+        with self.lock:
+            if self.pending is not None:
+                self.pending.extend(records)
+            if self.ready:
+                self._rollover()
+                self._apply(records)
+
+    def catch_up(self):
+        """
+        按 ID 追加读取新记录与之前的缺口，纳入其他 worker 的写入
+        :return: 读取到的新记录数（达到 poll_batch_size 时调用方应立即再读一次）
+        """
+        with self.lock:
+            if not self.ready:
+                return 0
+            generation = self.generation
+            after = self.tail_id
+            missing = sorted(self.missing)
+        records = self.db_handler.get_records_after(
+            after, RECORD_COLUMNS, limit=self.poll_batch_size + len(missing), include_ids=missing
+        )
+        new_ids = [int(record["id"]) for record in records if int(record["id"]) > after]
+
+        with self.lock:
+            if generation != self.generation:
+                # 读取期间已完整重新加载，结果可能与新快照重复，丢弃
+                return 0
+            self._rollover()
+            self._apply(records)
+            now = time.time()
+            if new_ids:
+                tail_id = max(new_ids)
+                seen = set(new_ids) | self.ahead
+                for record_id in range(max(after + 1, tail_id - self.gap_window + 1), tail_id + 1):
+                    if record_id not in seen:
+                        self.missing[record_id] = now
+                self.ahead = {record_id for record_id in self.ahead if record_id > tail_id}
+                self.tail_id = tail_id
+            floor = self.tail_id - self.gap_window
+            self.missing = {
+                record_id: found_at for record_id, found_at in self.missing.items()
+                if record_id > floor and now - found_at < self.gap_ttl
+            }
+        if new_ids:
+            debug(f"排行榜追加读取: table={self.table_name}, 新记录={len(new_ids)}, tail_id={self.tail_id}")
+        return len(new_ids)
+
+    def load(self):
+        """
+        从数据库加载全部时间段的排行并替换当前排行（在同一个 REPEATABLE READ 快照中读取）
+        """
+        with self.lock:
+            self.pending = []
+        today = datetime.date.today()
+        ranges = self._current_ranges(today)
+        source, count_expr, sum_expr, time_col = self.db_handler._contribution_source()
+        boards = {}
+
+        conn = self.db_handler.get_connection()
+        cursor = conn.cursor()
+        try:
+            conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {self.table_name}")
+            high_water = cursor.fetchone()[0]
+            # 快照中不可见的较小 ID：尚未提交的并发事务（之后补上）或已回滚的 ID
+            cursor.execute(
+                f"""
+                SELECT g FROM generate_series(%s::bigint, %s::bigint) AS g
+                WHERE NOT EXISTS (SELECT 1 FROM {self.table_name} WHERE id = g)
+                """,
+                (max(1, high_water - self.gap_window + 1), high_water)
+            )
+            found_at = time.time()
+            missing = {row[0]: found_at for row in cursor.fetchall()}
+            for period, period_range in ranges.items():
+                query = f'''
+                    SELECT room_id, uid, MAX(uname), {count_expr}, {sum_expr}
+                    FROM {source}
+                '''
+                params = []
+                if period_range is not None:
+                    query += f" WHERE {time_col} >= %s AND {time_col} < %s"
+                    params.extend(period_range)
+                query += " GROUP BY room_id, uid"
+                cursor.execute(query, params)
+                day = period_range[0] if period_range is not None else today
+                for room_id, uid, uname, gift_count, total_price in cursor.fetchall():
+                    self._add(
+                        boards, {period: period_range}, str(room_id), int(uid),
+                        uname, int(gift_count or 0), int(total_price or 0), day
+                    )
+            conn.rollback()
+        except Exception:
+            conn.rollback()
+            with self.lock:
+                self.pending = None
+            raise
+        finally:
+            conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+            cursor.close()
+            self.db_handler.release_connection(conn)
+
+        with self.lock:
+            pending, self.pending = self.pending, None
+            self.boards = boards
+            self.ranges = ranges
+            self.today = today
+            self.tail_id = high_water
+            self.missing = missing
+            self.ahead = set()
+            self.generation += 1
+            self.ready = True
+            self._apply(pending)
+            users = len(boards.get((None, None), ()))
+        info(f"排行榜加载完成: table={self.table_name}, 排行数={len(boards)}, 用户数={users}, high_water={high_water}")
+
+    def top(self, room_id=None, limit=10, period=None):
+        """
+        读取排行；尚未加载完成或该时间段未启用时返回 None（调用方应回退到数据库查询）
+        """
+        period = normalize_period(period)
+        if period not in self.periods:
+            return None
+        with self.lock:
+            if not self.ready:
+                return None
+            self._rollover()
+            board = self.boards.get((str(room_id) if room_id else None, period))
+            return board.top(limit) if board is not None else []
+
+    def _loop(self):
+        # 启动后先加载一次，之后按 poll_interval 追加读取，按 resync_interval 完整重新加载
+        delay = 0
+        # 下次完整加载的时间，None 表示不再完整加载
+        next_load = 0
+        while not self.stop_event.wait(delay):
+            try:
+                if next_load is not None and time.time() >= next_load:
+                    self.load()
+                    next_load = time.time() + self.resync_interval if self.resync_interval else None
+                elif self.poll_interval and self.catch_up() >= self.poll_batch_size:
+                    delay = 0
+                    continue
+            except Exception as e:
+                error(f"排行榜更新失败: {e}")
+                delay = min(60, max(5, self.poll_interval))
+                continue
+            if self.poll_interval:
+                delay = self.poll_interval
+            elif next_load is not None:
+                delay = max(0, next_load - time.time())
+            else:
+                break
+
+    def start(self):
+        """注册写入监听器并在后台加载排行"""
+        register_write_listener(self.on_write)
+        self.thread = threading.Thread(target=self._loop, name=f"leaderboard-{self.table_name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        unregister_write_listener(self.on_write)
+        self.stop_event.set()
+
+
+# 礼物表名 -> Leaderboard
+_leaderboards = {}
+_leaderboards_lock = threading.Lock()
+
+
+def get_leaderboard(table_name):
+    """获取已启动的排行榜，未启用时返回 None"""
+    return _leaderboards.get(table_name)
+
+
+def start_leaderboard(db_handler):
+    """
+    为礼物表启动排行榜（同一张表只启动一次）。
+    LEADERBOARD_PERIODS 为逗号分隔的时间段（day,week,month,year,all），
+    LEADERBOARD_POLL_INTERVAL 为追加读取新记录的间隔（秒），
+    LEADERBOARD_RESYNC_INTERVAL 为完整重新加载的间隔（秒）
+    """
+    periods = []
+    for name in os.getenv("LEADERBOARD_PERIODS", "day,week,month,year,all").split(","):
+        name = name.strip().lower()
+        if name == "all":
+            periods.append(None)
+        elif name in PERIODS:
+            periods.append(name)
+        elif name:
+            warning(f"忽略未知的排行榜时间段: {name}")
+    resync_interval = float(os.getenv("LEADERBOARD_RESYNC_INTERVAL", 600))
+    poll_interval = float(os.getenv("LEADERBOARD_POLL_INTERVAL", 1.0))
+
+    with _leaderboards_lock:
+        leaderboard = _leaderboards.get(db_handler.table_name)
+        if leaderboard is None:
+            leaderboard = Leaderboard(db_handler, periods, resync_interval, poll_interval)
+            leaderboard.start()
+            _leaderboards[db_handler.table_name] = leaderboard
+            info(f"内存排行榜已启动: table={db_handler.table_name}, periods={periods}, "
+                 f"poll_interval={poll_interval}s, resync_interval={resync_interval}s")
+        return leaderboard
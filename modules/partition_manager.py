@@ -0,0 +1,226 @@
+"""
+按月分区管理
+gift_records / guard_records 可选使用 timestamp 上的按月 RANGE 分区（GIFT_PARTITIONING=true）：
+- 预先创建当月及之后若干个月的分区，另有一个 DEFAULT 分区兜底
+- 超过保留期的旧分区按配置 detach（保留为独立表）、移动到归档 schema 或直接删除
+- 提供从普通表迁移到分区表的方法（tools/init_db.py --migrate-partitions）
+查询最近 N 天的数据时，规划器只需扫描一到两个分区。
+"""
+import datetime
+import os
+import re
+import threading
+
+import psycopg2
+
+from modules.logger import debug, info, error
+
+PARTITION_SUFFIX = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def _month_start(value):
+    return datetime.date(value.year, value.month, 1)
+
+
+def _add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table_name, month):
+    return f"{table_name}_p{month.year:04d}{month.month:02d}"
+
+
+def is_partitioned(cursor, table_name):
+    """表是否为分区表；表不存在时返回 None"""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table_name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0] == "p"
+
+
+def list_partitions(cursor, table_name):
+    """
+    列出按月分区
+    :return: [(分区表名, 月份第一天)]，按月份升序；DEFAULT 分区等不符合命名规则的分区不包含在内
+    """
+    cursor.execute(
+        '''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ''',
+        (table_name,)
+    )
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = PARTITION_SUFFIX.search(name)
+        if match and name == partition_name(table_name, datetime.date(int(match.group(1)), int(match.group(2)), 1)):
+            partitions.append((name, datetime.date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda item: item[1])
+
+
+def ensure_partitions(cursor, table_name, start_month, end_month):
+    """
+    创建 [start_month, end_month] 范围内缺少的按月分区，以及 DEFAULT 分区
+    """
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT")
+    existing = {month for _, month in list_partitions(cursor, table_name)}
+    month = _month_start(start_month)
+    created = []
+    while month <= end_month:
+        if month not in existing:
+            name = partition_name(table_name, month)
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table_name} FOR VALUES FROM (%s) TO (%s)",
+                (month, _add_months(month, 1))
+            )
+            created.append(name)
+        month = _add_months(month, 1)
+    if created:
+        info(f"已创建分区: {', '.join(created)}")
+    return created
+
+
+def ensure_current_partitions(cursor, table_name, months_ahead=2, today=None):
+    """创建当月及之后 months_ahead 个月的分区"""
+    this_month = _month_start(today or datetime.date.today())
+    return ensure_partitions(cursor, table_name, this_month, _add_months(this_month, months_ahead))
+
+
+def migrate_to_partitioned(cursor, table_name, months_ahead=2):
+    """
+    把已有的普通表迁移为按月分区表（在调用方的事务中执行，失败时整体回滚）：
+    1. 原表改名为 <table>_legacy，并按原表结构创建同名分区表（主键改为 (id, timestamp)）
+    2. 按原有数据的时间范围创建分区并复制数据，自增序列继续沿用
+    3. 删除原表；索引由调用方随后按分区表重新创建
+    迁移期间持有原表的排他锁，数据量大时请在低峰期执行并提前备份。
+    """
+    if is_partitioned(cursor, table_name) is not False:
+        return False
+
+    legacy = f"{table_name}_legacy"
+    cursor.execute(f"LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE")
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table_name,))
+    sequence = cursor.fetchone()[0]
+    cursor.execute(f"SELECT MIN(timestamp), MAX(timestamp), COUNT(*) FROM {table_name}")
+    min_ts, max_ts, total = cursor.fetchone()
+
+    cursor.execute(f"ALTER TABLE {table_name} RENAME TO {legacy}")
+    # 原主键索引名与新表主键冲突，原表即将删除，直接去掉
+    cursor.execute(
+        "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p'",
+        (legacy,)
+    )
+    for (constraint,) in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {legacy} DROP CONSTRAINT "{constraint}"')
+    cursor.execute(
+        f"CREATE TABLE {table_name} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)"
+    )
+    cursor.execute(f"ALTER TABLE {table_name} ADD PRIMARY KEY (id, timestamp)")
+
+    this_month = _month_start(datetime.date.today())
+    first_month = _month_start(min_ts.date()) if min_ts else this_month
+    last_month = max(_month_start(max_ts.date()) if max_ts else this_month, this_month)
+    ensure_partitions(cursor, table_name, first_month, _add_months(last_month, months_ahead))
+
+    cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {legacy}")
+    if sequence:
+        cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table_name}.id")
+    cursor.execute(f"DROP TABLE {legacy}")
+    info(f"表 {table_name} 已迁移为按月分区表，复制 {total} 行")
+    return True
+
+
+class PartitionManager:
+    def __init__(self, db_config, table_names, months_ahead=2, retention_months=0,
+                 retire_action="detach", archive_schema="archive", interval=3600):
+        """
+        :param db_config: psycopg2.connect 的参数
+        :param table_names: 需要维护的分区表名列表
+        :param months_ahead: 预先创建之后多少个月的分区
+        :param retention_months: 保留最近多少个月的分区，0 表示不清理
+        :param retire_action: 过期分区的处理方式：detach / archive / drop
+        :param archive_schema: retire_action=archive 时移动到的 schema
+        :param interval: 后台维护间隔（秒）
+        """
+        self.db_config = dict(db_config)
+        self.table_names = list(table_names)
+        self.months_ahead = max(0, int(months_ahead))
+        self.retention_months = max(0, int(retention_months))
+        self.retire_action = retire_action
+        self.archive_schema = archive_schema
+        self.interval = interval
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _retire(self, cursor, table_name, name):
+        cursor.execute(f"ALTER TABLE {table_name} DETACH PARTITION {name}")
+        if self.retire_action == "drop":
+            cursor.execute(f"DROP TABLE {name}")
+            info(f"已删除过期分区: {name}")
+        elif self.retire_action == "archive":
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {self.archive_schema}")
+            cursor.execute(f"ALTER TABLE {name} SET SCHEMA {self.archive_schema}")
+            info(f"已归档过期分区: {name} -> {self.archive_schema}.{name}")
+        else:
+            info(f"已分离过期分区: {name}")
+
+    def maintain(self, today=None):
+        """
+        创建未来的分区并处理过期分区；多个 worker 同时执行时用咨询锁串行化
+        """
+        conn = psycopg2.connect(**self.db_config)
+        try:
+            for table_name in self.table_names:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"partition:{table_name}",))
+                    if not is_partitioned(cursor, table_name):
+                        debug(f"表 {table_name} 不是分区表，跳过分区维护")
+                        conn.rollback()
+                        continue
+
+                    ensure_current_partitions(cursor, table_name, self.months_ahead, today)
+
+                    if self.retention_months:
+                        cutoff = _add_months(_month_start(today or datetime.date.today()), -self.retention_months)
+                        for name, month in list_partitions(cursor, table_name):
+                            if month < cutoff:
+                                self._retire(cursor, table_name, name)
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            error(f"分区维护失败: {e}")
+        finally:
+            conn.close()
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.maintain()
+
+    def start(self):
+        """立即执行一次维护，之后每隔 interval 秒在后台执行"""
+        self.maintain()
+        self.thread = threading.Thread(target=self._loop, name="partition-manager", daemon=True)
+        self.thread.start()
+        info(f"分区管理已启动: tables={self.table_names}, months_ahead={self.months_ahead}, "
+             f"retention_months={self.retention_months}, retire_action={self.retire_action}")
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def create_partition_manager(db_config, table_names):
+    """按环境变量 GIFT_PARTITION_* 创建分区管理器"""
+    return PartitionManager(
+        db_config,
+        table_names,
+        months_ahead=int(os.getenv("GIFT_PARTITION_MONTHS_AHEAD", 2)),
+        retention_months=int(os.getenv("GIFT_PARTITION_RETENTION_MONTHS", 0)),
+        retire_action=os.getenv("GIFT_PARTITION_RETIRE_ACTION", "detach").lower(),
+        archive_schema=os.getenv("GIFT_PARTITION_ARCHIVE_SCHEMA", "archive"),
+        interval=float(os.getenv("GIFT_PARTITION_CHECK_INTERVAL", 3600)),
+    )
@@ -0,0 +1,330 @@
+"""
+查询结果缓存
+缓存 /api/gift/* 的聚合查询结果，键为 (接口, 规范化后的参数)，每个接口有独立的过期时间。
+- 失效：每条缓存记录带若干标签（如 gift_records:room:123），写入礼物时递增相关标签的版本号，
+  读取时版本号不一致即视为未命中；查询开始前先取版本号，查询期间发生的写入也能正确失效
+- 标签版本号有容量上限，并在最长的接口过期时间后清理：版本号取自全局递增序号，
+  未记录的标签返回“下限”（被容量淘汰的标签中最大的版本号），淘汰后不会误命中
+- 后端：memory（进程内 LRU，默认）或 sqlite（同一台机器上的多个 gunicorn worker 共享缓存与失效）
+- 统计：按接口统计命中 / 未命中次数
+"""
+import os
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from modules.ttl_cache import TTLCache, MISSING
+from modules.logger import info, warning, error
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SQLITE_PATH = os.path.join(ROOT_DIR, "data", "query_cache.sqlite3")
+
+
+def make_cache_key(endpoint, **params):
+    """接口名 + 参数（去掉 None，统一转为字符串并排序）生成缓存键"""
+    normalized = {k: str(v) for k, v in params.items() if v is not None}
+    return f"{endpoint}:{json.dumps(normalized, sort_keys=True, ensure_ascii=False)}"
+
+
+class MemoryCacheBackend:
+    """进程内缓存：TTLCache 存放 (值, 标签版本号)，版本号保存在按递增时间排序的有界字典中"""
+    def __init__(self, maxsize=1024, tags_maxsize=10000, tag_ttl=300):
+        """
+        :param tags_maxsize: 保留的标签版本号数量上限
+        :param tag_ttl: 标签版本号的保留时间（秒），不小于最长的接口过期时间
+        """
+        self.cache = TTLCache(maxsize=maxsize)
+        self.tags_maxsize = max(1, int(tags_maxsize))
+        self.tag_ttl = tag_ttl
+        # tag -> (版本号, 最近递增时间)
+        self.generations = OrderedDict()
+        self.sequence = 0
+        self.floor = 0
+        self.lock = threading.Lock()
+
+    def current_generations(self, tags):
+        with self.lock:
+            return {tag: self.generations[tag][0] if tag in self.generations else self.floor for tag in tags}
+
+    def bump(self, tags):
+        now = time.time()
+        with self.lock:
+            self.sequence += 1
+            for tag in tags:
+                self.generations[tag] = (self.sequence, now)
+                self.generations.move_to_end(tag)
+            # 超过保留时间的标签：依赖旧版本号的缓存条目都已过期，直接删除
+            while self.generations and next(iter(self.generations.values()))[1] <= now - self.tag_ttl:
+                self.generations.popitem(last=False)
+            # 超出容量时淘汰最早递增的标签，并抬高下限
+            while len(self.generations) > self.tags_maxsize:
+                _, (generation, _) = self.generations.popitem(last=False)
+                self.floor = max(self.floor, generation)
+
+    def tag_count(self):
+        with self.lock:
+            return len(self.generations)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, generations, ttl):
+        self.cache.set(key, (value, generations), ttl=ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+    def size(self):
+        return len(self.cache)
+
+
+class SqliteCacheBackend:
+    """
+    SQLite 共享缓存：同一文件可被多个进程同时读写（WAL 模式）。
+    超出容量时优先清理已过期、其次是最早过期的条目
+    """
+    def __init__(self, path=DEFAULT_SQLITE_PATH, maxsize=1024, tags_maxsize=10000, tag_ttl=300):
+        self.path = path
+        self.maxsize = max(1, int(maxsize))
+        self.tags_maxsize = max(1, int(tags_maxsize))
+        self.tag_ttl = tag_ttl
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, generations TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_expires_at ON entries(expires_at)")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'generations'").fetchone():
+            # 旧版无上限的版本号表：版本号规则不同，连同已缓存的条目一起丢弃
+            conn.execute("DROP TABLE IF EXISTS generations")
+            conn.execute("DELETE FROM entries")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tag_generations ("
+            "tag TEXT PRIMARY KEY, gen INTEGER NOT NULL, bumped_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tag_generations_gen ON tag_generations(gen)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_state ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL, floor INTEGER NOT NULL)"
+        )
+        conn.execute("INSERT OR IGNORE INTO generation_state (id, seq, floor) VALUES (1, 0, 0)")
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def current_generations(self, tags):
+        tags = list(tags)
+        if not tags:
+            return {}
+        conn = self._conn()
+        floor = conn.execute("SELECT floor FROM generation_state WHERE id = 1").fetchone()[0]
+        rows = conn.execute(
+            f"SELECT tag, gen FROM tag_generations WHERE tag IN ({','.join('?' * len(tags))})", tags
+        ).fetchall()
+        found = dict(rows)
+        return {tag: found.get(tag, floor) for tag in tags}
+
+    def bump(self, tags):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE generation_state SET seq = seq + 1 WHERE id = 1")
+            seq = conn.execute("SELECT seq FROM generation_state WHERE id = 1").fetchone()[0]
+            conn.executemany(
+                "INSERT INTO tag_generations (tag, gen, bumped_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(tag) DO UPDATE SET gen = excluded.gen, bumped_at = excluded.bumped_at",
+                [(tag, seq, now) for tag in tags]
+            )
+            conn.execute("DELETE FROM tag_generations WHERE bumped_at <= ?", (now - self.tag_ttl,))
+            count = conn.execute("SELECT COUNT(*) FROM tag_generations").fetchone()[0]
+            if count > self.tags_maxsize:
+                overflow = count - self.tags_maxsize
+                conn.execute(
+                    "UPDATE generation_state SET floor = MAX(floor, "
+                    "(SELECT MAX(gen) FROM (SELECT gen FROM tag_generations ORDER BY gen LIMIT ?))) WHERE id = 1",
+                    (overflow,)
+                )
+                conn.execute(
+                    "DELETE FROM tag_generations WHERE tag IN (SELECT tag FROM tag_generations ORDER BY gen LIMIT ?)",
+                    (overflow,)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def tag_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM tag_generations").fetchone()[0]
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value, generations, expires_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[2] <= time.time():
+            return MISSING
+        return json.loads(row[0]), json.loads(row[1])
+
+    def set(self, key, value, generations, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, generations, expires_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), json.dumps(generations), now + ttl)
+        )
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count > self.maxsize:
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires_at LIMIT ?)",
+                (max(0, count - self.maxsize),)
+            )
+
+    def clear(self):
+        self._conn().execute("DELETE FROM entries")
+
+    def size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class QueryCache:
+    def __init__(self, backend, ttls=None, default_ttl=10):
+        """
+        :param backend: MemoryCacheBackend 或 SqliteCacheBackend
+        :param ttls: 接口名 -> 过期时间（秒）
+        :param default_ttl: 未单独配置的接口的过期时间（秒）
+        """
+        self.backend = backend
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+
+        # 接口名 -> [命中次数, 未命中次数]
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+
+    def _count(self, endpoint, hit):
+        with self.counters_lock:
+            counter = self.counters.setdefault(endpoint, [0, 0])
+            counter[0 if hit else 1] += 1
+
+    def get_or_load(self, endpoint, key, tags, loader):
+        """
+        读取缓存，未命中时调用 loader() 并写入缓存。
+        缓存后端出错时直接调用 loader，不影响接口可用性
+        :param tags: 该结果依赖的标签，任一标签失效即重新查询
+        """
+        started = time.time()
+        try:
+            generations = self.backend.current_generations(tags)
+            item = self.backend.get(key)
+        except Exception as e:
+            warning(f"读取查询缓存失败，直接查询数据库: {e}")
+            return loader()
+
+        if item is not MISSING:
+            value, cached_generations = item
+            if cached_generations == generations:
+                self._count(endpoint, True)
+                return value
+
+        self._count(endpoint, False)
+        value = loader()
+        # 过期时间从读取版本号时算起，保证标签版本号的保留时间覆盖所有依赖它的条目
+        ttl = self.ttls.get(endpoint, self.default_ttl) - (time.time() - started)
+        if ttl <= 0:
+            return value
+        try:
+            self.backend.set(key, value, generations, ttl)
+        except Exception as e:
+            warning(f"写入查询缓存失败: {e}")
+        return value
+
+    def invalidate(self, tags):
+        """使依赖这些标签的缓存失效"""
+        try:
+            self.backend.bump(tags)
+        except Exception as e:
+            error(f"查询缓存失效失败: {e}")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self.counters_lock:
+            endpoints = {
+                endpoint: {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                }
+                for endpoint, (hits, misses) in self.counters.items()
+            }
+        try:
+            size = self.backend.size()
+            tags = self.backend.tag_count()
+        except Exception:
+            size = tags = None
+        return {
+            "backend": type(self.backend).__name__,
+            "size": size,
+            "tags": tags,
+            "pid": os.getpid(),
+            "endpoints": endpoints,
+        }
+
+
+# 各接口默认过期时间（秒），可通过 QUERY_CACHE_TTL_<接口名大写> 覆盖
+DEFAULT_TTLS = {
+    "daily": 10,
+    "weekly": 60,
+    "monthly": 300,
+    "user": 30,
+    "top": 10,
+    "trend": 60,
+    "hourly": 10,
+    "room": 5,
+}
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    """
+    获取进程内共享的查询缓存；QUERY_CACHE_ENABLED=false 时返回 None。
+    QUERY_CACHE_BACKEND=sqlite 时使用 QUERY_CACHE_SQLITE_PATH（相对路径以项目根目录为基准）作为共享后端
+    """
+    global _shared_cache
+    if os.environ.get("QUERY_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            maxsize = int(os.environ.get("QUERY_CACHE_MAXSIZE", 1024))
+            tags_maxsize = int(os.environ.get("QUERY_CACHE_TAGS_MAXSIZE", 10000))
+            backend_name = os.environ.get("QUERY_CACHE_BACKEND", "memory").lower()
+            ttls = {
+                endpoint: float(os.environ.get(f"QUERY_CACHE_TTL_{endpoint.upper()}", ttl))
+                for endpoint, ttl in DEFAULT_TTLS.items()
+            }
+            # 标签版本号至少保留到依赖它的最长缓存条目过期
+            tag_ttl = max(ttls.values())
+            if backend_name == "sqlite":
+                path = os.environ.get("QUERY_CACHE_SQLITE_PATH", DEFAULT_SQLITE_PATH)
+                if not os.path.isabs(path):
+                    path = os.path.join(ROOT_DIR, path)
+                backend = SqliteCacheBackend(path, maxsize=maxsize, tags_maxsize=tags_maxsize, tag_ttl=tag_ttl)
+            else:
+                backend = MemoryCacheBackend(maxsize=maxsize, tags_maxsize=tags_maxsize, tag_ttl=tag_ttl)
+            _shared_cache = QueryCache(backend, ttls=ttls)
+            info(f"查询结果缓存已启用: backend={backend_name}, maxsize={maxsize}")
+        return _shared_cache
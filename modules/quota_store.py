@@ -0,0 +1,444 @@
+"""
+电池额度存储
+按 (房间, 额度类型, 时间桶) 记录已用电池数。每个额度由 (起始桶, 当前桶, 上限) 描述：
+已用数量为 [起始桶, 当前桶] 内各桶之和，扣减记在当前桶上——
+起始桶与当前桶相同即为固定窗口（如按 reset_hour 对齐的自然日），不同即为滑动窗口（如最近 60 分钟的分钟桶）。
+try_consume 原子地检查全部额度并同时扣减：
+- memory：进程内，按房间分段加锁（lock striping），不同房间互不阻塞；每个序列维护各桶之和，
+  滑动窗口的检查均摊 O(1)。可选在变更后延迟合并写入磁盘快照，重启后恢复
+- sqlite：同一台机器上的多个 worker 共享一个 WAL 模式的 SQLite 文件，检查与扣减在 BEGIN IMMEDIATE 事务中完成；
+  不维护累计值，每次检查用索引范围查询对窗口内的桶求和（分钟窗口最多 61 个桶）
+- postgres：多台机器共享，按房间加事务级咨询锁后求和、检查并 UPSERT；与 sqlite 相同，每次检查对窗口内的桶求和
+时间桶字符串可按字典序比较先后（如 "2024-01-01T10:05"、"2024-01-01"）。
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import zlib
+from collections import deque
+
+from modules.db_pool import get_db_pool, load_db_config
+from modules.logger import debug, info, warning, error
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SQLITE_PATH = os.path.join(ROOT_DIR, "data", "battery_quota.sqlite3")
+DEFAULT_SNAPSHOT_PATH = os.path.join(ROOT_DIR, "data", "battery_quota.json")
+
+
+class _Series:
+    """单个 (房间, 额度类型) 的时间桶序列，按桶升序排列，total 为序列中所有桶之和"""
+    __slots__ = ("buckets", "total")
+
+    def __init__(self):
+        self.buckets = deque()
+        self.total = 0
+
+    def usage(self, since_key, key):
+        """[since_key, key] 内的已用数量；滑动窗口顺带丢弃已滑出的桶（均摊 O(1)）"""
+        if since_key == key:
+            # 固定窗口：旧窗口保留到 prune（每日报告需要读取上一天的用量）
+            for bucket_key, used in reversed(self.buckets):
+                if bucket_key == key:
+                    return used
+                if bucket_key < key:
+                    break
+            return 0
+        while self.buckets and self.buckets[0][0] < since_key:
+            self.total -= self.buckets.popleft()[1]
+        return self.total
+
+    def add(self, key, amount):
+        # 通常追加在末尾；时钟回拨等情况下从右向左找到对应位置
+        index = len(self.buckets)
+        while index > 0 and self.buckets[index - 1][0] > key:
+            index -= 1
+        if index > 0 and self.buckets[index - 1][0] == key:
+            self.buckets[index - 1][1] += amount
+        else:
+            self.buckets.insert(index, [key, amount])
+        self.total += amount
+
+    def prune(self, before_key):
+        while self.buckets and self.buckets[0][0] < before_key:
+            self.total -= self.buckets.popleft()[1]
+
+
+class MemoryQuotaStore:
+    """进程内额度存储"""
+    def __init__(self, snapshot_path=None, snapshot_delay=1.0, stripes=64):
+        """
+        :param snapshot_path: 快照文件路径，None 表示不持久化
+        :param snapshot_delay: 变更后延迟多少秒写快照，期间的变更合并为一次写入
+        :param stripes: 锁分段数，房间按 room_id 的哈希分配到各段
+        """
+        # 每段一把锁和一个 (room_id, 额度类型) -> _Series 的字典
+        self.stripes = [(threading.Lock(), {}) for _ in range(max(1, int(stripes)))]
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_delay = snapshot_delay
+        self.save_lock = threading.Lock()
+        self.save_timer = None
+        if self.snapshot_path:
+            self._load()
+
+    def _stripe(self, room_id):
+        return self.stripes[zlib.crc32(str(room_id).encode("utf-8")) % len(self.stripes)]
+
+    def _items(self):
+        """所有 (room_id, 额度类型, 时间桶, 已用数量)"""
+        items = []
+        for lock, series_map in self.stripes:
+            with lock:
+                for (room_id, kind), series in series_map.items():
+                    items.extend((room_id, kind, key, used) for key, used in series.buckets)
+        return items
+
+    def _load(self):
+        """从快照恢复；旧的时间桶随后由调用方按当前窗口清理"""
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            entries = sorted(snapshot.get("usage", []), key=lambda item: item[2])
+            for room_id, kind, key, used in entries:
+                _, series_map = self._stripe(room_id)
+                series_map.setdefault((room_id, kind), _Series()).add(key, used)
+            info(f"电池额度已从快照恢复: {self.snapshot_path}, 条目数量={len(entries)}")
+        except Exception as e:
+            warning(f"读取电池额度快照失败，忽略: {e}")
+
+    def _save(self):
+        """把当前额度写入快照：临时文件写完并 fsync 后原子替换"""
+        with self.save_lock:
+            self.save_timer = None
+            usage = [list(item) for item in self._items()]
+            try:
+                directory = os.path.dirname(self.snapshot_path) or "."
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".battery_quota.", suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"usage": usage}, f, ensure_ascii=False, separators=(",", ":"))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.snapshot_path)
+                debug(f"电池额度快照已写入: 条目数量={len(usage)}")
+            except Exception as e:
+                warning(f"写入电池额度快照失败: {e}")
+
+    def _schedule_save(self):
+        """变更后安排一次延迟写入，写入在定时器线程中完成，不占用请求线程"""
+        if not self.snapshot_path:
+            return
+        with self.save_lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = threading.Timer(self.snapshot_delay, self._save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def get_usage(self, room_id, windows):
+        """
+        :param windows: 额度类型 -> (起始桶, 当前桶)
+        :return: 额度类型 -> 已用数量
+        """
+        lock, series_map = self._stripe(room_id)
+        with lock:
+            result = {}
+            for kind, (since_key, key) in windows.items():
+                series = series_map.get((room_id, kind))
+                result[kind] = series.usage(since_key, key) if series is not None else 0
+            return result
+
+    def try_consume(self, room_id, amount, windows):
+        """
+        检查并扣减额度，全部额度都充足时才扣减
+        :param windows: 额度类型 -> (起始桶, 当前桶, 上限)
+        :return: (是否成功, 额度类型 -> 已用数量（成功时为扣减后）, 不足的额度类型或 None)
+        """
+        lock, series_map = self._stripe(room_id)
+        with lock:
+            used = {}
+            for kind, (since_key, key, _) in windows.items():
+                series = series_map.get((room_id, kind))
+                used[kind] = series.usage(since_key, key) if series is not None else 0
+            for kind, (_, _, limit) in windows.items():
+                if used[kind] + amount > limit:
+                    return False, used, kind
+            for kind, (_, key, _) in windows.items():
+                series_map.setdefault((room_id, kind), _Series()).add(key, amount)
+                used[kind] += amount
+        self._schedule_save()
+        return True, used, None
+
+    def buckets(self, room_id, kind, since_key, key):
+        """[since_key, key] 内各时间桶的已用数量，按桶升序"""
+        lock, series_map = self._stripe(room_id)
+        with lock:
+            series = series_map.get((room_id, kind))
+            if series is None:
+                return []
+            return [(k, used) for k, used in series.buckets if since_key <= k <= key]
+
+    def window_usage(self, kind, key):
+        """某个时间桶内各房间的已用数量"""
+        usage = {}
+        for lock, series_map in self.stripes:
+            with lock:
+                for (room_id, series_kind), series in series_map.items():
+                    if series_kind != kind:
+                        continue
+                    for bucket_key, used in series.buckets:
+                        if bucket_key == key:
+                            usage[room_id] = used
+        return usage
+
+    def prune(self, kind, before_key):
+        """删除早于 before_key 的时间桶"""
+        changed = False
+        for lock, series_map in self.stripes:
+            with lock:
+                for item in [item for item in series_map if item[1] == kind]:
+                    series = series_map[item]
+                    count = len(series.buckets)
+                    series.prune(before_key)
+                    changed = changed or len(series.buckets) != count
+                    if not series.buckets:
+                        del series_map[item]
+        if changed:
+            self._schedule_save()
+
+    def close(self):
+        """取消等待中的定时器并立即写入快照（进程退出时调用）"""
+        if not self.snapshot_path:
+            return
+        with self.save_lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+        self._save()
+
+
+class SqliteQuotaStore:
+    """同一台机器上多个进程共享的额度存储"""
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS battery_quota ("
+            "room_id TEXT NOT NULL, kind TEXT NOT NULL, window TEXT NOT NULL, used INTEGER NOT NULL, "
+            "PRIMARY KEY (room_id, kind, window))"
+        )
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def _sum(conn, room_id, kind, since_key, key):
+        return conn.execute(
+            "SELECT COALESCE(SUM(used), 0) FROM battery_quota "
+            "WHERE room_id = ? AND kind = ? AND window >= ? AND window <= ?",
+            (room_id, kind, since_key, key)
+        ).fetchone()[0]
+
+    def get_usage(self, room_id, windows):
+        conn = self._conn()
+        return {
+            kind: self._sum(conn, room_id, kind, since_key, key)
+            for kind, (since_key, key) in windows.items()
+        }
+
+    def try_consume(self, room_id, amount, windows):
+        conn = self._conn()
+        # BEGIN IMMEDIATE 立即获取写锁，其他进程的检查与扣减在此期间排队等待
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            used = {
+                kind: self._sum(conn, room_id, kind, since_key, key)
+                for kind, (since_key, key, _) in windows.items()
+            }
+            for kind, (_, _, limit) in windows.items():
+                if used[kind] + amount > limit:
+                    conn.execute("ROLLBACK")
+                    return False, used, kind
+            for kind, (_, key, _) in windows.items():
+                used[kind] += amount
+                conn.execute(
+                    "INSERT INTO battery_quota (room_id, kind, window, used) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(room_id, kind, window) DO UPDATE SET used = used + excluded.used",
+                    (room_id, kind, key, amount)
+                )
+            conn.execute("COMMIT")
+            return True, used, None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def buckets(self, room_id, kind, since_key, key):
+        return self._conn().execute(
+            "SELECT window, used FROM battery_quota "
+            "WHERE room_id = ? AND kind = ? AND window >= ? AND window <= ? ORDER BY window",
+            (room_id, kind, since_key, key)
+        ).fetchall()
+
+    def window_usage(self, kind, key):
+        rows = self._conn().execute(
+            "SELECT room_id, used FROM battery_quota WHERE kind = ? AND window = ?", (kind, key)
+        ).fetchall()
+        return dict(rows)
+
+    def prune(self, kind, before_key):
+        self._conn().execute("DELETE FROM battery_quota WHERE kind = ? AND window < ?", (kind, before_key))
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class PostgresQuotaStore:
+    """多台机器共享的额度存储（使用进程级共享连接池）"""
+    def __init__(self, db_config, table_name="battery_quota"):
+        self.pool = get_db_pool(db_config)
+        self.table_name = table_name
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {self.table_name} (
+                        room_id TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        window_key TEXT NOT NULL,
+                        used INTEGER NOT NULL,
+                        PRIMARY KEY (room_id, kind, window_key)
+                    )
+                ''')
+            conn.commit()
+
+    def _sum(self, cursor, room_id, kind, since_key, key):
+        cursor.execute(
+            f"SELECT COALESCE(SUM(used), 0) FROM {self.table_name} "
+            f"WHERE room_id = %s AND kind = %s AND window_key >= %s AND window_key <= %s",
+            (room_id, kind, since_key, key)
+        )
+        return int(cursor.fetchone()[0])
+
+    def get_usage(self, room_id, windows):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                result = {
+                    kind: self._sum(cursor, room_id, kind, since_key, key)
+                    for kind, (since_key, key) in windows.items()
+                }
+            conn.rollback()
+        return result
+
+    def try_consume(self, room_id, amount, windows):
+        with self.pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    # 同一房间的检查与扣减串行执行（事务结束时自动释放）
+                    cursor.execute(
+                        "SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{self.table_name}:{room_id}",)
+                    )
+                    used = {
+                        kind: self._sum(cursor, room_id, kind, since_key, key)
+                        for kind, (since_key, key, _) in windows.items()
+                    }
+                    for kind, (_, _, limit) in windows.items():
+                        if used[kind] + amount > limit:
+                            conn.rollback()
+                            return False, used, kind
+                    for kind, (_, key, _) in sorted(windows.items()):
+                        cursor.execute(
+                            f'''
+                            INSERT INTO {self.table_name} AS q (room_id, kind, window_key, used)
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (room_id, kind, window_key) DO UPDATE SET
+                                used = q.used + EXCLUDED.used
+                            ''',
+                            (room_id, kind, key, amount)
+                        )
+                        used[kind] += amount
+                conn.commit()
+                return True, used, None
+            except Exception:
+                conn.rollback()
+                raise
+
+    def buckets(self, room_id, kind, since_key, key):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT window_key, used FROM {self.table_name} "
+                    f"WHERE room_id = %s AND kind = %s AND window_key >= %s AND window_key <= %s "
+                    f"ORDER BY window_key",
+                    (room_id, kind, since_key, key)
+                )
+                rows = cursor.fetchall()
+            conn.rollback()
+        return rows
+
+    def window_usage(self, kind, key):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT room_id, used FROM {self.table_name} WHERE kind = %s AND window_key = %s", (kind, key)
+                )
+                rows = cursor.fetchall()
+            conn.rollback()
+        return dict(rows)
+
+    def prune(self, kind, before_key):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {self.table_name} WHERE kind = %s AND window_key < %s", (kind, before_key)
+                )
+            conn.commit()
+
+    def close(self):
+        pass
+
+
+def create_quota_store(db_config=None):
+    """
+    按环境变量 BATTERY_QUOTA_BACKEND（memory / sqlite / postgres）创建额度存储。
+    多个 worker 时应使用 sqlite（同一台机器）或 postgres（多台机器），否则每个 worker 各自计数。
+    memory 默认把额度快照写入 BATTERY_QUOTA_SNAPSHOT_PATH（留空则不持久化）
+    """
+    backend = os.getenv("BATTERY_QUOTA_BACKEND", "memory").lower()
+    try:
+        if backend == "sqlite":
+            path = os.getenv("BATTERY_QUOTA_SQLITE_PATH", DEFAULT_SQLITE_PATH)
+            if not os.path.isabs(path):
+                path = os.path.join(ROOT_DIR, path)
+            store = SqliteQuotaStore(path)
+        elif backend == "postgres":
+            store = PostgresQuotaStore(db_config or load_db_config())
+        else:
+            if backend != "memory":
+                warning(f"未知的电池额度存储 {backend}，使用 memory")
+            backend = "memory"
+            snapshot_path = os.getenv("BATTERY_QUOTA_SNAPSHOT_PATH", DEFAULT_SNAPSHOT_PATH)
+            if snapshot_path and not os.path.isabs(snapshot_path):
+                snapshot_path = os.path.join(ROOT_DIR, snapshot_path)
+            store = MemoryQuotaStore(
+                snapshot_path or None,
+                snapshot_delay=float(os.getenv("BATTERY_QUOTA_SNAPSHOT_DELAY", 1.0))
+            )
+    except Exception as e:
+        error(f"电池额度存储 {backend} 初始化失败，改用进程内存储: {e}")
+        backend = "memory"
+        store = MemoryQuotaStore()
+    info(f"电池额度存储: {backend}")
+    return store
@@ -0,0 +1,145 @@
+"""
+ChatGPT 调用限流
+- 每个房间（可选每个用户）一个令牌桶，检查与扣减都是 O(1)；房间额度用完后该房间进入冷却，不影响其他房间
+- 全局令牌桶限制所有房间合计的请求速率（API 额度），与各房间的额度分开计算
+- 全局信号量限制同时进行中的 OpenAI 请求数，慢请求不会无限占用线程与连接
+房间 / 用户的令牌桶按最近使用保留，超出 maxsize 时淘汰最久未使用的（被淘汰的桶等同于满桶）。
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+# 限流结果；reason 为 "cooldown" / "room" / "user" / "global"，retry_after 为预计可以再次请求的秒数
+RateDecision = namedtuple("RateDecision", "allowed reason retry_after")
+
+
+class ConcurrencyLimitError(RuntimeError):
+    """等待进行中请求名额超时"""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now=None):
+        """
+        :param rate: 每秒补充的令牌数
+        :param capacity: 桶容量（允许的突发请求数）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic() if now is None else now
+        # 冷却结束时间（monotonic），冷却期间不发放令牌
+        self.cooldown_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now, amount=1):
+        """距离可以取出 amount 个令牌还需等待的秒数，0 表示现在就可以"""
+        self._refill(now)
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        if self.tokens >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount=1):
+        self.tokens -= amount
+
+
+class KeyedBuckets:
+    """按键（房间 / 用户）保存的令牌桶，按最近使用淘汰"""
+    def __init__(self, rate, capacity, maxsize=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+
+    def get(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity, now)
+            if len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+
+class ChatRateLimiter:
+    def __init__(self, room_rate, room_capacity, cooldown=30.0, user_rate=0.0, user_capacity=0,
+                 global_rate=0.0, global_capacity=0, max_concurrency=8, acquire_timeout=10.0, maxsize=10000):
+        """
+        :param room_rate / room_capacity: 每个房间的令牌补充速率（个/秒）与容量
+        :param cooldown: 房间额度用完后的冷却时间（秒）
+        :param user_rate / user_capacity: 每个用户的令牌桶，容量为 0 表示不按用户限制
+        :param global_rate / global_capacity: 所有房间合计的令牌桶，容量为 0 表示不限制
+        :param max_concurrency: 同时进行中的 OpenAI 请求数上限，0 表示不限制
+        :param acquire_timeout: 等待进行中请求名额的最长时间（秒）
+        :param maxsize: 最多保留的房间 / 用户令牌桶数量
+        """
+        self.cooldown = cooldown
+        self.acquire_timeout = acquire_timeout
+        self.rooms = KeyedBuckets(room_rate, room_capacity, maxsize)
+        self.users = KeyedBuckets(user_rate, user_capacity, maxsize) if user_capacity > 0 else None
+        self.budget = TokenBucket(global_rate, global_capacity) if global_capacity > 0 else None
+        self.semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self.lock = threading.Lock()
+
+    def check(self, room_id=None, user_key=None):
+        """
+        检查并扣减房间、用户与全局额度，全部充足时才扣减
+        :param room_id: 房间ID，None 表示只检查全局额度（如欢迎语、头像描述）
+        :param user_key: 用户键，None 表示不按用户限制
+        :return: RateDecision
+        """
+        now = time.monotonic()
+        with self.lock:
+            room = self.rooms.get(room_id, now) if room_id is not None else None
+            if room is not None:
+                if now < room.cooldown_until:
+                    return RateDecision(False, "cooldown", room.cooldown_until - now)
+                if room.wait_time(now) > 0:
+                    # 房间额度用完，进入冷却
+                    room.cooldown_until = now + self.cooldown
+                    return RateDecision(False, "room", self.cooldown)
+            user = self.users.get(user_key, now) if self.users is not None and user_key else None
+            if user is not None:
+                wait = user.wait_time(now)
+                if wait > 0:
+                    return RateDecision(False, "user", wait)
+            if self.budget is not None:
+                wait = self.budget.wait_time(now)
+                if wait > 0:
+                    return RateDecision(False, "global", wait)
+            for bucket in (room, user, self.budget):
+                if bucket is not None:
+                    bucket.take()
+        return RateDecision(True, None, 0.0)
+
+    def cooldown_remaining(self, room_id):
+        """房间剩余的冷却秒数"""
+        now = time.monotonic()
+        with self.lock:
+            room = self.rooms.buckets.get(room_id)
+            return max(0.0, room.cooldown_until - now) if room is not None else 0.0
+
+    @contextmanager
+    def inflight(self):
+        """
+        占用一个进行中请求名额：with limiter.inflight(): client.responses.create(...)
+        等待超时抛出 ConcurrencyLimitError
+        """
+        if self.semaphore is None:
+            yield
+            return
+        if not self.semaphore.acquire(timeout=self.acquire_timeout):
+            raise ConcurrencyLimitError(f"进行中的 OpenAI 请求已达上限，等待 {self.acquire_timeout} 秒超时")
+        try:
+            yield
+        finally:
+            self.semaphore.release()
@@ -1,112 +1,192 @@
 import json
 import os
+import threading
+
+from modules.room_config_store import JsonRoomConfigStore
+from modules.logger import debug, info, warning
+
 
 class RoomConfigManager:
-    def __init__(self, room_config_path="room_id_config.json", global_config=None):
+    """
+    房间配置。读取只访问内存中的配置，不加锁；修改写入配置存储（见 modules/room_config_store.py），
+    后台线程定期取回其他 worker 的修改，多个 worker 共享同一存储时配置保持一致。
+    每个房间的配置 dict 写入内存后不再原地修改，修改时整体替换，读取方拿到的总是完整的一份。
+    """
+    def __init__(self, room_config_path="room_id_config.json", global_config=None, store=None, poll_interval=None):
         """
         :param room_config_path: 存储room_id的配置文件
         :param global_config: 全局配置字典，用来初始化默认值
+        :param store: 配置存储，默认使用 room_config_path 文件
+        :param poll_interval: 检查其他进程修改的间隔（秒），默认读取 ROOM_CONFIG_POLL_INTERVAL
         """
         self.room_config_path = room_config_path
         self.global_config = global_config  # 用于获取 max_hourly_battery_per_room / max_daily_battery
-        # 如果文件不存在则创建空文件
+        self.store = store or JsonRoomConfigStore(room_config_path)
+        if poll_interval is None:
+            poll_interval = float(os.getenv("ROOM_CONFIG_POLL_INTERVAL", 2.0))
+        self.poll_interval = max(0.1, poll_interval)
+
+        # 串行化本进程内的修改
+        self.write_lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.version, rooms = self.store.load()
+        if not rooms and not isinstance(self.store, JsonRoomConfigStore):
+            rooms = self._import_file()
+
+        # 加载时一次性补齐旧配置缺少的字段，读取时不再检查；只写入补齐的字段，不覆盖其他字段
+        migrated = {}
+        for room_id, config in rooms.items():
+            original = dict(config)
+            if self._backfill(config):
+                migrated[room_id] = (original, {
+                    key: config.get(key) for key in set(original) | set(config)
+                    if original.get(key) != config.get(key)
+                })
+        for room_id, (original, changes) in migrated.items():
+            rooms[room_id] = self.store.update(room_id, changes, original)
+        if migrated:
+            debug(f"房间配置已补齐字段: 房间数量={len(migrated)}")
+        self.room_config = rooms
+
+    @staticmethod
+    def _backfill(config):
+        """
+        补齐 youxiao / welcome_enabled 字段（旧版本的 enabled 字段转为 youxiao）
+        :return: 是否有修改
+        """
+        changed = False
+        if "youxiao" not in config:
+            config["youxiao"] = config.pop("enabled", False)
+            changed = True
+        if "welcome_enabled" not in config:
+            config["welcome_enabled"] = False
+            changed = True
+        return changed
+
+    def _import_file(self):
+        """共享存储为空时导入 room_id_config.json 中的已有配置"""
         if not os.path.exists(self.room_config_path):
-            with open(self.room_config_path, "w", encoding="utf-8") as f:
-                json.dump({}, f, indent=4, ensure_ascii=False)
+            return {}
+        try:
+            with open(self.room_config_path, "r", encoding="utf-8") as f:
+                rooms = json.load(f)
+        except Exception as e:
+            warning(f"读取 {self.room_config_path} 失败，不导入: {e}")
+            return {}
+        for room_id, config in rooms.items():
+            self._backfill(config)
+            rooms[room_id] = self.store.put(room_id, config, only_if_missing=True)
+        info(f"已从 {self.room_config_path} 导入房间配置: 房间数量={len(rooms)}")
+        return rooms
 
-        # 读取已有配置
-        with open(self.room_config_path, "r", encoding="utf-8") as f:
-            self.room_config = json.load(f)
+    def _room(self, room_id):
+        """
+        获取房间配置（不加锁）；尚未定义时写入默认值，已有其他 worker 写入的配置时以存储中的为准
+        """
+        config = self.room_config.get(room_id)
+        if config is not None:
+            return config
+        with self.write_lock:
+            config = self.room_config.get(room_id)
+            if config is None:
+                config = self.store.put(room_id, {
+                    "max_hourly_battery": self.global_config["max_hourly_battery_per_room"],
+                    "max_daily_battery": self.global_config["max_daily_battery"],
+                    "youxiao": False,
+                    "welcome_enabled": False
+                }, only_if_missing=True)
+                self._backfill(config)
+                self.room_config[room_id] = config
+            return config
 
-    def save_room_config(self):
+    def _update(self, room_id, changes):
         """
-        保存 room_config
+        修改房间配置并写入存储；changes 中值为 None 的字段会被删除。
+        只把修改的字段交给存储合并，本进程内存中可能过期的其他字段不会覆盖其他 worker 的修改
+        :return: 修改后的配置
         """
-        with open(self.room_config_path, "w", encoding="utf-8") as f:
-            json.dump(self.room_config, f, indent=4, ensure_ascii=False)
+        with self.write_lock:
+            config = self.store.update(room_id, changes, self._room(room_id))
+            self.room_config[room_id] = config
+            return config
+
+    def refresh(self):
+        """取回其他进程的修改（与本进程的修改串行，避免用修改前读到的旧配置覆盖）"""
+        with self.write_lock:
+            self.version, rooms = self.store.changes(self.version)
+            for config in rooms.values():
+                self._backfill(config)
+            self.room_config.update(rooms)
+        if rooms:
+            debug(f"房间配置已更新: 房间数量={len(rooms)}")
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            self.store.wait_for_change(self.poll_interval, self.stop_event)
+            if self.stop_event.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                warning(f"刷新房间配置失败: {e}")
+
+    def start(self):
+        """在后台持续取回其他进程的修改"""
+        self.thread = threading.Thread(target=self._loop, name="room-config", daemon=True)
+        self.thread.start()
+
+    def flush(self):
+        """写入尚未保存的修改（进程退出时调用）"""
+        self.store.flush()
+
+    def close(self):
+        self.stop_event.set()
+        self.store.close()
 
     def get_room_limits(self, room_id):
         """
         获取指定房间的 (max_hourly_battery, max_daily_battery)。
-        如果尚未定义，则写入默认值并保存。
-        """
-        if room_id not in self.room_config:
-            self.room_config[room_id] = {
-                "max_hourly_battery": self.global_config["max_hourly_battery_per_room"],
-                "max_daily_battery": self.global_config["max_daily_battery"],
-                "youxiao": False,
-                "welcome_enabled": False
-            }
-            self.save_room_config()
-        
-        # 确保所有房间配置都有youxiao字段
-        if "youxiao" not in self.room_config[room_id]:
-            # 如果有enabled字段，则从enabled转移
-            if "enabled" in self.room_config[room_id]:
-                self.room_config[room_id]["youxiao"] = self.room_config[room_id]["enabled"]
-                del self.room_config[room_id]["enabled"]
-            else:
-                self.room_config[room_id]["youxiao"] = False
-            self.save_room_config()
-
-        # 确保所有房间配置都有 welcome_enabled 字段
-        if "welcome_enabled" not in self.room_config[room_id]:
-            self.room_config[room_id]["welcome_enabled"] = False
-            self.save_room_config()
-
-        return (
-            self.room_config[room_id]["max_hourly_battery"],
-            self.room_config[room_id]["max_daily_battery"]
-        )
-        
+        如果尚未定义，则写入默认值。
+        """
+        config = self._room(room_id)
+        return config["max_hourly_battery"], config["max_daily_battery"]
+
     def get_room_youxiao(self, room_id):
         """
         获取指定房间的youxiao状态。
         如果尚未定义，则初始化为False。
         """
-        # 确保房间配置已经初始化
-        self.get_room_limits(room_id)
-        
-        return self.room_config[room_id]["youxiao"]
-        
+        return self._room(room_id)["youxiao"]
+
     def set_room_youxiao(self, room_id, youxiao):
         """
         设置指定房间的youxiao状态。
         如果房间尚未定义，则先初始化。
         """
-        # 确保房间配置已经初始化
-        self.get_room_limits(room_id)
-        
-        self.room_config[room_id]["youxiao"] = youxiao
-        self.save_room_config()
-        
+        self._update(room_id, {"youxiao": youxiao})
         return youxiao
 
     def get_room_welcome_enabled(self, room_id: str) -> bool:
         """
         获取指定房间的欢迎模式开关（默认 False）。
         """
-        self.get_room_limits(room_id)
-        return bool(self.room_config[room_id].get("welcome_enabled", False))
+        return bool(self._room(room_id).get("welcome_enabled", False))
 
     def set_room_welcome_enabled(self, room_id: str, enabled: bool) -> bool:
         """
         设置指定房间的欢迎模式开关，并保存。
         返回最终状态。
         """
-        self.get_room_limits(room_id)
-        self.room_config[room_id]["welcome_enabled"] = bool(enabled)
-        self.save_room_config()
-        return self.room_config[room_id]["welcome_enabled"]
+        return self._update(room_id, {"welcome_enabled": bool(enabled)})["welcome_enabled"]
 
     def get_room_prompt(self, room_id):
         """
         获取指定房间的自定义system prompt。
         如果不存在，返回None。
         """
-        # 确保房间配置已经初始化
-        self.get_room_limits(room_id)
-        return self.room_config.get(room_id, {}).get("prompt")
+        return self._room(room_id).get("prompt")
 
     def set_room_prompt(self, room_id, prompt):
         """
@@ -114,12 +194,8 @@ class RoomConfigManager:
         传入空字符串或None则删除该字段。
         返回最终保存的prompt（或None）。
         """
-        # 确保房间配置已经初始化
-        self.get_room_limits(room_id)
         if prompt is None or str(prompt).strip() == "":
-            if "prompt" in self.room_config[room_id]:
-                del self.room_config[room_id]["prompt"]
+            prompt = None
         else:
-            self.room_config[room_id]["prompt"] = str(prompt)
-        self.save_room_config()
-        return self.room_config[room_id].get("prompt")
+            prompt = str(prompt)
+        return self._update(room_id, {"prompt": prompt}).get("prompt")
@@ -0,0 +1,431 @@
+"""
+房间配置存储
+RoomConfigManager 把房间配置保存在这里，并定期取回其他进程的修改，使多个 worker 看到同一份配置：
+- json：room_id_config.json 文件。修改延迟合并为一次原子写入，写入时在文件锁内按字段合并到磁盘上的内容，
+  不会覆盖其他进程的修改；通过文件 mtime 发现其他进程的修改
+- sqlite：同一台机器上的多个 worker 共享一个 WAL 模式的 SQLite 文件，按版本号增量取回修改
+- postgres：多台机器共享 room_config 表，写入后 NOTIFY，其他进程 LISTEN 收到通知后按版本号增量取回
+所有存储的接口相同：
+    load() -> (版本, {房间: 配置})
+    changes(版本) -> (新版本, {房间: 配置})，配置未变化时返回空 dict
+    put(房间, 配置, only_if_missing=False) -> 存储中该房间的配置
+    update(房间, 修改的字段, 房间不存在时的初始配置) -> 存储中该房间的配置
+        只把修改的字段合并到存储中的配置（值为 None 的字段删除），多个进程同时修改同一房间的不同字段不会互相覆盖
+    wait_for_change(timeout, stop_event) 等待下一次检查（postgres 收到通知时提前返回）
+"""
+import json
+import os
+import select
+import sqlite3
+import tempfile
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from modules.db_pool import get_db_pool, load_db_config
+from modules.logger import debug, info, warning, error
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只在进程内串行化写入
+    fcntl = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SQLITE_PATH = os.path.join(ROOT_DIR, "data", "room_config.sqlite3")
+NOTIFY_CHANNEL = "room_config"
+
+
+def merge_config(config, changes):
+    """返回按字段合并后的新配置，changes 中值为 None 的字段被删除"""
+    merged = dict(config)
+    for key, value in changes.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+class JsonRoomConfigStore:
+    """room_id_config.json 文件存储"""
+    def __init__(self, path="room_id_config.json", save_delay=1.0):
+        """
+        :param path: 配置文件路径
+        :param save_delay: 修改后延迟多少秒写盘，期间的修改合并为一次写入
+        """
+        self.path = path
+        self.save_delay = max(0.0, save_delay)
+        # 房间 -> (配置, only_if_missing, 修改的字段)，尚未写盘的修改：
+        # 先按 only_if_missing 写入配置，再把修改的字段合并上去
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.save_timer = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            # 如果文件不存在则创建空文件
+            self._write({})
+        return self._stat(), self._read()
+
+    def changes(self, version):
+        """文件被修改过（包括本进程写盘）时重新读取整个文件，并叠加尚未写盘的修改"""
+        current = self._stat()
+        if current == version:
+            return version, {}
+        try:
+            rooms = self._read()
+        except Exception as e:
+            # 其他程序可能正在非原子地写入，下次再读
+            warning(f"读取房间配置文件失败: {e}")
+            return version, {}
+        with self.lock:
+            for room_id, item in self.pending.items():
+                self._apply_pending(rooms, room_id, item)
+        return current, rooms
+
+    @staticmethod
+    def _apply_pending(rooms, room_id, item):
+        config, only_if_missing, changes = item
+        if not only_if_missing or room_id not in rooms:
+            rooms[room_id] = dict(config)
+        if changes:
+            rooms[room_id] = merge_config(rooms[room_id], changes)
+
+    def put(self, room_id, config, only_if_missing=False):
+        with self.lock:
+            previous = self.pending.get(room_id)
+            # 已有尚未写盘的修改时不再被默认值覆盖
+            if not (only_if_missing and previous is not None):
+                self.pending[room_id] = (config, only_if_missing, {})
+            self._schedule_save()
+        return config
+
+    def update(self, room_id, changes, base):
+        """
+        记录字段级修改，写盘时才合并到磁盘上的最新配置；返回本进程视角下合并后的配置
+        :param base: 本进程当前的配置，磁盘上还没有该房间时作为初始配置
+        """
+        with self.lock:
+            previous = self.pending.get(room_id)
+            if previous is None:
+                self.pending[room_id] = (base, True, dict(changes))
+            else:
+                config, only_if_missing, pending_changes = previous
+                self.pending[room_id] = (config, only_if_missing, {**pending_changes, **changes})
+            self._schedule_save()
+        return merge_config(base, changes)
+
+    def _schedule_save(self):
+        """调用方持有 self.lock"""
+        if self.save_timer is None:
+            self.save_timer = threading.Timer(self.save_delay, self.flush)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def _write(self, rooms):
+        """先写临时文件并 fsync，再原子替换，写到一半崩溃也不会损坏原文件"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".room_config.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(rooms, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def flush(self):
+        """把尚未写盘的修改与磁盘上的内容合并后写入（定时器与进程退出时调用）"""
+        with self.save_lock:
+            with self.lock:
+                if self.save_timer is not None:
+                    self.save_timer.cancel()
+                    self.save_timer = None
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            lock_file = None
+            try:
+                if fcntl is not None:
+                    # 文件锁保证多个进程的“读取-合并-写入”不会交错
+                    lock_file = open(self.path + ".lock", "a")
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                rooms = self._read()
+                for room_id, item in pending.items():
+                    self._apply_pending(rooms, room_id, item)
+                self._write(rooms)
+                debug(f"房间配置已写入: 修改房间数量={len(pending)}")
+            except Exception as e:
+                # 写盘失败时放回待写队列，下次修改或退出时重试
+                warning(f"保存房间配置失败: {e}")
+                with self.lock:
+                    for room_id, item in pending.items():
+                        newer = self.pending.get(room_id)
+                        if newer is None:
+                            self.pending[room_id] = item
+                        else:
+                            # 失败期间又有新的修改：保留原来的初始配置，字段修改以新的为准
+                            config, only_if_missing, changes = item
+                            self.pending[room_id] = (config, only_if_missing, {**changes, **newer[2]})
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+    def wait_for_change(self, timeout, stop_event):
+        stop_event.wait(timeout)
+
+    def close(self):
+        self.flush()
+
+
+class SqliteRoomConfigStore:
+    """同一台机器上多个进程共享的房间配置"""
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS room_config ("
+            "room_id TEXT PRIMARY KEY, config TEXT NOT NULL, version INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_room_config_version ON room_config (version)")
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def load(self):
+        return self.changes(0)
+
+    def changes(self, version):
+        rows = self._conn().execute(
+            "SELECT room_id, config, version FROM room_config WHERE version > ?", (version,)
+        ).fetchall()
+        rooms = {room_id: json.loads(config) for room_id, config, _ in rows}
+        return max([version] + [row[2] for row in rows]), rooms
+
+    def put(self, room_id, config, only_if_missing=False):
+        conn = self._conn()
+        # BEGIN IMMEDIATE 串行化写入，版本号按提交顺序递增
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conflict = "DO NOTHING" if only_if_missing else \
+                "DO UPDATE SET config = excluded.config, version = excluded.version"
+            conn.execute(
+                "INSERT INTO room_config (room_id, config, version) "
+                "SELECT ?, ?, COALESCE(MAX(version), 0) + 1 FROM room_config WHERE true "
+                f"ON CONFLICT(room_id) {conflict}",
+                (room_id, json.dumps(config, ensure_ascii=False))
+            )
+            stored = conn.execute("SELECT config FROM room_config WHERE room_id = ?", (room_id,)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return json.loads(stored[0])
+
+    def update(self, room_id, changes, base):
+        """在 BEGIN IMMEDIATE 事务中读取当前配置、按字段合并并写回"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT config FROM room_config WHERE room_id = ?", (room_id,)).fetchone()
+            config = merge_config(json.loads(row[0]) if row is not None else base, changes)
+            conn.execute(
+                "INSERT INTO room_config (room_id, config, version) "
+                "SELECT ?, ?, COALESCE(MAX(version), 0) + 1 FROM room_config WHERE true "
+                "ON CONFLICT(room_id) DO UPDATE SET config = excluded.config, version = excluded.version",
+                (room_id, json.dumps(config, ensure_ascii=False))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return config
+
+    def flush(self):
+        pass
+
+    def wait_for_change(self, timeout, stop_event):
+        stop_event.wait(timeout)
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class PostgresRoomConfigStore:
+    """多台机器共享的房间配置（使用进程级共享连接池，另占用一个连接 LISTEN 修改通知）"""
+    def __init__(self, db_config, table_name="room_config"):
+        self.db_config = dict(db_config)
+        self.pool = get_db_pool(db_config)
+        self.table_name = table_name
+        self.listen_conn = None
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {self.table_name}_version_seq")
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {self.table_name} (
+                        room_id TEXT PRIMARY KEY,
+                        config JSONB NOT NULL,
+                        version BIGINT NOT NULL DEFAULT nextval('{self.table_name}_version_seq')
+                    )
+                ''')
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_version ON {self.table_name} (version)"
+                )
+            conn.commit()
+
+    def load(self):
+        return self.changes(0)
+
+    def changes(self, version):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT room_id, config, version FROM {self.table_name} WHERE version > %s", (version,)
+                )
+                rows = cursor.fetchall()
+            conn.rollback()
+        rooms = {room_id: config for room_id, config, _ in rows}
+        return max([version] + [row[2] for row in rows]), rooms
+
+    def put(self, room_id, config, only_if_missing=False):
+        with self.pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    # 写入串行执行，保证版本号的提交顺序与大小一致，增量读取不会漏掉修改
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (self.table_name,))
+                    conflict = "DO NOTHING" if only_if_missing else f'''
+                        DO UPDATE SET config = EXCLUDED.config, version = nextval('{self.table_name}_version_seq')
+                    '''
+                    cursor.execute(
+                        f"INSERT INTO {self.table_name} (room_id, config) VALUES (%s, %s::jsonb) "
+                        f"ON CONFLICT (room_id) {conflict}",
+                        (room_id, json.dumps(config, ensure_ascii=False))
+                    )
+                    if cursor.rowcount:
+                        cursor.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, room_id))
+                    cursor.execute(f"SELECT config FROM {self.table_name} WHERE room_id = %s", (room_id,))
+                    stored = cursor.fetchone()[0]
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return stored
+
+    def update(self, room_id, changes, base):
+        """在数据库内按字段合并：已有配置 || 修改的字段，再删除值为 None 的字段"""
+        values = {key: value for key, value in changes.items() if value is not None}
+        removed = [key for key, value in changes.items() if value is None]
+        with self.pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (self.table_name,))
+                    cursor.execute(
+                        f"INSERT INTO {self.table_name} AS room_config (room_id, config) VALUES (%s, %s::jsonb) "
+                        f"ON CONFLICT (room_id) DO UPDATE SET "
+                        f"config = (room_config.config || %s::jsonb) - %s::text[], "
+                        f"version = nextval('{self.table_name}_version_seq') "
+                        f"RETURNING config",
+                        (
+                            room_id, json.dumps(merge_config(base, changes), ensure_ascii=False),
+                            json.dumps(values, ensure_ascii=False), removed,
+                        )
+                    )
+                    stored = cursor.fetchone()[0]
+                    cursor.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, room_id))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return stored
+
+    def flush(self):
+        pass
+
+    def _listen(self):
+        if self.listen_conn is None:
+            conn = psycopg2.connect(**self.db_config)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            self.listen_conn = conn
+        return self.listen_conn
+
+    def wait_for_change(self, timeout, stop_event):
+        """等待 NOTIFY，超时后同样返回（按版本号兜底检查一次）"""
+        try:
+            conn = self._listen()
+            if select.select([conn], [], [], timeout) != ([], [], []):
+                conn.poll()
+                conn.notifies.clear()
+        except Exception as e:
+            warning(f"房间配置 LISTEN 连接异常，稍后重连: {e}")
+            self._close_listen()
+            stop_event.wait(timeout)
+
+    def _close_listen(self):
+        if self.listen_conn is not None:
+            try:
+                self.listen_conn.close()
+            except Exception:
+                pass
+            self.listen_conn = None
+
+    def close(self):
+        self._close_listen()
+
+
+def create_room_config_store(room_config_path="room_id_config.json", db_config=None):
+    """
+    按环境变量 ROOM_CONFIG_BACKEND（json / sqlite / postgres）创建房间配置存储。
+    sqlite / postgres 的表为空时，由 RoomConfigManager 导入 room_id_config.json 中的已有配置
+    """
+    backend = os.getenv("ROOM_CONFIG_BACKEND", "json").lower()
+    try:
+        if backend == "sqlite":
+            path = os.getenv("ROOM_CONFIG_SQLITE_PATH", DEFAULT_SQLITE_PATH)
+            if not os.path.isabs(path):
+                path = os.path.join(ROOT_DIR, path)
+            store = SqliteRoomConfigStore(path)
+        elif backend == "postgres":
+            store = PostgresRoomConfigStore(db_config or load_db_config())
+        else:
+            if backend != "json":
+                warning(f"未知的房间配置存储 {backend}，使用 json")
+            backend = "json"
+            store = JsonRoomConfigStore(
+                room_config_path, save_delay=float(os.getenv("ROOM_CONFIG_SAVE_DELAY", 1.0))
+            )
+    except Exception as e:
+        error(f"房间配置存储 {backend} 初始化失败，改用 json 文件: {e}")
+        backend = "json"
+        store = JsonRoomConfigStore(room_config_path)
+    info(f"房间配置存储: {backend}")
+    return store
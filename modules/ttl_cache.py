@@ -0,0 +1,88 @@
+"""
+带过期时间的 LRU 缓存
+线程安全，容量有上限，超出时淘汰最久未使用的条目；过期时间使用绝对时间戳，便于持久化。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# 未命中时的默认返回值，用于区分“缓存了 None”与“没有缓存”
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        """
+        :param maxsize: 最大条目数
+        :param ttl: 默认过期时间（秒）
+        """
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        # key -> (value, expires_at)
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        """
+        读取缓存，未命中或已过期时返回 default
+        """
+        now = time.time()
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at <= now:
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """
+        写入缓存
+        :param ttl: 本条目的过期时间（秒），默认使用缓存配置
+        :param expires_at: 直接指定绝对过期时间戳（用于从磁盘恢复）
+        """
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def items(self):
+        """
+        返回未过期的 (key, value, expires_at) 列表
+        """
+        now = time.time()
+        with self.lock:
+            return [(k, v, exp) for k, (v, exp) in self.data.items() if exp > now]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
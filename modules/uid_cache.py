@@ -0,0 +1,180 @@
+"""
+UID 缓存
+缓存 直播间 -> 主播 UID 以及 账号 cookie -> 自身 UID 的映射，二者几乎不会变化。
+- 成功结果缓存较长时间，查询不到的结果（负缓存）缓存较短时间
+- 可选持久化到 JSON 文件，重启以及 sendGold.py / sendLike 子进程都能复用
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+
+from modules.ttl_cache import TTLCache, MISSING
+from modules.logger import debug, warning
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PERSIST_PATH = os.path.join(ROOT_DIR, "data", "uid_cache.json")
+
+
+def cookie_cache_key(cookies):
+    """
+    根据 cookie 生成缓存键，只保存 SESSDATA 的摘要，避免把 cookie 明文写入磁盘
+    :param cookies: cookie dict 或 cookie 字符串
+    """
+    if isinstance(cookies, dict):
+        raw = cookies.get("SESSDATA") or json.dumps(cookies, sort_keys=True)
+    else:
+        raw = str(cookies or "")
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+class UidCache:
+    def __init__(self, persist_path=DEFAULT_PERSIST_PATH, ttl=86400, negative_ttl=60,
+                 maxsize=10000, save_interval=5.0):
+        """
+        :param persist_path: 持久化文件路径，为空则只缓存在内存中
+        :param ttl: 成功结果的过期时间（秒）
+        :param negative_ttl: 查询不到时（负缓存）的过期时间（秒）
+        :param maxsize: 最大条目数
+        :param save_interval: 两次写盘之间的最小间隔（秒）
+        """
+        self.persist_path = persist_path or None
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.save_interval = save_interval
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        self.save_lock = threading.Lock()
+        self.last_save = 0.0
+        self.save_timer = None
+
+        self._load()
+
+    def _load(self):
+        """从磁盘恢复未过期的条目"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            now = time.time()
+            for key, item in entries.items():
+                if item.get("expires_at", 0) > now:
+                    self.cache.set(key, item.get("value"), expires_at=item["expires_at"])
+            debug(f"UID 缓存已从磁盘恢复: {self.persist_path}, 条目数量={len(self.cache)}")
+        except Exception as e:
+            warning(f"读取 UID 缓存文件失败，忽略: {e}")
+
+    def _save(self):
+        """
+        写盘：与磁盘上已有的条目合并（其他进程可能也在写），再原子替换
+        """
+        with self.save_lock:
+            self.save_timer = None
+            self.last_save = time.time()
+            entries = {}
+            try:
+                if os.path.exists(self.persist_path):
+                    with open(self.persist_path, "r", encoding="utf-8") as f:
+                        entries = json.load(f)
+            except Exception:
+                entries = {}
+
+            now = time.time()
+            entries = {k: v for k, v in entries.items() if v.get("expires_at", 0) > now}
+            for key, value, expires_at in self.cache.items():
+                old = entries.get(key)
+                if old is None or old.get("expires_at", 0) <= expires_at:
+                    entries[key] = {"value": value, "expires_at": expires_at}
+
+            try:
+                directory = os.path.dirname(self.persist_path)
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".uid_cache.", suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.persist_path)
+            except Exception as e:
+                warning(f"写入 UID 缓存文件失败: {e}")
+
+    def _schedule_save(self):
+        """按 save_interval 合并写盘；调用频繁时只安排一次延迟写入"""
+        if not self.persist_path:
+            return
+        with self.save_lock:
+            if self.save_timer is not None:
+                return
+            delay = max(0.0, self.save_interval - (time.time() - self.last_save))
+            if delay == 0.0:
+                run_now = True
+            else:
+                run_now = False
+                self.save_timer = threading.Timer(delay, self._save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+        if run_now:
+            self._save()
+
+    def flush(self):
+        """立即把内存中的条目写盘（短生命周期的脚本退出前调用）"""
+        if not self.persist_path:
+            return
+        with self.save_lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+        self._save()
+
+    def _get_or_fetch(self, key, fetch):
+        value = self.cache.get(key)
+        if value is not MISSING:
+            return value
+
+        # fetch 返回 None 表示确定查询不到（负缓存），抛出异常表示暂时失败（不缓存）
+        value = fetch()
+        self.cache.set(key, value, ttl=self.ttl if value is not None else self.negative_ttl)
+        self._schedule_save()
+        return value
+
+    def get_anchor_uid(self, room_id, fetch):
+        """
+        获取主播 UID
+        :param fetch: 无参可调用对象，缓存未命中时调用，返回 UID 或 None
+        """
+        return self._get_or_fetch(f"anchor:{room_id}", fetch)
+
+    def get_self_uid(self, cookies, fetch):
+        """
+        获取账号自身 UID
+        :param cookies: 账号 cookie（dict 或字符串），用于生成缓存键
+        :param fetch: 无参可调用对象，缓存未命中时调用，返回 UID 或 None
+        """
+        return self._get_or_fetch(f"self:{cookie_cache_key(cookies)}", fetch)
+
+    def invalidate_anchor_uid(self, room_id):
+        self.cache.delete(f"anchor:{room_id}")
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_uid_cache():
+    """
+    获取进程内共享的 UID 缓存。
+    持久化路径可通过环境变量 UID_CACHE_PATH 指定（相对路径以项目根目录为基准），设置为空字符串则关闭持久化
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            persist_path = os.environ.get("UID_CACHE_PATH", DEFAULT_PERSIST_PATH)
+            if persist_path and not os.path.isabs(persist_path):
+                persist_path = os.path.join(ROOT_DIR, persist_path)
+            _shared_cache = UidCache(
+                persist_path=persist_path,
+                ttl=int(os.environ.get("UID_CACHE_TTL", 86400)),
+                negative_ttl=int(os.environ.get("UID_CACHE_NEGATIVE_TTL", 60)),
+            )
+        return _shared_cache
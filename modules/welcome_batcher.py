@@ -0,0 +1,104 @@
+"""
+进场欢迎合并（需设置 WELCOME_BATCH_WINDOW > 0 启用，启用后 /entry_welcome 返回 202）
+开播或被 raid 时，一秒内会有几十个 /entry_welcome 请求。每个房间的进场先放入缓冲区，
+窗口期（WELCOME_BATCH_WINDOW）结束后合并为一条欢迎语（一次 LLM 调用）、一条弹幕：
+- 同一房间两条欢迎弹幕之间至少间隔 WELCOME_MIN_INTERVAL 秒，间隔内的进场并入下一批
+- 同一批内同名用户只欢迎一次
+- 生成欢迎语在定时器线程中进行，不占用请求线程
+"""
+import os
+import threading
+import time
+
+from modules.logger import debug, info, error
+
+
+class WelcomeBatcher:
+    def __init__(self, compose, send, window=1.5, min_interval=5.0):
+        """
+        :param compose: compose(room_id, entries) -> 欢迎语；entries 为 [{"uname", "is_captain", "face"}]
+        :param send: send(room_id, text)，发送弹幕
+        :param window: 第一位用户进场后等待多少秒再合并发送
+        :param min_interval: 同一房间两次发送之间的最小间隔（秒）
+        """
+        self.compose = compose
+        self.send = send
+        self.window = window
+        self.min_interval = min_interval
+
+        self.lock = threading.Lock()
+        # 房间 -> 待欢迎的进场（按昵称去重，保持进场顺序）
+        self.pending = {}
+        # 房间 -> 上一次发送的时间（monotonic），超过 min_interval 的记录不再影响发送时间，发送时清理
+        self.last_sent = {}
+
+        self.batches = 0
+        self.entries = 0
+
+    def submit(self, room_id, uname, is_captain=False, face=None):
+        """
+        加入房间的欢迎缓冲区
+        :return: 本批已有的进场人数
+        """
+        now = time.monotonic()
+        with self.lock:
+            batch = self.pending.get(room_id)
+            if batch is None:
+                batch = self.pending[room_id] = {}
+                delay = max(self.window, self.last_sent.get(room_id, float("-inf")) + self.min_interval - now)
+                timer = threading.Timer(delay, self._flush, args=(room_id,))
+                timer.daemon = True
+                timer.start()
+            entry = batch.get(uname)
+            if entry is None:
+                batch[uname] = {"uname": uname, "is_captain": bool(is_captain), "face": face}
+            else:
+                entry["is_captain"] = entry["is_captain"] or bool(is_captain)
+                entry["face"] = entry["face"] or face
+            self.entries += 1
+            return len(batch)
+
+    def _flush(self, room_id):
+        with self.lock:
+            batch = self.pending.pop(room_id, None)
+            now = time.monotonic()
+            self.last_sent[room_id] = now
+            for other in [r for r, sent in self.last_sent.items() if now - sent >= self.min_interval]:
+                if other not in self.pending:
+                    del self.last_sent[other]
+            if batch:
+                self.batches += 1
+        if not batch:
+            return
+        entries = list(batch.values())
+        try:
+            text = self.compose(room_id, entries)
+        except Exception as e:
+            error(f"房间 {room_id} 生成合并欢迎语失败: {e}")
+            text = "欢迎各位小伙伴喵～"
+        debug(f"房间 {room_id} 合并欢迎 {len(entries)} 位用户: {text}")
+        try:
+            self.send(room_id, text)
+        except Exception as e:
+            error(f"房间 {room_id} 发送合并欢迎语失败: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending_rooms": len(self.pending),
+                "entries": self.entries,
+                "batches": self.batches,
+            }
+
+
+def create_welcome_batcher(compose, send):
+    """
+    按环境变量 WELCOME_BATCH_WINDOW / WELCOME_MIN_INTERVAL 创建欢迎合并器；
+    默认 WELCOME_BATCH_WINDOW=0，返回 None（每次进场单独生成并发送，接口响应保持 200 及欢迎语等字段）
+    """
+    window = float(os.getenv("WELCOME_BATCH_WINDOW", 0))
+    if window <= 0:
+        return None
+    min_interval = float(os.getenv("WELCOME_MIN_INTERVAL", 5.0))
+    info(f"进场欢迎合并已启用: window={window}s, min_interval={min_interval}s")
+    return WelcomeBatcher(compose, send, window=window, min_interval=min_interval)
@@ -0,0 +1,39 @@
+import time
+
+from modules.action_queue import ActionQueue, STATUS_SUCCEEDED
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_retrying_action_keeps_room_order():
+    action_queue = ActionQueue(num_workers=1, base_backoff=0.2)
+    calls = []
+    failures = {"left": 1}
+
+    def action(name):
+        calls.append(name)
+        if name == "A" and failures["left"]:
+            failures["left"] -= 1
+            raise RuntimeError("temporary failure")
+        return True
+
+    try:
+        job_a = action_queue.submit("1", "danmaku", action, "A")
+        assert wait_for(lambda: calls == ["A"])
+        job_b = action_queue.submit("1", "danmaku", action, "B")
+        # 其他房间不受退避影响
+        job_c = action_queue.submit("2", "danmaku", action, "C")
+        assert wait_for(lambda: action_queue.get_job(job_c)["status"] == STATUS_SUCCEEDED)
+        assert calls == ["A", "C"]
+        assert wait_for(lambda: action_queue.get_job(job_b)["status"] == STATUS_SUCCEEDED)
+    finally:
+        action_queue.shutdown(timeout=2.0)
+
+    assert calls == ["A", "C", "A", "B"]
+    assert action_queue.get_job(job_a)["attempts"] == 2
+    assert action_queue.pending_count() == 0
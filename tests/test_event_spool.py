@@ -0,0 +1,85 @@
+import json
+import time
+
+import psycopg2
+
+from modules.event_spool import EventSpool
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_bad_event_is_dead_lettered_and_replay_continues(tmp_path):
+    written = []
+
+    def handler(events):
+        if any(event["payload"].get("bad") for event in events):
+            raise psycopg2.errors.NumericValueOutOfRange("integer out of range")
+        written.extend(event["payload"]["tid"] for event in events)
+
+    spool = EventSpool(str(tmp_path / "spool"), handler, replay_interval=0.01)
+    try:
+        for i in range(6):
+            spool.append({"kind": "gift", "payload": {"tid": str(i), "bad": i == 2}})
+        assert wait_for(lambda: spool.stats()["pending_bytes"] == 0)
+    finally:
+        spool.close()
+
+    assert written == ["0", "1", "3", "4", "5"]
+    assert spool.stats()["dead_lettered"] == 1
+    dead_letter = tmp_path / "spool" / "slot-0" / "dead_letter.jsonl"
+    entries = [json.loads(line) for line in dead_letter.read_text(encoding="utf-8").splitlines()]
+    assert [entry["record"]["payload"]["tid"] for entry in entries] == ["2"]
+
+
+def test_transient_error_keeps_events_for_retry(tmp_path):
+    failures = {"left": 1}
+    written = []
+
+    def handler(events):
+        if failures["left"]:
+            failures["left"] -= 1
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        written.extend(event["payload"]["tid"] for event in events)
+
+    spool = EventSpool(str(tmp_path / "spool"), handler, replay_interval=0.01, max_backoff=0.5)
+    try:
+        for i in range(3):
+            spool.append({"kind": "gift", "payload": {"tid": str(i)}})
+        assert wait_for(lambda: len(written) == 3)
+    finally:
+        spool.close()
+
+    assert written == ["0", "1", "2"]
+    assert spool.stats()["dead_lettered"] == 0
+
+
+def test_orphaned_slot_is_drained_by_another_worker(tmp_path):
+    written = []
+
+    def handler(events):
+        written.extend(event["payload"]["tid"] for event in events)
+
+    def unavailable(events):
+        raise psycopg2.OperationalError("could not connect to server")
+
+    directory = str(tmp_path / "spool")
+    survivor = EventSpool(directory, handler, replay_interval=0.01, orphan_scan_interval=0.05)
+    # 缩容前的另一个 worker：数据库不可用时退出，事件留在 slot-1
+    retired = EventSpool(directory, unavailable, replay_interval=0.01)
+    assert retired.directory.endswith("slot-1")
+    retired.append_many([{"kind": "gift", "payload": {"tid": str(i)}} for i in range(3)])
+    retired.close(timeout=0.5)
+    try:
+        assert wait_for(lambda: len(written) == 3)
+        assert wait_for(lambda: survivor.stats()["orphan_directory"] is None)
+    finally:
+        survivor.close()
+
+    assert sorted(written) == ["0", "1", "2"]
+    assert survivor.stats()["orphan_replayed"] == 3
+    assert not list((tmp_path / "spool" / "slot-1").glob("*.seg"))
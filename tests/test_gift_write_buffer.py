@@ -0,0 +1,67 @@
+import json
+import threading
+import time
+
+import psycopg2
+
+from modules.gift_write_buffer import GiftWriteBuffer
+
+
+class FakeDBHandler:
+    """按行模拟数据库：含坏行的批次整体失败（与事务回滚一致）"""
+    def __init__(self, bad_rows=(), transient_failures=0):
+        self.bad_rows = set(bad_rows)
+        self.transient_failures = transient_failures
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def insert_gift_rows(self, rows, page_size=500, skip_existing_tid=False):
+        with self.lock:
+            if self.transient_failures:
+                self.transient_failures -= 1
+                raise psycopg2.OperationalError("server closed the connection unexpectedly")
+            for row in rows:
+                if row in self.bad_rows:
+                    raise psycopg2.errors.NumericValueOutOfRange("integer out of range")
+            self.rows.extend(rows)
+            return list(range(len(rows)))
+
+
+def test_bad_row_is_dead_lettered_and_the_rest_are_written(tmp_path):
+    dead_letter_path = tmp_path / "dead_letter" / "gift_rows.jsonl"
+    rows = [(i, f"user{i}") for i in range(10)]
+    bad = rows[6]
+    db = FakeDBHandler(bad_rows=[bad])
+    buffer = GiftWriteBuffer(db, batch_size=10, flush_interval=0.01, dead_letter_path=str(dead_letter_path))
+    for row in rows:
+        assert buffer.offer(row)
+    buffer.close()
+
+    assert db.rows == [row for row in rows if row != bad]
+    stats = buffer.stats()
+    assert stats["buffered"] == 0
+    assert stats["written"] == 9
+    assert stats["dead_lettered"] == 1
+
+    entries = [json.loads(line) for line in dead_letter_path.read_text(encoding="utf-8").splitlines()]
+    assert len(entries) == 1
+    assert entries[0]["record"] == list(bad)
+    assert "NumericValueOutOfRange" in entries[0]["error"]
+
+
+def test_transient_error_retries_the_whole_batch(tmp_path):
+    dead_letter_path = tmp_path / "gift_rows.jsonl"
+    rows = [(i, f"user{i}") for i in range(5)]
+    db = FakeDBHandler(transient_failures=1)
+    buffer = GiftWriteBuffer(db, batch_size=5, flush_interval=0.01, max_backoff=0.5,
+                             dead_letter_path=str(dead_letter_path))
+    for row in rows:
+        assert buffer.offer(row)
+    deadline = time.time() + 5
+    while buffer.stats()["written"] < len(rows) and time.time() < deadline:
+        time.sleep(0.05)
+    buffer.close()
+
+    assert db.rows == rows
+    assert buffer.stats()["failed_flushes"] == 1
+    assert not dead_letter_path.exists()
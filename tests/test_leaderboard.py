@@ -0,0 +1,76 @@
+import datetime
+import random
+
+from modules.db_handler import DBHandler
+from modules.leaderboard import Leaderboard, SortedIndex
+
+
+class FakeDBHandler:
+    """只提供排行榜追加读取用到的接口"""
+    table_name = "gift_records"
+    _period_range = DBHandler._period_range
+
+    def __init__(self):
+        self.records = {}
+
+    def commit(self, record_id, uid, price, room_id="1"):
+        self.records[record_id] = {
+            "id": record_id, "timestamp": datetime.datetime.now(), "room_id": room_id,
+            "uid": uid, "uname": f"user{uid}", "price": price,
+        }
+        return self.records[record_id]
+
+    def get_records_after(self, after_id, columns, room_ids=None, limit=500, include_ids=None):
+        include_ids = set(include_ids or ())
+        ids = sorted(i for i in self.records if i > after_id or i in include_ids)
+        return [dict(self.records[i]) for i in ids[:limit]]
+
+
+def loaded_leaderboard(db):
+    """模拟一次空库上的完整加载"""
+    leaderboard = Leaderboard(db, periods=("day", None))
+    leaderboard.ranges = leaderboard._current_ranges(datetime.date.today())
+    leaderboard.today = datetime.date.today()
+    leaderboard.ready = True
+    return leaderboard
+
+
+def test_sorted_index_matches_sorted_list():
+    index = SortedIndex(load=4)
+    expected = []
+    rng = random.Random(7)
+    for _ in range(2000):
+        if expected and rng.random() < 0.4:
+            key = expected.pop(rng.randrange(len(expected)))
+            index.remove(key)
+        else:
+            key = (rng.randrange(1000), rng.randrange(1000000))
+            if key in expected:
+                continue
+            expected.append(key)
+            index.add(key)
+        expected.sort()
+    assert len(index) == len(expected)
+    assert index.head(len(expected) + 5) == expected
+    assert index.head(3) == expected[:3]
+
+
+def test_catch_up_picks_up_other_workers_and_late_commits():
+    db = FakeDBHandler()
+    leaderboard = loaded_leaderboard(db)
+
+    # 本进程的写入由监听器立即计入，追加读取时不会重复计算
+    leaderboard.on_write("gift_records", [db.commit(1, uid=10, price=100)])
+    # 其他 worker 的写入；ID 2 的事务尚未提交
+    db.commit(3, uid=20, price=50)
+    leaderboard.catch_up()
+    assert [(r["uid"], r["total_price"]) for r in leaderboard.top(limit=10)] == [(10, 100), (20, 50)]
+
+    # ID 2 延迟提交后由下一次追加读取补上
+    db.commit(2, uid=20, price=80)
+    leaderboard.catch_up()
+    assert [(r["uid"], r["total_price"]) for r in leaderboard.top(limit=10)] == [(20, 130), (10, 100)]
+
+    leaderboard.catch_up()
+    assert leaderboard.top(room_id="1", limit=10, period="day")[0]["total_price"] == 130
+    assert not leaderboard.missing
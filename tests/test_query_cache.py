@@ -0,0 +1,41 @@
+import pytest
+
+from modules.query_cache import MemoryCacheBackend, QueryCache, SqliteCacheBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_backend(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "sqlite":
+            return SqliteCacheBackend(str(tmp_path / "query_cache.sqlite3"), **kwargs)
+        return MemoryCacheBackend(**kwargs)
+    return make
+
+
+def test_tag_generations_stay_bounded_without_false_hits(make_backend):
+    backend = make_backend(tags_maxsize=3, tag_ttl=60)
+    cache = QueryCache(backend, default_ttl=60)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return len(loads)
+
+    assert cache.get_or_load("user", "uid:1", ["uid:1"], loader) == 1
+    assert cache.get_or_load("user", "uid:1", ["uid:1"], loader) == 1
+
+    # 写入该用户后，它的标签又被大量其他用户的写入挤出
+    cache.invalidate(["uid:1"])
+    for uid in range(2, 50):
+        cache.invalidate([f"uid:{uid}"])
+    assert backend.tag_count() <= 3
+
+    assert cache.get_or_load("user", "uid:1", ["uid:1"], loader) == 2
+    assert cache.get_or_load("user", "uid:1", ["uid:1"], loader) == 2
+
+
+def test_expired_tag_generations_are_dropped(make_backend):
+    backend = make_backend(tags_maxsize=100, tag_ttl=0)
+    for uid in range(10):
+        backend.bump([f"uid:{uid}"])
+    assert backend.tag_count() == 0
@@ -0,0 +1,48 @@
+from modules.room_config_manager import RoomConfigManager
+from modules.room_config_store import JsonRoomConfigStore, SqliteRoomConfigStore
+
+GLOBAL_CONFIG = {"max_hourly_battery_per_room": 100, "max_daily_battery": 1000}
+
+
+def manager(tmp_path, store):
+    return RoomConfigManager(str(tmp_path / "missing.json"), GLOBAL_CONFIG, store=store)
+
+
+def test_concurrent_toggles_on_shared_sqlite_store_are_not_lost(tmp_path):
+    path = str(tmp_path / "room_config.sqlite3")
+    a = manager(tmp_path, SqliteRoomConfigStore(path))
+    b = manager(tmp_path, SqliteRoomConfigStore(path))
+    a.set_room_youxiao("1", True)
+    b.refresh()
+    assert b.get_room_youxiao("1") is True
+
+    # B 尚未取回 A 的下一次修改时修改另一个字段
+    a.set_room_youxiao("1", False)
+    b.set_room_prompt("1", "喵")
+
+    c = manager(tmp_path, SqliteRoomConfigStore(path))
+    assert c.get_room_youxiao("1") is False
+    assert c.get_room_prompt("1") == "喵"
+    assert b.get_room_youxiao("1") is False
+
+    a.set_room_prompt("1", None)
+    assert manager(tmp_path, SqliteRoomConfigStore(path)).get_room_prompt("1") is None
+
+
+def test_concurrent_toggles_on_shared_json_file_are_not_lost(tmp_path):
+    path = str(tmp_path / "room_id_config.json")
+    a = RoomConfigManager(path, GLOBAL_CONFIG, store=JsonRoomConfigStore(path, save_delay=60))
+    b = RoomConfigManager(path, GLOBAL_CONFIG, store=JsonRoomConfigStore(path, save_delay=60))
+    a.get_room_youxiao("1")
+    a.flush()
+    b.refresh()
+
+    b.set_room_prompt("1", "喵")
+    b.flush()
+    # A 尚未取回 B 的修改
+    a.set_room_welcome_enabled("1", True)
+    a.flush()
+
+    c = RoomConfigManager(path, GLOBAL_CONFIG, store=JsonRoomConfigStore(path))
+    assert c.get_room_prompt("1") == "喵"
+    assert c.get_room_welcome_enabled("1") is True
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+汇总查询执行计划检查工具
+对 DBHandler 的汇总查询执行 EXPLAIN（不执行查询本身），可在 CI 或上线前对真实数据库运行。
+每个查询都要求过滤列（时间列，或房间/用户列）出现在索引扫描的 Index Cond 中，
+且不出现在任何节点的 Filter 中；出现顺序扫描或不满足上述条件时以退出码 1 结束。
+
+检查时会关闭 enable_seqscan，使小表的执行计划与大表一致。关闭后规划器在谓词无法使用索引时
+（例如对时间列套用 DATE()/EXTRACT()）仍可能退化为整个索引扫描加 Filter，
+因此判断依据是 Index Cond / Filter 的内容，而不是扫描节点的类型。
+"""
+import re
+import sys
+import argparse
+import logging
+import datetime
+from pathlib import Path
+
+import psycopg2
+import psycopg2.extras
+
+# 添加项目根目录到模块搜索路径
+current_dir = Path(__file__).parent
+root_dir = current_dir.parent
+sys.path.append(str(root_dir))
+
+from modules.db_handler import DBHandler
+from modules.logger import get_logger, info, warning, error
+
+
+class ExplainCursor:
+    """
+    把 SELECT 改写为 EXPLAIN 执行并记录计划。
+    查询结果为形状正确的空结果：fetchall 返回空列表，fetchone 返回列数与列名都正确的一行，
+    每列为该类型的空值（json 列为空列表，其他列为 None），需要解包结果的方法可以正常执行完
+    """
+    JSON_TYPE_OIDS = (114, 3802)  # json, jsonb
+
+    def __init__(self, cursor, plans):
+        self.cursor = cursor
+        self.plans = plans
+        self.description = None
+
+    def execute(self, query, params=None):
+        self.cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        self.plans.append((query, self.cursor.fetchone()[0][0]["Plan"]))
+        # LIMIT 0 只规划不读取数据，用来取得结果列的名称与类型
+        self.cursor.execute(f"SELECT * FROM ({query.strip().rstrip(';')}) AS explain_check LIMIT 0", params)
+        self.description = self.cursor.description
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        if self.description is None:
+            return None
+        names = [column.name for column in self.description]
+        values = [[] if column.type_code in self.JSON_TYPE_OIDS else None for column in self.description]
+        if isinstance(self.cursor, psycopg2.extras.DictCursor):
+            return dict(zip(names, values))
+        return tuple(values)
+
+    def close(self):
+        self.cursor.close()
+
+
+class ExplainConnection:
+    def __init__(self, conn, plans):
+        self.conn = conn
+        self.plans = plans
+
+    def cursor(self, *args, **kwargs):
+        return ExplainCursor(self.conn.cursor(*args, **kwargs), self.plans)
+
+
+class ExplainDBHandler(DBHandler):
+    """所有查询都在同一个关闭了 enable_seqscan 的连接上执行 EXPLAIN"""
+    def __init__(self, env_path, table_name, use_rollups):
+        super().__init__(env_path, table_name)
+        self.use_rollups = use_rollups
+        self.plans = []
+        self.conn = psycopg2.connect(**self.db_config)
+        with self.conn.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+
+    def get_connection(self):
+        return ExplainConnection(self.conn, self.plans)
+
+    def release_connection(self, conn):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+def find_seq_scans(plan):
+    """返回计划树中所有顺序扫描的表名"""
+    tables = []
+    if plan.get("Node Type") == "Seq Scan":
+        tables.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        tables.extend(find_seq_scans(child))
+    return tables
+
+
+def _references_column(expression, column):
+    """表达式中是否引用了该列（忽略 ::timestamp 这类类型转换）"""
+    pattern = rf'(?<![:\w"])"?{re.escape(column)}"?(?![\w(])'
+    return re.search(pattern, expression or "") is not None
+
+
+def find_index_problems(plan, column):
+    """
+    检查计划树是否用 column 作为索引条件
+    :return: 问题描述列表，为空表示通过
+    """
+    problems = []
+    indexed = False
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get("Plans", []))
+        if _references_column(node.get("Index Cond"), column):
+            indexed = True
+        if _references_column(node.get("Filter"), column):
+            problems.append(f"{node.get('Node Type')} 在 Filter 中过滤 {column}: {node.get('Filter')}")
+    if not indexed:
+        problems.append(f"没有以 {column} 为条件的索引扫描（Index Cond）")
+    return problems
+
+
+def check_queries(env_path, table_name, use_rollups, room_id, uid):
+    """
+    对需要走索引的汇总查询执行 EXPLAIN
+    :return: 未通过检查的 (查询名称, 问题列表)
+    """
+    db = ExplainDBHandler(env_path, table_name, use_rollups)
+    today = datetime.date.today()
+    iso_year, iso_week, _ = today.isocalendar()
+    # 原始记录的时间列为 timestamp，汇总表为 bucket
+    time_col = "bucket" if use_rollups else "timestamp"
+    # (查询名称, 调用, 必须作为索引条件的列)
+    cases = [
+        ("daily_summary", lambda: db.get_daily_summary(today.strftime("%Y-%m-%d")), time_col),
+        ("weekly_summary", lambda: db.get_weekly_summary(iso_year, iso_week), time_col),
+        ("monthly_summary", lambda: db.get_monthly_summary(today.year, today.month), time_col),
+        ("user_contribution", lambda: db.get_user_contribution(uid), "uid"),
+        ("top_contributors_room", lambda: db.get_top_contributors(room_id=room_id, limit=10), "room_id"),
+        ("top_contributors_day", lambda: db.get_top_contributors(limit=10, period="day"), time_col),
+        ("top_contributors_room_month", lambda: db.get_top_contributors(room_id=room_id, limit=10, period="month"), time_col),
+        ("gift_trend", lambda: db.get_gift_trend(days=30), time_col),
+        ("gift_trend_room", lambda: db.get_gift_trend(room_id=room_id, days=30), time_col),
+        ("room_dashboard", lambda: db.get_room_dashboard(room_id, period="month"), time_col),
+    ]
+
+    failures = []
+    try:
+        for name, run, column in cases:
+            db.plans.clear()
+            run()
+            for query, plan in db.plans:
+                problems = [f"顺序扫描 {table}" for table in find_seq_scans(plan)]
+                problems.extend(find_index_problems(plan, column))
+                if problems:
+                    failures.append((name, problems))
+                    error(f"[{'rollup' if use_rollups else 'raw'}] {name} 未使用索引: {problems}\n{query.strip()}")
+                else:
+                    info(f"[{'rollup' if use_rollups else 'raw'}] {name} OK")
+    finally:
+        db.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查汇总查询是否使用索引")
+    parser.add_argument("--env", default=str(root_dir / "missions/.env"), help="环境变量文件路径")
+    parser.add_argument("--table", default="gift_records", help="表名")
+    parser.add_argument("--mode", choices=["raw", "rollup", "both"], default="both",
+                        help="检查原始记录查询、汇总表查询或两者")
+    parser.add_argument("--room-id", default="1", help="查询使用的房间ID")
+    parser.add_argument("--uid", type=int, default=1, help="查询使用的用户ID")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        default="INFO", help="日志级别")
+    args = parser.parse_args()
+
+    get_logger("explain_check", None, getattr(logging, args.log_level))
+
+    modes = {"raw": [False], "rollup": [True], "both": [False, True]}[args.mode]
+    failures = []
+    for use_rollups in modes:
+        failures.extend(check_queries(args.env, args.table, use_rollups, args.room_id, args.uid))
+
+    if failures:
+        warning(f"共 {len(failures)} 个查询未使用索引")
+        sys.exit(1)
+    info("所有汇总查询均使用索引")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -81,7 +81,7 @@ def record_exists_by_tid(db: DBHandler, tid: str) -> bool:
         return cur.fetchone() is not None
     finally:
         cur.close()
-        conn.close()
+        db.release_connection(conn)
 
 
 def map_row_to_payload(row: Dict[str, str]) -> Dict[str, Any]:
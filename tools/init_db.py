@@ -18,8 +18,24 @@ root_dir = current_dir.parent
 sys.path.append(str(root_dir))
 
 from modules.logger import get_logger, debug, info, warning, error, critical
+from modules.partition_manager import is_partitioned, ensure_current_partitions, migrate_to_partitioned
 
-def init_database(env_path, table_name="gift_records", drop_existing=False):
+def prepare_partitioned_table(cursor, table_name, partitioned, migrate):
+    """
+    按需把表创建为 / 迁移为按月分区表
+    :return: 表最终是否为分区表
+    """
+    state = is_partitioned(cursor, table_name)
+    if not partitioned:
+        return bool(state)
+    if state is False:
+        if not migrate:
+            warning(f"表 {table_name} 是普通表，未启用分区；迁移请执行 tools/init_db.py --partitioned --migrate-partitions")
+            return False
+        migrate_to_partitioned(cursor, table_name, int(os.getenv("GIFT_PARTITION_MONTHS_AHEAD", 2)))
+    return True
+
+def init_database(env_path, table_name="gift_records", drop_existing=False, partitioned=False, migrate=False):
     """
     初始化数据库表结构
     
@@ -27,6 +43,8 @@ def init_database(env_path, table_name="gift_records", drop_existing=False):
         env_path: 环境变量文件路径
         table_name: 要创建的表名
         drop_existing: 是否删除已存在的表
+        partitioned: 是否使用按 timestamp 的按月分区表（表不存在时创建为分区表）
+        migrate: 已存在的普通表是否迁移为分区表
         
     Returns:
         bool: 初始化是否成功
@@ -51,12 +69,15 @@ def init_database(env_path, table_name="gift_records", drop_existing=False):
         # 如果指定了删除表，先删除已存在的表
         if drop_existing:
             cursor.execute(f'DROP TABLE IF EXISTS {table_name} CASCADE')
+            for suffix in ("room_hourly", "room_daily", "user_daily"):
+                cursor.execute(f'DROP TABLE IF EXISTS {table_name}_{suffix}')
             info(f"Dropped existing table {table_name}")
         
-        # 创建礼物记录表
+        # 创建礼物记录表（分区表的主键必须包含分区键 timestamp）
+        partitioned = prepare_partitioned_table(cursor, table_name, partitioned, migrate)
         cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS {table_name} (
-            id SERIAL PRIMARY KEY,
+            id SERIAL{"" if partitioned else " PRIMARY KEY"},
             timestamp TIMESTAMP NOT NULL,
             room_id TEXT NOT NULL,
             uid BIGINT NOT NULL,
@@ -64,9 +85,11 @@ def init_database(env_path, table_name="gift_records", drop_existing=False):
             gift_id INTEGER NOT NULL,
             gift_name TEXT NOT NULL,
             price INTEGER NOT NULL,
-            gift_num INTEGER DEFAULT 1
-        )
+            gift_num INTEGER DEFAULT 1{", PRIMARY KEY (id, timestamp)" if partitioned else ""}
+        ){" PARTITION BY RANGE (timestamp)" if partitioned else ""}
         ''')
+        if partitioned:
+            ensure_current_partitions(cursor, table_name, int(os.getenv("GIFT_PARTITION_MONTHS_AHEAD", 2)))
         
         # 为新字段进行向前兼容的 schema 升级
         cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS total_price INTEGER")
@@ -100,6 +123,12 @@ def init_database(env_path, table_name="gift_records", drop_existing=False):
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_uid ON {table_name}(uid)')
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_room_id ON {table_name}(room_id)')
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_tid ON {table_name}(tid)')
+        # 复合覆盖索引：按房间 + 时间区间统计（INCLUDE price 可走 index-only scan），按用户 + 时间查询贡献
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_room_id_timestamp ON {table_name}(room_id, timestamp) INCLUDE (price)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_uid_timestamp ON {table_name}(uid, timestamp)')
+
+        # 汇总表（首次创建时从原始记录回填）
+        init_rollup_tables(cursor, table_name)
         
         conn.commit()
         info(f"Database table '{table_name}' and indexes initialized successfully")
@@ -123,9 +152,111 @@ def init_database(env_path, table_name="gift_records", drop_existing=False):
         traceback.print_exc()
         return False
 
-def init_guard_table(env_path, table_name="guard_records", drop_existing=False):
+def init_rollup_tables(cursor, table_name="gift_records", rebuild=False):
+    """
+    创建礼物汇总表，写入礼物时在同一事务内增量更新（见 DBHandler._apply_rollups）：
+    - {table}_room_hourly: (room_id, 小时) -> 礼物数量、总价
+    - {table}_room_daily:  (room_id, 日期) -> 礼物数量、总价
+    - {table}_user_daily:  (room_id, uid, 日期) -> 用户名、礼物数量、总价
+    汇总表不存在（首次创建）或 rebuild=True 时，从原始记录重新计算。
+
+    Args:
+        cursor: 数据库游标（调用方负责提交事务）
+        table_name: 原始礼物记录表名
+        rebuild: 是否清空并重新计算汇总数据
+    """
+    cursor.execute("SELECT to_regclass(%s)", (f"{table_name}_room_daily",))
+    needs_backfill = rebuild or cursor.fetchone()[0] is None
+
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table_name}_room_hourly (
+        room_id TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        gift_count BIGINT NOT NULL DEFAULT 0,
+        total_price BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (room_id, bucket)
+    )
+    ''')
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table_name}_room_daily (
+        room_id TEXT NOT NULL,
+        bucket DATE NOT NULL,
+        gift_count BIGINT NOT NULL DEFAULT 0,
+        total_price BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (room_id, bucket)
+    )
+    ''')
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table_name}_user_daily (
+        room_id TEXT NOT NULL,
+        uid BIGINT NOT NULL,
+        bucket DATE NOT NULL,
+        uname TEXT,
+        gift_count BIGINT NOT NULL DEFAULT 0,
+        total_price BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (room_id, uid, bucket)
+    )
+    ''')
+    # 按小时 / 日期查询（小时趋势，日/周/月汇总、趋势）以及按用户查询（用户贡献）
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_room_hourly_bucket ON {table_name}_room_hourly(bucket)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_room_daily_bucket ON {table_name}_room_daily(bucket)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_user_daily_bucket ON {table_name}_user_daily(bucket)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_user_daily_uid ON {table_name}_user_daily(uid)')
+
+    if not needs_backfill:
+        return
+
+    # 重建期间阻止写入，保证汇总与原始记录一致
+    cursor.execute(f"LOCK TABLE {table_name} IN SHARE MODE")
+    cursor.execute(f"TRUNCATE {table_name}_room_hourly, {table_name}_room_daily, {table_name}_user_daily")
+    cursor.execute(f'''
+    INSERT INTO {table_name}_room_hourly (room_id, bucket, gift_count, total_price)
+    SELECT room_id, date_trunc('hour', timestamp), COUNT(*), COALESCE(SUM(price), 0)
+    FROM {table_name}
+    GROUP BY 1, 2
+    ''')
+    cursor.execute(f'''
+    INSERT INTO {table_name}_room_daily (room_id, bucket, gift_count, total_price)
+    SELECT room_id, timestamp::date, COUNT(*), COALESCE(SUM(price), 0)
+    FROM {table_name}
+    GROUP BY 1, 2
+    ''')
+    cursor.execute(f'''
+    INSERT INTO {table_name}_user_daily (room_id, uid, bucket, uname, gift_count, total_price)
+    SELECT room_id, uid, timestamp::date, MAX(uname), COUNT(*), COALESCE(SUM(price), 0)
+    FROM {table_name}
+    GROUP BY 1, 2, 3
+    ''')
+    info(f"Rollup tables for '{table_name}' rebuilt from raw records")
+
+def rebuild_rollups(env_path, table_name="gift_records"):
     """
-    初始化上舰记录表结构（guard_records）
+    从原始礼物记录重新计算汇总表（例如关闭过 GIFT_ROLLUPS 之后重新开启时）
+    """
+    try:
+        load_dotenv(env_path)
+        db_config = {
+            "host": os.getenv("DB_HOST"),
+            "port": os.getenv("DB_PORT"),
+            "user": os.getenv("DB_USER"),
+            "password": os.getenv("DB_PASS"),
+            "database": os.getenv("DB_NAME")
+        }
+        conn = psycopg2.connect(**db_config)
+        cursor = conn.cursor()
+        init_rollup_tables(cursor, table_name, rebuild=True)
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return True
+    except Exception as e:
+        error(f"Failed to rebuild rollup tables: {e}")
+        traceback.print_exc()
+        return False
+
+def init_guard_table(env_path, table_name="guard_records", drop_existing=False, partitioned=False, migrate=False):
+    """
+    初始化上舰记录表结构（guard_records），partitioned / migrate 含义同 init_database
     """
     try:
         # 加载环境变量
@@ -147,9 +278,10 @@ def init_guard_table(env_path, table_name="guard_records", drop_existing=False):
             info(f"Dropped existing table {table_name}")
 
         # 创建上舰记录表
+        partitioned = prepare_partitioned_table(cursor, table_name, partitioned, migrate)
         cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS {table_name} (
-            id SERIAL PRIMARY KEY,
+            id SERIAL{"" if partitioned else " PRIMARY KEY"},
             timestamp TIMESTAMP NOT NULL,
             room_id TEXT NOT NULL,
             uid BIGINT NOT NULL,
@@ -161,15 +293,21 @@ def init_guard_table(env_path, table_name="guard_records", drop_existing=False):
             gift_name TEXT NOT NULL,
             start_time BIGINT,
             end_time BIGINT,
-            raw_message JSONB
-        )
+            raw_message JSONB{", PRIMARY KEY (id, timestamp)" if partitioned else ""}
+        ){" PARTITION BY RANGE (timestamp)" if partitioned else ""}
         ''')
+        if partitioned:
+            ensure_current_partitions(cursor, table_name, int(os.getenv("GIFT_PARTITION_MONTHS_AHEAD", 2)))
+
+        # 事件唯一标识，用于本地 spool 重放时去重
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS tid TEXT")
 
         # 索引
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_timestamp ON {table_name}(timestamp)')
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_uid ON {table_name}(uid)')
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_room_id ON {table_name}(room_id)')
         cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_guard_level ON {table_name}(guard_level)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_tid ON {table_name}(tid)')
 
         conn.commit()
         info(f"Database table '{table_name}' and indexes initialized successfully")
@@ -201,6 +339,10 @@ def main():
     parser.add_argument("--env", default=str(root_dir / "missions/.env"), help="环境变量文件路径")
     parser.add_argument("--table", default="gift_records", help="表名")
     parser.add_argument("--drop", action="store_true", help="删除并重新创建表")
+    parser.add_argument("--rebuild-rollups", action="store_true", help="从原始记录重新计算汇总表")
+    parser.add_argument("--partitioned", action="store_true", help="使用按月分区表（表不存在时创建为分区表）")
+    parser.add_argument("--migrate-partitions", action="store_true", help="把已有的普通表迁移为按月分区表（需同时指定 --partitioned）")
+    parser.add_argument("--guard-table", help="同时初始化的上舰记录表名（例如 guard_records）")
     parser.add_argument("--log-file", help="日志文件路径")
     parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], 
                         default="INFO", help="日志级别")
@@ -213,7 +355,11 @@ def main():
     logger = get_logger("init_db", args.log_file, log_level)
     
     # 初始化数据库
-    success = init_database(args.env, args.table, args.drop)
+    success = init_database(args.env, args.table, args.drop, args.partitioned, args.migrate_partitions)
+    if success and args.guard_table:
+        success = init_guard_table(args.env, args.guard_table, args.drop, args.partitioned, args.migrate_partitions)
+    if success and args.rebuild_rollups:
+        success = rebuild_rollups(args.env, args.table)
     
     # 设置退出码
     if success: